@@ -1,2 +1,44 @@
 # 调用模型获取天气缓存，30分钟缓存
 WEATHER_CATCH = 'weather:timeout'
+# 聊天响应缓存命名空间
+RESPONSE_CACHE = 'chat:response'
+# 会话元信息（系统提示词等），格式 session:{session_id}
+SESSION_META = 'session:{}'
+# 会话消息列表（已转换的 LangChain 消息），格式 session:{session_id}:messages
+SESSION_MESSAGES = 'session:{}:messages'
+# 历史消息摘要缓存，格式 history:summary:{消息内容哈希}
+HISTORY_SUMMARY = 'history:summary:{}'
+# 相同请求合并：领导者租约、增量日志、发布频道、跨进程跟随者计数，格式 singleflight:{消息哈希}...
+SINGLEFLIGHT_LEASE = 'singleflight:{}:lease'
+SINGLEFLIGHT_LOG = 'singleflight:{}:log'
+SINGLEFLIGHT_CHANNEL = 'singleflight:{}'
+SINGLEFLIGHT_FOLLOWERS = 'singleflight:{}:followers'
+# 准入控制：各 worker 的并发数（哈希）、worker 心跳时间（有序集合）、每分钟请求数，
+# 格式 admission:{服务商}:active_by_worker / admission:{服务商}:heartbeat / admission:{服务商}:rpm:{分钟}
+ADMISSION_ACTIVE = 'admission:{}:active_by_worker'
+ADMISSION_HEARTBEAT = 'admission:{}:heartbeat'
+ADMISSION_RPM = 'admission:{}:rpm:{}'
+# PDF 文档块缓存命名空间，键为文件内容与分块参数的哈希，条目为逐段写入的列表
+PDF_CHUNK_CACHE = 'pdf:chunk_batches'
+# 解析过程中逐段写入的文档块暂存列表，格式 pdf:chunk_batches:{文档哈希}:staging:{随机标识}
+PDF_CHUNK_STAGING = 'pdf:chunk_batches:{}:staging:{}'
+# PDF 文档块 BM25 索引命名空间，键为文档哈希
+PDF_BM25_INDEX = 'pdf:bm25'
+# 扫描页 OCR 结果缓存，格式 pdf:ocr:{页面图片哈希}
+PDF_OCR_CACHE = 'pdf:ocr:{}'
+# 文档库：解析任务队列、解析状态，格式 document:{document_id}:status
+DOCUMENT_JOBS = 'document:jobs'
+DOCUMENT_STATUS = 'document:{}:status'
+# 图片预处理结果缓存命名空间，键为图片内容哈希与处理参数，值为处理后图片的媒体 ID（空字符串表示使用原图）
+IMAGE_CACHE = 'image:optimized_ref'
+# 音频片段转写结果缓存，格式 audio:transcript:{片段音频哈希}
+AUDIO_TRANSCRIPT_CACHE = 'audio:transcript:{}'
+# 媒体存储：元信息（哈希）、引用方集合、最近访问时间（有序集合）、总字节数，格式 media:{媒体内容哈希}...
+MEDIA_META = 'media:{}'
+MEDIA_REFS = 'media:{}:refs'
+MEDIA_LRU = 'media:lru'
+MEDIA_BYTES = 'media:bytes'
+MEDIA_EVICT_LOCK = 'media:evict:lock'
+# 单个媒体的写入/淘汰锁、上传后的临时引用方（带过期时间），格式 media:{媒体内容哈希}:...
+MEDIA_LOCK = 'media:{}:lock'
+MEDIA_UPLOAD_OWNER = 'media:{}:upload'
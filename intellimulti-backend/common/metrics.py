@@ -0,0 +1,89 @@
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import Any, Dict
+
+# 配置日志
+logger = logging.getLogger("metrics")
+logger.setLevel(logging.INFO)
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> str:
+    """指标名 + 标签，如 chat_stream_aborted_total{provider=dashscope}"""
+    if not labels:
+        return name
+    label_str = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+
+class Metrics:
+    """进程内指标统计（单例模式），支持计数器、仪表盘和观测值（带近期样本分位数）"""
+    _instance = None
+    # 每个观测指标保留的近期样本数
+    SAMPLE_SIZE = 1024
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._counters = defaultdict(float)
+            cls._instance._gauges = defaultdict(float)
+            cls._instance._observations = {}
+        return cls._instance
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        """计数器累加"""
+        with self._lock:
+            self._counters[_metric_key(name, labels)] += value
+
+    def gauge(self, name: str, delta: float, **labels) -> None:
+        """仪表盘增减（如进行中的请求数）"""
+        with self._lock:
+            self._gauges[_metric_key(name, labels)] += delta
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """记录一次观测值（耗时、数量等）"""
+        key = _metric_key(name, labels)
+        with self._lock:
+            stats = self._observations.get(key)
+            if stats is None:
+                stats = {"count": 0, "sum": 0.0, "max": 0.0, "samples": deque(maxlen=self.SAMPLE_SIZE)}
+                self._observations[key] = stats
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["max"] = max(stats["max"], value)
+            stats["samples"].append(value)
+
+    def percentile(self, name: str, q: float, default: float = None, **labels) -> float:
+        """计算观测值近期样本的分位数（q 取值 0~100）"""
+        with self._lock:
+            stats = self._observations.get(_metric_key(name, labels))
+            samples = sorted(stats["samples"]) if stats else []
+        if not samples:
+            return default
+        index = min(len(samples) - 1, int(len(samples) * q / 100))
+        return samples[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出当前所有指标"""
+        with self._lock:
+            observations = {}
+            for key, stats in self._observations.items():
+                samples = sorted(stats["samples"])
+                observations[key] = {
+                    "count": stats["count"],
+                    "sum": round(stats["sum"], 4),
+                    "avg": round(stats["sum"] / stats["count"], 4) if stats["count"] else 0,
+                    "max": round(stats["max"], 4),
+                    "p50": samples[len(samples) // 2] if samples else None,
+                    "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else None,
+                }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "observations": observations,
+            }
+
+
+# 单例实例（全局唯一）
+metrics = Metrics()
@@ -98,5 +98,26 @@ class MySQLClient:
             if conn:
                 conn.close()
 
+    def execute_many(self, sql, params_list):
+        """批量执行增删改语句（返回受影响行数）"""
+        conn = None
+        cursor = None
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            affected_rows = cursor.executemany(sql, params_list)
+            logger.info(f"批量执行SQL成功: {sql[:100]}... 影响行数: {affected_rows}")
+            return affected_rows
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.error(f"批量执行SQL失败: {sql[:100]}... 错误: {str(e)}", exc_info=True)
+            raise e
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.close()
+
 # 单例实例（全局唯一）
 mysql_client = MySQLClient()
\ No newline at end of file
@@ -2,6 +2,7 @@ import json
 import pickle
 import base64
 import logging
+import time
 import redis
 from typing import Any, Optional, Union, Dict, List, Tuple
 from config.settings import settings
@@ -76,6 +77,8 @@ class RedisClient:
     """企业级Redis客户端（单例模式+连接池）支持所有数据类型"""
     _instance = None
     _pool = None
+    # 不解码响应的连接池，读取原始字节（压缩数据、二进制索引）
+    _binary_pool = None
 
     def __new__(cls):
         if cls._instance is None:
@@ -97,6 +100,14 @@ class RedisClient:
                 decode_responses=True,
                 max_connections=settings.REDIS_MAX_CONNECTIONS
             )
+            cls._binary_pool = redis.ConnectionPool(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                password=settings.REDIS_PASSWORD,
+                decode_responses=False,
+                max_connections=settings.REDIS_MAX_CONNECTIONS
+            )
             logger.info("Redis连接池初始化成功")
         except Exception as e:
             logger.error(f"Redis连接池初始化失败: {str(e)}", exc_info=True)
@@ -111,6 +122,15 @@ class RedisClient:
             logger.error(f"获取Redis客户端失败: {str(e)}", exc_info=True)
             raise e
 
+    @property
+    def binary_client(self):
+        """获取不解码响应的Redis客户端，读取结果为 bytes"""
+        try:
+            return redis.Redis(connection_pool=self._binary_pool)
+        except Exception as e:
+            logger.error(f"获取Redis客户端失败: {str(e)}", exc_info=True)
+            raise e
+
     # ===== 基础字符串操作（保持原样）=====
     def get(self, key: str) -> Optional[str]:
         """获取字符串值"""
@@ -345,6 +365,148 @@ class RedisClient:
             logger.error(f"Redis HGET {key}.{field} 失败: {str(e)}", exc_info=True)
             return None
 
+    def rpush(self, key: str, *values: str) -> Optional[int]:
+        """向列表尾部追加元素，返回列表长度"""
+        try:
+            return self.client.rpush(key, *values)
+        except Exception as e:
+            logger.error(f"Redis RPUSH {key} 失败: {str(e)}", exc_info=True)
+            return None
+
+    def blpop(self, key: str, timeout: int = 0) -> Optional[str]:
+        """阻塞弹出列表头部元素，超时或失败时返回 None"""
+        try:
+            result = self.client.blpop([key], timeout=timeout)
+            return result[1] if result else None
+        except Exception as e:
+            logger.error(f"Redis BLPOP {key} 失败: {str(e)}", exc_info=True)
+            return None
+
+    def llen(self, key: str) -> int:
+        """获取列表长度"""
+        try:
+            return self.client.llen(key)
+        except Exception as e:
+            logger.error(f"Redis LLEN {key} 失败: {str(e)}", exc_info=True)
+            return 0
+
+    def lrange(self, key: str, start: int = 0, end: int = -1) -> list:
+        """获取列表指定区间的元素"""
+        try:
+            return self.client.lrange(key, start, end)
+        except Exception as e:
+            logger.error(f"Redis LRANGE {key} 失败: {str(e)}", exc_info=True)
+            return []
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> Optional[int]:
+        """哈希字段自增，返回自增后的值"""
+        try:
+            return self.client.hincrby(key, field, amount)
+        except Exception as e:
+            logger.error(f"Redis HINCRBY {key}.{field} 失败: {str(e)}", exc_info=True)
+            return None
+
+    def hsetnx(self, key: str, field: str, value: str) -> bool:
+        """仅当哈希字段不存在时设置，返回是否设置成功"""
+        try:
+            return bool(self.client.hsetnx(key, field, value))
+        except Exception as e:
+            logger.error(f"Redis HSETNX {key}.{field} 失败: {str(e)}", exc_info=True)
+            return False
+
+    # ===== 集合与有序集合 =====
+    def sadd(self, key: str, *members: str) -> int:
+        """向集合添加成员，返回新增的成员数"""
+        try:
+            return self.client.sadd(key, *members)
+        except Exception as e:
+            logger.error(f"Redis SADD {key} 失败: {str(e)}", exc_info=True)
+            return 0
+
+    def srem(self, key: str, *members: str) -> int:
+        """从集合移除成员"""
+        try:
+            return self.client.srem(key, *members)
+        except Exception as e:
+            logger.error(f"Redis SREM {key} 失败: {str(e)}", exc_info=True)
+            return 0
+
+    def smembers(self, key: str) -> set:
+        """获取集合全部成员"""
+        try:
+            return self.client.smembers(key)
+        except Exception as e:
+            logger.error(f"Redis SMEMBERS {key} 失败: {str(e)}", exc_info=True)
+            return set()
+
+    def zadd(self, key: str, mapping: Dict[str, float]) -> int:
+        """设置有序集合成员的分数"""
+        try:
+            return self.client.zadd(key, mapping)
+        except Exception as e:
+            logger.error(f"Redis ZADD {key} 失败: {str(e)}", exc_info=True)
+            return 0
+
+    def zrange(self, key: str, start: int = 0, end: int = -1) -> list:
+        """按分数从低到高获取有序集合指定区间的成员"""
+        try:
+            return self.client.zrange(key, start, end)
+        except Exception as e:
+            logger.error(f"Redis ZRANGE {key} 失败: {str(e)}", exc_info=True)
+            return []
+
+    def zscore(self, key: str, member: str) -> Optional[float]:
+        """获取有序集合成员的分数，成员不存在时返回 None"""
+        try:
+            return self.client.zscore(key, member)
+        except Exception as e:
+            logger.error(f"Redis ZSCORE {key} 失败: {str(e)}", exc_info=True)
+            return None
+
+    def zrem(self, key: str, *members: str) -> int:
+        """从有序集合移除成员"""
+        try:
+            return self.client.zrem(key, *members)
+        except Exception as e:
+            logger.error(f"Redis ZREM {key} 失败: {str(e)}", exc_info=True)
+            return 0
+
+    # ===== 发布订阅 =====
+    def publish(self, channel: str, message: str) -> int:
+        """发布消息，返回收到消息的订阅者数量"""
+        try:
+            return self.client.publish(channel, message)
+        except Exception as e:
+            logger.error(f"Redis PUBLISH {channel} 失败: {str(e)}", exc_info=True)
+            return 0
+
+    def append_and_publish(self, key: str, channel: str, message: str, ex: int = None) -> bool:
+        """追加到列表并发布（同一个 pipeline），列表用于后加入的订阅者回放已发布的消息"""
+        try:
+            pipe = self.client.pipeline()
+            pipe.rpush(key, message)
+            if ex:
+                pipe.expire(key, ex)
+            pipe.publish(channel, message)
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Redis APPEND_AND_PUBLISH {key} 失败: {str(e)}", exc_info=True)
+            return False
+
+    def pubsub(self):
+        """创建订阅对象（忽略订阅确认消息）"""
+        return self.client.pubsub(ignore_subscribe_messages=True)
+
+    # ===== 脚本 =====
+    def eval_script(self, script: str, keys: List[str], args: List[Any]) -> Any:
+        """执行 Lua 脚本（按 SHA 调用，服务端未缓存时自动改用 EVAL），一次往返完成多条命令，失败时返回 None"""
+        try:
+            return self.client.register_script(script)(keys=keys, args=args)
+        except Exception as e:
+            logger.error(f"Redis 脚本执行失败 {keys}: {str(e)}", exc_info=True)
+            return None
+
     # ===== 高级功能 =====
     def set_with_lock(self, key: str, value: Any, ex: int = 30,
                       lock_timeout: int = 10) -> bool:
@@ -409,6 +571,149 @@ class RedisClient:
             logger.error(f"缓存函数执行失败 {key}: {str(e)}", exc_info=True)
             raise e
 
+    # ===== 带容量淘汰的缓存 =====
+    def cache_get(self, namespace: str, key: str, default: Any = None, ex: Optional[int] = None) -> Any:
+        """
+        从命名空间缓存中获取对象，命中时刷新其最近访问时间（LRU）
+
+        Args:
+            namespace: 缓存命名空间（同时作为索引有序集合的键）
+            key: 缓存键
+            default: 未命中时的默认值
+            ex: 写入时的过期时间（秒），指定时命中后同时刷新条目的过期时间
+        """
+        result = self.get_object(f"{namespace}:{key}")
+        if result is None:
+            return default
+        self._cache_touch(namespace, key, ex)
+        return result
+
+    def cache_get_bytes(self, namespace: str, key: str, ex: Optional[int] = None) -> Optional[bytes]:
+        """从命名空间缓存中获取原始字节（不经过序列化器），未命中时返回 None；ex 同 cache_get"""
+        try:
+            result = self.binary_client.get(f"{namespace}:{key}")
+        except Exception as e:
+            logger.error(f"Redis CACHE_GET_BYTES {namespace}:{key} 失败: {str(e)}", exc_info=True)
+            return None
+        if result is None:
+            return None
+        self._cache_touch(namespace, key, ex)
+        return result
+
+    def cache_get_list_bytes(self, namespace: str, key: str, ex: Optional[int] = None) -> Optional[List[bytes]]:
+        """从命名空间缓存中获取列表条目的全部元素（原始字节，一次 LRANGE），未命中时返回 None；ex 同 cache_get"""
+        try:
+            result = self.binary_client.lrange(f"{namespace}:{key}", 0, -1)
+        except Exception as e:
+            logger.error(f"Redis CACHE_GET_LIST_BYTES {namespace}:{key} 失败: {str(e)}", exc_info=True)
+            return None
+        if not result:
+            return None
+        self._cache_touch(namespace, key, ex)
+        return result
+
+    def cache_stage_bytes(self, staging_key: str, value: bytes, ex: int = 3600) -> bool:
+        """向暂存列表追加一个元素（逐段写入的缓存条目），全部写完后由 cache_commit_list 提交"""
+        try:
+            pipe = self.client.pipeline()
+            pipe.rpush(staging_key, value)
+            pipe.expire(staging_key, ex)
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Redis CACHE_STAGE_BYTES {staging_key} 失败: {str(e)}", exc_info=True)
+            return False
+
+    def cache_commit_list(self, namespace: str, key: str, staging_key: str, head: bytes, ex: int = 3600,
+                          max_entries: int = 1000) -> bool:
+        """
+        提交暂存列表：在列表头部写入 head（如条目的统计信息）后改名为缓存条目，淘汰规则同 cache_set
+        读取方只会看到完整的条目
+        """
+        try:
+            pipe = self.client.pipeline()
+            pipe.lpush(staging_key, head)
+            pipe.rename(staging_key, f"{namespace}:{key}")
+            pipe.expire(f"{namespace}:{key}", ex)
+            return self._cache_register(pipe, namespace, key, ex, max_entries)
+        except Exception as e:
+            logger.error(f"Redis CACHE_COMMIT_LIST {namespace}:{key} 失败: {str(e)}", exc_info=True)
+            return False
+
+    def cache_set(self, namespace: str, key: str, value: Any, ex: int = 3600,
+                  max_entries: int = 1000) -> bool:
+        """
+        写入命名空间缓存，超过最大条目数时按最近访问时间淘汰最旧的条目
+
+        Args:
+            namespace: 缓存命名空间（有序集合记录每个键的最近访问时间）
+            key: 缓存键
+            value: 任意Python对象
+            ex: 过期时间（秒）
+            max_entries: 命名空间内最多保留的条目数
+        """
+        try:
+            return self._cache_store(namespace, key, RedisSerializer.serialize(value), ex, max_entries)
+        except Exception as e:
+            logger.error(f"Redis CACHE_SET {namespace}:{key} 失败: {str(e)}", exc_info=True)
+            return False
+
+    def cache_set_bytes(self, namespace: str, key: str, value: bytes, ex: int = 3600,
+                        max_entries: int = 1000) -> bool:
+        """写入原始字节（不经过序列化器，不做 base64），淘汰规则同 cache_set"""
+        try:
+            return self._cache_store(namespace, key, value, ex, max_entries)
+        except Exception as e:
+            logger.error(f"Redis CACHE_SET_BYTES {namespace}:{key} 失败: {str(e)}", exc_info=True)
+            return False
+
+    def _cache_touch(self, namespace: str, key: str, ex: Optional[int] = None):
+        """
+        刷新缓存条目的最近访问时间；指定 ex 时在同一 pipeline 中刷新条目的过期时间，
+        使索引中的访问时间与条目的实际过期时间一致（否则常用条目按写入时间过期，索引中却还排在前面）
+        """
+        try:
+            pipe = self.client.pipeline()
+            pipe.zadd(namespace, {key: time.time()})
+            if ex:
+                pipe.expire(f"{namespace}:{key}", ex)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Redis CACHE_GET {namespace}:{key} 刷新访问时间失败: {str(e)}", exc_info=True)
+
+    def _cache_store(self, namespace: str, key: str, stored: Union[str, bytes], ex: int, max_entries: int) -> bool:
+        """写入已编码的缓存值并按最近访问时间淘汰超出 max_entries 的条目"""
+        pipe = self.client.pipeline()
+        pipe.set(f"{namespace}:{key}", stored, ex=ex)
+        return self._cache_register(pipe, namespace, key, ex, max_entries)
+
+    def _cache_register(self, pipe, namespace: str, key: str, ex: int, max_entries: int) -> bool:
+        """在写入条目的 pipeline 中记录访问时间并执行，再按最近访问时间淘汰超出 max_entries 的条目，返回第一条写入命令的结果"""
+        now = time.time()
+        pipe.zadd(namespace, {key: now})
+        # 清理已过期条目的索引
+        pipe.zremrangebyscore(namespace, "-inf", now - ex)
+        pipe.zcard(namespace)
+        results = pipe.execute()
+
+        overflow = results[-1] - max_entries
+        if overflow > 0:
+            evicted = self.client.zrange(namespace, 0, overflow - 1)
+            if evicted:
+                # 条目已不存在（已过期或被删除）的成员只从索引中移除，不计为淘汰
+                pipe = self.client.pipeline()
+                for k in evicted:
+                    pipe.exists(f"{namespace}:{k}")
+                alive = [k for k, exists in zip(evicted, pipe.execute()) if exists]
+                pipe = self.client.pipeline()
+                if alive:
+                    pipe.delete(*[f"{namespace}:{k}" for k in alive])
+                pipe.zrem(namespace, *evicted)
+                pipe.execute()
+                logger.debug(f"Redis CACHE_SET {namespace} 淘汰 {len(alive)} 个条目，"
+                             f"清理 {len(evicted) - len(alive)} 个失效索引")
+        return bool(results[0])
+
     def close(self):
         """关闭连接"""
         try:
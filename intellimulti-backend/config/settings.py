@@ -19,6 +19,7 @@ app_settings = AppSettings()
 cors_settings = CorsSettings()
 
 
+import json
 import os
 from dotenv import load_dotenv
 
@@ -47,5 +48,170 @@ class Config:
     # Redis连接池配置
     REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 20))
 
+    # ===== 大模型客户端配置 =====
+    # 每个服务商共享一个长连接 HTTP 连接池
+    MODEL_POOL_MAX_CONNECTIONS = int(os.getenv("MODEL_POOL_MAX_CONNECTIONS", 100))  # 单个服务商最大连接数
+    MODEL_POOL_MAX_KEEPALIVE = int(os.getenv("MODEL_POOL_MAX_KEEPALIVE", 20))  # 最大保活连接数
+    MODEL_KEEPALIVE_EXPIRY = float(os.getenv("MODEL_KEEPALIVE_EXPIRY", 120))  # 空闲连接保活时间（秒）
+    MODEL_HTTP_TIMEOUT = float(os.getenv("MODEL_HTTP_TIMEOUT", 120))  # 请求超时（秒）
+    MODEL_CONNECT_TIMEOUT = float(os.getenv("MODEL_CONNECT_TIMEOUT", 10))  # 建连超时（秒）
+    MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() == "true"  # 启动时是否预先建立连接
+
+    # ===== SSE 流式输出配置 =====
+    SSE_FLUSH_POLICY = os.getenv("SSE_FLUSH_POLICY", "window")  # immediate / window / bytes
+    SSE_FLUSH_INTERVAL_MS = int(os.getenv("SSE_FLUSH_INTERVAL_MS", 50))  # 合并窗口（毫秒）
+    SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", 1024))  # 缓冲达到该字节数立即发送
+    SSE_COMPRESSION = os.getenv("SSE_COMPRESSION", "false").lower() == "true"  # 是否启用 gzip/deflate 压缩
+    SSE_DISCONNECT_CHECK_INTERVAL = float(os.getenv("SSE_DISCONNECT_CHECK_INTERVAL", 0.5))  # 客户端断连检测间隔（秒）
+
+    # ===== 响应缓存配置 =====
+    RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"  # 是否启用（默认关闭）
+    RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 86400))  # 缓存过期时间（秒）
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 5000))  # 最多缓存的回答数
+    RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", 20000))  # 超过该长度的回答不缓存
+    RESPONSE_CACHE_REPLAY_CHARS = int(os.getenv("RESPONSE_CACHE_REPLAY_CHARS", 64))  # 命中时每个增量回放的字符数
+
+    # ===== 会话配置 =====
+    SESSION_TTL = int(os.getenv("SESSION_TTL", 7 * 24 * 3600))  # 会话空闲过期时间（秒）
+
+    # ===== 历史消息压缩配置 =====
+    # 每个模型的输入 token 预算（JSON，可通过环境变量覆盖）
+    MODEL_INPUT_TOKEN_BUDGETS = json.loads(os.getenv("MODEL_INPUT_TOKEN_BUDGETS", json.dumps({
+        "qwen3-omni-flash": 24000,
+        "qwen-max": 24000,
+        "qwen-turbo": 24000,
+        "deepseek-chat": 48000,
+    })))
+    DEFAULT_INPUT_TOKEN_BUDGET = int(os.getenv("DEFAULT_INPUT_TOKEN_BUDGET", 16000))
+    HISTORY_COMPACTION_MODE = os.getenv("HISTORY_COMPACTION_MODE", "summarize")  # summarize / drop / off
+    HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "qwen-turbo")  # 生成摘要的模型
+    HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", 200))  # 单条摘要最大字数
+    HISTORY_SUMMARY_CONCURRENCY = int(os.getenv("HISTORY_SUMMARY_CONCURRENCY", 4))  # 并发生成摘要数
+    HISTORY_SUMMARY_TTL = int(os.getenv("HISTORY_SUMMARY_TTL", 7 * 24 * 3600))  # 摘要缓存时间（秒）
+
+    # ===== 相同请求合并（single-flight）配置 =====
+    SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"  # 进程内合并
+    SINGLEFLIGHT_REDIS = os.getenv("SINGLEFLIGHT_REDIS", "false").lower() == "true"  # 通过 Redis 跨进程合并（多进程部署时开启）
+    SINGLEFLIGHT_LEASE_TTL = int(os.getenv("SINGLEFLIGHT_LEASE_TTL", 15))  # 领导者租约时间（秒），生成期间按心跳续约
+    SINGLEFLIGHT_LOG_TTL = int(os.getenv("SINGLEFLIGHT_LOG_TTL", 60))  # 生成结束后增量日志保留时间（秒）
+    SINGLEFLIGHT_PUBLISH_INTERVAL = float(os.getenv("SINGLEFLIGHT_PUBLISH_INTERVAL", 0.1))  # 跨进程发布增量的批量间隔（秒）
+
+    # ===== 模型调用准入控制配置 =====
+    # 每个服务商的并发数、每分钟请求数、最大排队数（JSON，可通过环境变量覆盖）
+    ADMISSION_LIMITS = json.loads(os.getenv("ADMISSION_LIMITS", json.dumps({
+        "dashscope": {"concurrency": 20, "rpm": 600, "queue": 100},
+        "deepseek": {"concurrency": 10, "rpm": 300, "queue": 50},
+    })))
+    ADMISSION_DEFAULT_CONCURRENCY = int(os.getenv("ADMISSION_DEFAULT_CONCURRENCY", 10))
+    ADMISSION_DEFAULT_RPM = int(os.getenv("ADMISSION_DEFAULT_RPM", 300))
+    ADMISSION_DEFAULT_QUEUE = int(os.getenv("ADMISSION_DEFAULT_QUEUE", 50))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 30))  # 最长排队时间（秒）
+    ADMISSION_RETRY_INTERVAL = float(os.getenv("ADMISSION_RETRY_INTERVAL", 0.2))  # 受 RPM/全局限制时重试放行间隔（秒）
+    ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 5))  # 默认建议重试时间（秒）
+    ADMISSION_REDIS = os.getenv("ADMISSION_REDIS", "false").lower() == "true"  # 是否通过 Redis 协调多个 worker
+    ADMISSION_REDIS_TTL = int(os.getenv("ADMISSION_REDIS_TTL", 30))  # worker 心跳超时（秒），超时 worker 的并发数不再计入全局
+
+    # ===== 模型路由配置 =====
+    ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "true").lower() == "true"  # 是否开启对冲和降级
+    ROUTER_HEDGE_ENABLED = os.getenv("ROUTER_HEDGE_ENABLED", "true").lower() == "true"  # 首 token 过慢时发起对冲请求
+    ROUTER_HEDGE_SAME_ENDPOINT = os.getenv("ROUTER_HEDGE_SAME_ENDPOINT", "true").lower() == "true"  # 没有可用降级端点时向同一端点发送重复请求
+    ROUTER_HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", 95))  # 对冲截止时间取 TTFT 的分位数
+    ROUTER_HEDGE_DEFAULT_DELAY = float(os.getenv("ROUTER_HEDGE_DEFAULT_DELAY", 3))  # 没有 TTFT 样本时的截止时间（秒）
+    ROUTER_HEDGE_MIN_DELAY = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", 1))  # 截止时间下限（秒）
+    ROUTER_HEDGE_MAX_DELAY = float(os.getenv("ROUTER_HEDGE_MAX_DELAY", 10))  # 截止时间上限（秒）
+    ROUTER_FALLBACK_MODEL = os.getenv("ROUTER_FALLBACK_MODEL", "qwen-turbo")  # 纯文本请求的降级模型，为空不降级
+    ROUTER_MULTIMODAL_FALLBACK_MODEL = os.getenv("ROUTER_MULTIMODAL_FALLBACK_MODEL", "")  # 多模态请求的降级模型
+    ROUTER_STATS_WINDOW = int(os.getenv("ROUTER_STATS_WINDOW", 100))  # 每个端点保留的最近调用结果数
+    ROUTER_STATS_SECONDS = float(os.getenv("ROUTER_STATS_SECONDS", 300))  # 错误率统计的时间窗口（秒）
+    ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", 10))  # 判定降级所需的最少样本数
+    ROUTER_DEGRADED_ERROR_RATE = float(os.getenv("ROUTER_DEGRADED_ERROR_RATE", 0.5))  # 错误率达到该值视为降级
+
+    # ===== PDF 处理配置 =====
+    PDF_EXTRACT_MAX_WORKERS = int(os.getenv("PDF_EXTRACT_MAX_WORKERS", min(4, os.cpu_count() or 1)))  # 文本提取进程数
+    PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 20))  # 每个提取任务的页数（也是进度推送粒度）
+    PDF_EXTRACT_WINDOW = int(os.getenv("PDF_EXTRACT_WINDOW", 2 * PDF_EXTRACT_MAX_WORKERS))  # 同时在途的提取任务数（限制内存中的页数）
+    PDF_CACHE_ENABLED = os.getenv("PDF_CACHE_ENABLED", "true").lower() == "true"  # 按文件内容缓存解析结果
+    PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL", 7 * 24 * 3600))  # 解析结果缓存时间（秒）
+    PDF_CACHE_MAX_ENTRIES = int(os.getenv("PDF_CACHE_MAX_ENTRIES", 500))  # 最多缓存的文档数（LRU 淘汰）
+    PDF_MAX_UPLOAD_BYTES = int(os.getenv("PDF_MAX_UPLOAD_BYTES", 200 * 1024 * 1024))  # 上传大小上限
+    PDF_MEMORY_THRESHOLD = int(os.getenv("PDF_MEMORY_THRESHOLD", 16 * 1024 * 1024))  # 超过该大小落盘到临时文件
+    PDF_READ_CHUNK_BYTES = int(os.getenv("PDF_READ_CHUNK_BYTES", 1024 * 1024))  # 读取上传文件的分块大小
+    PDF_SPOOL_DIR = os.getenv("PDF_SPOOL_DIR") or None  # 临时文件目录，默认系统临时目录
+    PDF_OCR_ENABLED = os.getenv("PDF_OCR_ENABLED", "true").lower() == "true"  # 扫描页自动 OCR
+    PDF_OCR_MODEL = os.getenv("PDF_OCR_MODEL", "qwen-vl-plus")  # 识别扫描页的视觉模型
+    PDF_OCR_MIN_CHARS = int(os.getenv("PDF_OCR_MIN_CHARS", 10))  # 文字少于该字数的页面视为扫描页
+    PDF_OCR_MAX_PAGES = int(os.getenv("PDF_OCR_MAX_PAGES", 200))  # 单个文档最多 OCR 的页数
+    PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", 150))  # 渲染分辨率
+    PDF_OCR_IMAGE_FORMAT = os.getenv("PDF_OCR_IMAGE_FORMAT", "jpeg")  # jpeg / webp
+    PDF_OCR_IMAGE_QUALITY = int(os.getenv("PDF_OCR_IMAGE_QUALITY", 80))
+    PDF_OCR_PAGES_PER_TASK = int(os.getenv("PDF_OCR_PAGES_PER_TASK", 4))  # 每个渲染任务的页数
+    PDF_OCR_BATCH_PAGES = int(os.getenv("PDF_OCR_BATCH_PAGES", 4))  # 每次调用视觉模型识别的页数
+    PDF_OCR_CONCURRENCY = int(os.getenv("PDF_OCR_CONCURRENCY", 4))  # 并发调用视觉模型数
+    PDF_OCR_CACHE_TTL = int(os.getenv("PDF_OCR_CACHE_TTL", 30 * 24 * 3600))  # 识别结果缓存时间（秒）
+
+    # ===== 文档块检索配置 =====
+    RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true"  # 关闭时所有文档块都放进提示词
+    RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 8))  # 每轮放进提示词的文档块数
+    RETRIEVAL_BM25_K1 = float(os.getenv("RETRIEVAL_BM25_K1", 1.5))
+    RETRIEVAL_BM25_B = float(os.getenv("RETRIEVAL_BM25_B", 0.75))
+    RETRIEVAL_LOCAL_INDEXES = int(os.getenv("RETRIEVAL_LOCAL_INDEXES", 32))  # 进程内保留的最近使用索引数
+    RETRIEVAL_CONTEXT_RATIO = float(os.getenv("RETRIEVAL_CONTEXT_RATIO", 0.5))  # 参考内容最多占模型输入预算的比例
+
+    # ===== 向量检索配置 =====
+    VECTOR_EMBEDDING_BACKEND = os.getenv("VECTOR_EMBEDDING_BACKEND", "")  # sentence-transformers:<模型>；hashing:<维度> 仅供测试
+    # 与 BM25 混合检索，默认只在配置了 sentence-transformers 模型时开启
+    VECTOR_ENABLED = os.getenv("VECTOR_ENABLED", str(VECTOR_EMBEDDING_BACKEND.startswith("sentence-transformers:"))).lower() == "true"
+    VECTOR_EMBED_BATCH = int(os.getenv("VECTOR_EMBED_BATCH", 64))  # 构建索引时每批向量化的文档块数
+    VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "data/vectors")  # 量化向量索引文件目录
+    VECTOR_CANDIDATES = int(os.getenv("VECTOR_CANDIDATES", 32))  # 每路检索的候选数（融合前）
+    VECTOR_MMR_ENABLED = os.getenv("VECTOR_MMR_ENABLED", "true").lower() == "true"  # MMR 多样性重排
+    VECTOR_MMR_DIVERSITY = float(os.getenv("VECTOR_MMR_DIVERSITY", 0.3))  # 多样性权重（0 为只看相关度）
+
+    # ===== 文档库配置 =====
+    DOCUMENT_STORAGE_DIR = os.getenv("DOCUMENT_STORAGE_DIR", "data/documents")  # 文档文件存储目录（按内容哈希命名）
+    DOCUMENT_WORKERS = int(os.getenv("DOCUMENT_WORKERS", 2))  # 每个进程的文档解析任务并发数，为 0 时不启动
+    DOCUMENT_STATUS_TTL = int(os.getenv("DOCUMENT_STATUS_TTL", 24 * 3600))  # Redis 中解析进度的保留时间（秒）
+    DOCUMENT_STALE_SECONDS = int(os.getenv("DOCUMENT_STALE_SECONDS", 600))  # 排队或解析中超过该时间未更新的文档，worker 启动时重新入队
+    DOCUMENT_MAX_PER_CHAT = int(os.getenv("DOCUMENT_MAX_PER_CHAT", 10))  # 单次对话最多引用的文档数
+
+    # ===== 图片预处理配置 =====
+    IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() == "true"  # 发送给模型前缩放、重新压缩
+    IMAGE_MAX_EDGE_BY_MODEL = json.loads(os.getenv("IMAGE_MAX_EDGE_BY_MODEL", json.dumps({
+        "qwen3-omni-flash": 1568,
+        "qwen-vl-plus": 2048,
+    })))  # 各模型的图片最长边上限（像素），超过的部分模型也会缩放，只增加传输和计费
+    IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", 1568))  # 未单独配置的模型使用的最长边上限
+    IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg")  # jpeg / webp
+    IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", 85))
+    IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", 24 * 3600))  # 预处理结果缓存时间（秒）
+    IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", 1000))
+    IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", 20 * 1024 * 1024))  # 单张图片大小上限
+
+    # ===== 媒体读取配置 =====
+    MEDIA_READ_CHUNK_BYTES = int(os.getenv("MEDIA_READ_CHUNK_BYTES", 1024 * 1024))  # 上传文件分块读取大小
+    MEDIA_OFFLOAD_BYTES = int(os.getenv("MEDIA_OFFLOAD_BYTES", 256 * 1024))  # 超过该大小的编码、解码、预处理放到线程中执行
+
+    # ===== 媒体存储配置 =====
+    MEDIA_STORE_DIR = os.getenv("MEDIA_STORE_DIR", "data/media")  # 图片、音频文件存储目录（按内容哈希命名）
+    MEDIA_STORE_MAX_BYTES = int(os.getenv("MEDIA_STORE_MAX_BYTES", 2 * 1024 * 1024 * 1024))  # 超过后按最近访问时间淘汰未被引用的文件
+    MEDIA_ENCODED_CACHE_BYTES = int(os.getenv("MEDIA_ENCODED_CACHE_BYTES", 64 * 1024 * 1024))  # 进程内 data URL 缓存大小
+    MEDIA_UPLOAD_TTL = int(os.getenv("MEDIA_UPLOAD_TTL", 24 * 3600))  # 上传后不被淘汰的最短时间（秒），无会话的历史引用在此期间有效
+
+    # ===== 音频处理配置 =====
+    AUDIO_MAX_UPLOAD_BYTES = int(os.getenv("AUDIO_MAX_UPLOAD_BYTES", 200 * 1024 * 1024))  # 上传大小上限
+    AUDIO_MAX_SECONDS = int(os.getenv("AUDIO_MAX_SECONDS", 3600))  # 最多处理的时长（秒），超出部分截断
+    AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", 16000))  # 重采样率（单声道）
+    AUDIO_SILENCE_THRESHOLD_DB = float(os.getenv("AUDIO_SILENCE_THRESHOLD_DB", -40))  # 音量低于该值（dBFS）视为静音
+    AUDIO_MIN_SILENCE_MS = int(os.getenv("AUDIO_MIN_SILENCE_MS", 500))  # 短于该时长的停顿不切分、不去除
+    AUDIO_PADDING_MS = int(os.getenv("AUDIO_PADDING_MS", 150))  # 语音区间两侧保留的静音
+    AUDIO_SEGMENT_MAX_SECONDS = float(os.getenv("AUDIO_SEGMENT_MAX_SECONDS", 60))  # 每个转写片段的最大时长
+    AUDIO_SEGMENT_FORMAT = os.getenv("AUDIO_SEGMENT_FORMAT", "mp3")  # mp3 / wav
+    AUDIO_SEGMENT_BITRATE = os.getenv("AUDIO_SEGMENT_BITRATE", "32k")  # mp3 码率
+    AUDIO_DIRECT_MAX_SECONDS = float(os.getenv("AUDIO_DIRECT_MAX_SECONDS", 60))  # 语音不超过该时长时直接交给对话模型
+    AUDIO_DIRECT_MAX_BYTES = int(os.getenv("AUDIO_DIRECT_MAX_BYTES", 10 * 1024 * 1024))  # 无法预处理时可直接发送的大小
+    AUDIO_TRANSCRIBE_MODEL = os.getenv("AUDIO_TRANSCRIBE_MODEL", "qwen3-omni-flash")  # 转写长音频片段的模型
+    AUDIO_CONCURRENCY = int(os.getenv("AUDIO_CONCURRENCY", 4))  # 并发转写的片段数
+    AUDIO_TRANSCRIPT_CACHE_TTL = int(os.getenv("AUDIO_TRANSCRIPT_CACHE_TTL", 30 * 24 * 3600))  # 转写结果缓存时间（秒）
+
 # 实例化配置
-settings = Config()
\ No newline at end of file
+settings = Config()
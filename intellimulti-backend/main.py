@@ -1,19 +1,44 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from common import constant
+from common.metrics import metrics
 from common.redis_client import redis_client
-from schema.schemas import MessageRequest, MessageResponse
+from schema.schemas import MessageRequest, MessageResponse, SessionCreateRequest, SessionTurnsRequest, \
+    SessionResponse, DocumentResponse, MediaResponse
 from schema.tool_schemas import WeatherInfo
-from services.chat_service import handle_chat_stream, handle_chat_sync, get_current_weather
+from services.chat_service import handle_chat_stream, handle_chat_sync, get_current_weather, handle_session_stream
+from services.session_service import SessionService
+from services.document_service import DocumentService, document_workers
+from services.media_service import MediaStore
+from services.model_service import model_registry
+from services.router_service import chat_router
+from utils.pdf_utils import PDFProcessor, PDFUpload
 from config.settings import app_settings, cors_settings
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动：初始化模型注册表，预先建立到模型服务商的长连接
+    await model_registry.startup()
+    # 启动文档库解析 worker（MySQL 不可用时只记录错误，不影响其他接口）
+    document_workers.start()
+    yield
+    # 关闭：停止解析 worker，释放模型连接池和PDF提取进程池
+    await document_workers.stop()
+    await model_registry.shutdown()
+    PDFProcessor.shutdown_pool()
+
+
 # 初始化 FastAPI 应用
 app = FastAPI(
     title=app_settings.APP_TITLE,
     description=app_settings.APP_DESCRIPTION,
-    version=app_settings.APP_VERSION
+    version=app_settings.APP_VERSION,
+    lifespan=lifespan
 )
 
 # 配置跨域中间件
@@ -28,18 +53,56 @@ app.add_middleware(
 # 注册路由
 @app.post("/api/chat/stream", summary="流式聊天接口")
 async def chat_stream(
+        request: Request,
         image_file: UploadFile | None = File(None),
         content_blocks: str = Form(default="[]"),
         history: str = Form(default="[]"),
         audio_file: UploadFile | None = File(None),
-        pdf_file: UploadFile | None = File(None)
+        pdf_file: UploadFile | None = File(None),
+        document_ids: str = Form(default="[]")
 ):
-    return await handle_chat_stream(image_file, content_blocks, history, audio_file, pdf_file)
+    return await handle_chat_stream(image_file, content_blocks, history, audio_file, pdf_file, request, document_ids)
 
 @app.post("/api/chat", summary="同步聊天接口", response_model=MessageResponse)
 async def chat_sync_api(request: MessageRequest):
     return await handle_chat_sync(request)
 
+@app.post("/api/sessions", summary="创建会话", response_model=SessionResponse)
+async def create_session(request: SessionCreateRequest):
+    return SessionResponse(session_id=SessionService.create_session(request.system_prompt))
+
+@app.post("/api/sessions/{session_id}/turns", summary="追加会话记录", response_model=SessionResponse)
+async def append_session_turns(session_id: str, request: SessionTurnsRequest):
+    count = SessionService.append_turns(session_id, request.history)
+    return SessionResponse(session_id=session_id, message_count=count)
+
+@app.post("/api/sessions/{session_id}/stream", summary="会话流式聊天接口")
+async def session_stream(
+        session_id: str,
+        request: Request,
+        image_file: UploadFile | None = File(None),
+        content_blocks: str = Form(default="[]"),
+        audio_file: UploadFile | None = File(None),
+        pdf_file: UploadFile | None = File(None)
+):
+    return await handle_session_stream(session_id, image_file, content_blocks, audio_file, pdf_file, request)
+
+@app.delete("/api/sessions/{session_id}", summary="删除会话")
+async def delete_session(session_id: str):
+    return {"deleted": SessionService.delete_session(session_id)}
+
+@app.post("/api/documents", summary="上传文档到文档库（后台解析）", response_model=DocumentResponse)
+async def upload_document(pdf_file: UploadFile = File(...)):
+    return await DocumentService.create_document(await PDFUpload.from_upload(pdf_file))
+
+@app.get("/api/documents/{document_id}", summary="查询文档解析状态", response_model=DocumentResponse)
+async def get_document(document_id: str):
+    return await DocumentService.get_document(document_id)
+
+@app.post("/api/media", summary="上传图片或音频，返回可在内容块中引用的媒体 ID", response_model=MediaResponse)
+async def upload_media(file: UploadFile = File(...)):
+    return await MediaStore.save_upload(file)
+
 @app.post('/api/get_weather', summary='获取当前天气信息', response_model=WeatherInfo)
 async def get_weather() -> WeatherInfo:
     weatherInfo = redis_client.get_object(constant.WEATHER_CATCH)
@@ -47,6 +110,10 @@ async def get_weather() -> WeatherInfo:
         return weatherInfo
     return await get_current_weather()
 
+@app.get('/api/metrics', summary='服务运行指标')
+async def get_metrics():
+    return {**metrics.snapshot(), "router": chat_router.snapshot()}
+
 # 启动服务
 if __name__ == "__main__":
     uvicorn.run(
@@ -17,3 +17,35 @@ class MessageResponse(BaseModel):
     timestamp: str
     role: str
     references: List[Dict[str, Any]] = [] # PDF的引用
+    cached: bool = False # 是否来自响应缓存
+
+
+class SessionCreateRequest(BaseModel):
+    system_prompt: Optional[str] = Field(default=None, description="自定义系统提示词，不传则使用默认提示词")
+
+
+class SessionTurnsRequest(BaseModel):
+    history: List[Dict[str, Any]] = Field(default=[], description="追加的对话记录，格式与 history 相同")
+
+
+class SessionResponse(BaseModel):
+    session_id: str
+    message_count: int = 0
+
+
+class DocumentResponse(BaseModel):
+    document_id: str
+    filename: str
+    size: int
+    status: str = Field(description="解析状态: queued, processing, ready, failed")
+    total_pages: Optional[int] = None
+    total_chunks: Optional[int] = None
+    error: Optional[str] = None
+    progress: Optional[Dict[str, Any]] = Field(default=None, description="解析中的实时进度（pdf_progress 事件）")
+
+
+class MediaResponse(BaseModel):
+    media_id: str = Field(description="媒体 ID（内容的 SHA-256）")
+    url: str = Field(description="在内容块和历史记录中引用该媒体的地址，格式 media://<媒体 ID>")
+    mime_type: str
+    size: int
@@ -0,0 +1,316 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, List, Set, Tuple
+
+import anyio
+from fastapi import HTTPException
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+
+logger = logging.getLogger("admission_service")
+logger.setLevel(logging.INFO)
+
+# 本进程在跨进程并发计数中的标识
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# 跨进程放行检查（一次往返）：刷新本进程心跳，清理心跳超时的 worker，
+# 统计存活 worker 的并发数之和，再检查当前分钟的请求数，都未超限时占用名额
+# KEYS: 并发数哈希、心跳有序集合、RPM 计数器；ARGV: worker 标识、当前时间、心跳超时、并发上限、RPM 上限
+_ADMIT_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[3]))
+local counts = redis.call('HGETALL', KEYS[1])
+local active = 0
+for i = 1, #counts, 2 do
+    if redis.call('ZSCORE', KEYS[2], counts[i]) then
+        -- 被误判超时的 worker 恢复后归还名额可能使自身计数为负，按 0 计
+        active = active + math.max(0, tonumber(counts[i + 1]))
+    else
+        redis.call('HDEL', KEYS[1], counts[i])
+    end
+end
+if active >= tonumber(ARGV[4]) then
+    return 0
+end
+local count = redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], 120)
+if count > tonumber(ARGV[5]) then
+    redis.call('DECR', KEYS[3])
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+return 1
+"""
+
+
+class Priority(IntEnum):
+    """排队优先级（数值越小越优先）"""
+    INTERACTIVE = 0  # 用户交互的流式/同步对话
+    BATCH = 1  # 天气、历史摘要等后台任务
+
+
+class AdmissionRejected(HTTPException):
+    """排队已满或等待超时，直接返回 429 并提示重试时间"""
+
+    def __init__(self, provider: str, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail=f"模型服务繁忙（{provider}），请 {retry_after} 秒后重试",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class _ProviderGate:
+    """单个服务商的并发、每分钟请求数限制与等待队列"""
+
+    def __init__(self, provider: str, limits: Dict[str, int]):
+        self.provider = provider
+        self.max_concurrency = limits.get("concurrency", settings.ADMISSION_DEFAULT_CONCURRENCY)
+        self.rpm = limits.get("rpm", settings.ADMISSION_DEFAULT_RPM)
+        self.max_queue = limits.get("queue", settings.ADMISSION_DEFAULT_QUEUE)
+        self.active = 0
+        self.started: deque = deque()  # 最近一分钟内的放行时间
+        self.queue: List[Tuple[int, int, asyncio.Future]] = []
+        self.retry_timer: asyncio.TimerHandle | None = None
+        self.heartbeat_timer: asyncio.TimerHandle | None = None
+        self.dispatcher: asyncio.Task | None = None  # 正在放行排队请求的任务（同时只有一个）
+
+
+class AdmissionController:
+    """
+    上游模型调用的准入控制
+    - 每个服务商独立的并发上限和每分钟请求数（RPM）上限
+    - 超出上限的请求进入有界优先队列，交互式请求优先于批处理任务
+    - 队列已满或等待超时时快速拒绝（429 + Retry-After）
+    - 可选通过 Redis 在多个 worker 之间共享并发数和 RPM 计数（此时配置的上限为全局上限）；
+      并发数按 worker 分别计数并定期心跳，异常退出的 worker 心跳超时后其计数不再计入；
+      Redis 调用都在线程中执行（放行检查为一个 Lua 脚本），不阻塞事件循环，此时所有请求都经过队列由放行任务处理
+    """
+
+    def __init__(self):
+        self._gates: Dict[str, _ProviderGate] = {}
+        self._seq = itertools.count()
+        # 不等待结果的 Redis 调用（保留引用，避免任务被回收）
+        self._background: Set[asyncio.Future] = set()
+
+    def _gate(self, provider: str) -> _ProviderGate:
+        gate = self._gates.get(provider)
+        if gate is None:
+            gate = _ProviderGate(provider, settings.ADMISSION_LIMITS.get(provider, {}))
+            self._gates[provider] = gate
+        return gate
+
+    def check(self, provider: str):
+        """快速检查：队列已满时直接拒绝，在返回流式响应之前调用"""
+        gate = self._gate(provider)
+        if self._queue_full(gate):
+            metrics.incr("admission_rejected_total", provider=provider, reason="queue_full")
+            raise AdmissionRejected(provider, self._retry_after(gate))
+
+    @asynccontextmanager
+    async def slot(self, provider: str, priority: Priority = Priority.INTERACTIVE):
+        """获取一个调用名额，退出时归还"""
+        await self.acquire(provider, priority)
+        admitted = time.monotonic()
+        try:
+            yield
+        finally:
+            metrics.observe("admission_hold_seconds", time.monotonic() - admitted, provider=provider)
+            self.release(provider)
+
+    async def guarded_stream(self, provider: str, factory: Callable[[], AsyncIterator[str]],
+                             priority: Priority = Priority.INTERACTIVE) -> AsyncGenerator[str, None]:
+        """获取名额后再创建上游流，流结束、出错或被取消时归还名额"""
+        async with self.slot(provider, priority):
+            stream = factory()
+            try:
+                async for item in stream:
+                    yield item
+            finally:
+                with anyio.CancelScope(shield=True):
+                    await stream.aclose()
+
+    async def acquire(self, provider: str, priority: Priority = Priority.INTERACTIVE):
+        gate = self._gate(provider)
+        start = time.monotonic()
+        if not settings.ADMISSION_REDIS and not gate.queue and self._reserve(gate):
+            self._record_wait(gate, priority, start)
+            return
+
+        if self._queue_full(gate):
+            metrics.incr("admission_rejected_total", provider=provider, reason="queue_full")
+            raise AdmissionRejected(provider, self._retry_after(gate))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (int(priority), next(self._seq), future)
+        heapq.heappush(gate.queue, entry)
+        metrics.gauge("admission_queued", 1, provider=provider)
+        self._kick(gate)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=settings.ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._abandon(gate, entry)
+            metrics.incr("admission_rejected_total", provider=provider, reason="timeout")
+            raise AdmissionRejected(provider, self._retry_after(gate))
+        except asyncio.CancelledError:
+            self._abandon(gate, entry)
+            raise
+        self._record_wait(gate, priority, start)
+
+    def release(self, provider: str):
+        gate = self._gate(provider)
+        gate.active -= 1
+        metrics.gauge("admission_active", -1, provider=provider)
+        if settings.ADMISSION_REDIS:
+            self._spawn(redis_client.hincrby, constant.ADMISSION_ACTIVE.format(provider), _WORKER_ID, -1)
+        if gate.queue:
+            self._kick(gate)
+
+    def _spawn(self, func: Callable, *args):
+        """在线程中执行 Redis 调用，不等待结果（同步的 release 和定时器回调中使用）"""
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        self._background.add(future)
+        future.add_done_callback(self._background.discard)
+
+    def _abandon(self, gate: _ProviderGate, entry: Tuple[int, int, asyncio.Future]):
+        """等待方离开：若已分到名额则归还，否则从队列移除"""
+        future = entry[2]
+        if future.done() and not future.cancelled():
+            self.release(gate.provider)
+            return
+        future.cancel()
+        if entry in gate.queue:
+            gate.queue.remove(entry)
+            heapq.heapify(gate.queue)
+            metrics.gauge("admission_queued", -1, provider=gate.provider)
+
+    def _kick(self, gate: _ProviderGate):
+        """启动放行任务（已在运行时由它继续处理队列）"""
+        if gate.dispatcher is None or gate.dispatcher.done():
+            gate.dispatcher = asyncio.ensure_future(self._dispatch(gate))
+
+    async def _dispatch(self, gate: _ProviderGate):
+        """按优先级放行排队的请求"""
+        while gate.queue:
+            if gate.queue[0][2].done():
+                heapq.heappop(gate.queue)
+                metrics.gauge("admission_queued", -1, provider=gate.provider)
+                continue
+            if not await self._try_admit(gate):
+                self._schedule_retry(gate)
+                return
+            # 等待 Redis 期间队首可能已经离开（超时、取消）或被优先级更高的请求取代，放行此时的队首
+            while gate.queue and gate.queue[0][2].done():
+                heapq.heappop(gate.queue)
+                metrics.gauge("admission_queued", -1, provider=gate.provider)
+            if not gate.queue:
+                self.release(gate.provider)
+                return
+            _, _, future = heapq.heappop(gate.queue)
+            metrics.gauge("admission_queued", -1, provider=gate.provider)
+            future.set_result(True)
+
+    def _schedule_retry(self, gate: _ProviderGate):
+        """因 RPM 或跨进程限制而无法放行时，定时重新尝试（并发名额释放时也会触发放行）"""
+        if gate.retry_timer is None or gate.retry_timer.cancelled():
+            def retry():
+                gate.retry_timer = None
+                self._kick(gate)
+
+            gate.retry_timer = asyncio.get_running_loop().call_later(settings.ADMISSION_RETRY_INTERVAL, retry)
+
+    def _reserve(self, gate: _ProviderGate) -> bool:
+        """检查本进程的并发数和 RPM 限制并占用名额"""
+        now = time.monotonic()
+        while gate.started and now - gate.started[0] >= 60:
+            gate.started.popleft()
+        if gate.active >= gate.max_concurrency or len(gate.started) >= gate.rpm:
+            return False
+        gate.active += 1
+        gate.started.append(now)
+        metrics.gauge("admission_active", 1, provider=gate.provider)
+        return True
+
+    async def _try_admit(self, gate: _ProviderGate) -> bool:
+        """
+        检查并占用名额
+        先占用本进程的名额再到 Redis 检查全局限制，等待 Redis 期间本进程的其他请求看到的是已占用后的计数
+        """
+        if not self._reserve(gate):
+            return False
+        if settings.ADMISSION_REDIS:
+            if not await asyncio.to_thread(self._try_admit_redis, gate):
+                gate.active -= 1
+                gate.started.pop()
+                metrics.gauge("admission_active", -1, provider=gate.provider)
+                return False
+            self._schedule_heartbeat(gate)
+        return True
+
+    def _schedule_heartbeat(self, gate: _ProviderGate):
+        """本进程持有名额期间定期刷新心跳，调用时间长的流式请求不会被当作已退出的 worker"""
+        if gate.heartbeat_timer is not None:
+            return
+
+        def beat():
+            gate.heartbeat_timer = None
+            if gate.active > 0:
+                self._spawn(redis_client.zadd, constant.ADMISSION_HEARTBEAT.format(gate.provider),
+                            {_WORKER_ID: time.time()})
+                self._schedule_heartbeat(gate)
+
+        gate.heartbeat_timer = asyncio.get_running_loop().call_later(settings.ADMISSION_REDIS_TTL / 3, beat)
+
+    @staticmethod
+    def _try_admit_redis(gate: _ProviderGate) -> bool:
+        """
+        通过 Redis 检查全局并发数和当前分钟的请求数（一个 Lua 脚本，在线程中调用）
+        Redis 不可用时只按本进程限制
+        """
+        now = time.time()
+        result = redis_client.eval_script(
+            _ADMIT_SCRIPT,
+            keys=[constant.ADMISSION_ACTIVE.format(gate.provider), constant.ADMISSION_HEARTBEAT.format(gate.provider),
+                  constant.ADMISSION_RPM.format(gate.provider, int(now // 60))],
+            args=[_WORKER_ID, now, settings.ADMISSION_REDIS_TTL, gate.max_concurrency, gate.rpm],
+        )
+        return result is None or bool(result)
+
+    @staticmethod
+    def _queue_full(gate: _ProviderGate) -> bool:
+        """排队数是否达到上限（启用 Redis 时所有请求都经过队列，本进程空闲名额对应的请求不计入）"""
+        return len(gate.queue) >= gate.max_queue + max(0, gate.max_concurrency - gate.active)
+
+    @staticmethod
+    def _retry_after(gate: _ProviderGate) -> int:
+        """估算重试等待时间：RPM 受限时等到窗口释放，否则按平均调用时长和队列长度估算"""
+        if gate.started and len(gate.started) >= gate.rpm:
+            return max(1, math.ceil(60 - (time.monotonic() - gate.started[0])))
+        avg_hold = metrics.percentile("admission_hold_seconds", 50, default=settings.ADMISSION_RETRY_AFTER,
+                                      provider=gate.provider)
+        return max(1, math.ceil(avg_hold * (len(gate.queue) + 1) / max(1, gate.max_concurrency)))
+
+    @staticmethod
+    def _record_wait(gate: _ProviderGate, priority: Priority, start: float):
+        metrics.observe("admission_queue_seconds", time.monotonic() - start,
+                        provider=gate.provider, priority=priority.name.lower())
+
+
+# 单例实例（全局唯一）
+admission = AdmissionController()
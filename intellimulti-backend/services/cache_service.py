@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+import zlib
+from typing import AsyncGenerator, List, Dict, Any, Optional, Tuple
+
+from langchain_core.messages import BaseMessage
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+from services.message_service import hash_messages
+from services.ocr_service import PageOCR
+from utils.pdf_utils import PDFProcessor, PDFUpload, ChunkSink
+
+
+class ResponseCache:
+    """
+    聊天响应精确匹配缓存（基于 RedisClient）
+    键为完整消息列表（系统提示词 + 历史 + 当前消息）的规范化哈希，媒体按内容哈希
+    通过 RESPONSE_CACHE_ENABLED 开启，默认关闭
+    """
+
+    @staticmethod
+    def build_key(messages: List[BaseMessage], model_name: str) -> Optional[str]:
+        """计算缓存键，未开启缓存时返回 None"""
+        if not settings.RESPONSE_CACHE_ENABLED:
+            return None
+        return hash_messages(messages, model_name)
+
+    @staticmethod
+    def get(cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+        """读取缓存的回答：{"content": str}"""
+        if not cache_key:
+            return None
+        cached = redis_client.cache_get(constant.RESPONSE_CACHE, cache_key, ex=settings.RESPONSE_CACHE_TTL)
+        metrics.incr("response_cache_total", result="hit" if cached else "miss")
+        return cached if isinstance(cached, dict) and cached.get("content") else None
+
+    @staticmethod
+    def save(cache_key: Optional[str], content: str) -> bool:
+        """写入回答，过长的回答不缓存"""
+        if not cache_key or not content or len(content) > settings.RESPONSE_CACHE_MAX_CHARS:
+            return False
+        return redis_client.cache_set(
+            constant.RESPONSE_CACHE,
+            cache_key,
+            {"content": content},
+            ex=settings.RESPONSE_CACHE_TTL,
+            max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+        )
+
+    @staticmethod
+    async def replay(content: str) -> AsyncGenerator[str, None]:
+        """将缓存的回答切分成增量回放，前端按正常流式输出渲染"""
+        step = max(1, settings.RESPONSE_CACHE_REPLAY_CHARS)
+        for start in range(0, len(content), step):
+            yield content[start:start + step]
+
+
+class PDFChunkCache:
+    """
+    PDF 文档块缓存（基于 RedisClient）
+    键为文件内容 SHA-256 + 分块参数的哈希，同一文件重复上传时只需读取上传时计算的哈希
+    每个条目是一个列表：第一个元素为统计信息（页数、文档块数），其后每个元素是解析时一段页面产出的文档块，
+    都以压缩后的 JSON 原样存储（不经过序列化器）；解析过程中逐段写入暂存列表，完成后整体提交，不在内存中攒齐全部文档块
+    文件名相关字段不入缓存，读取时按本次上传的文件名还原
+    """
+
+    # 与文件名相关、读取时重新生成的元数据字段
+    _FILENAME_FIELDS = ("source", "source_info")
+
+    @staticmethod
+    def document_hash(upload: PDFUpload) -> str:
+        """计算文档哈希（文件内容哈希 + 分块参数），同时作为文档块缓存和检索索引的键"""
+        params = json.dumps(PDFProcessor.splitter_params(), sort_keys=True)
+        return hashlib.sha256(f"{upload.sha256}:{params}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _load(cache_key: Optional[str]) -> Optional[Tuple[Dict[str, Any], List[bytes]]]:
+        """读取缓存条目：(统计信息, 各段压缩后的文档块)"""
+        if not cache_key or not settings.PDF_CACHE_ENABLED:
+            return None
+        cached = redis_client.cache_get_list_bytes(constant.PDF_CHUNK_CACHE, cache_key, ex=settings.PDF_CACHE_TTL)
+        metrics.incr("pdf_cache_total", result="hit" if cached else "miss")
+        if not cached:
+            return None
+        try:
+            return json.loads(zlib.decompress(cached[0])), cached[1:]
+        except (zlib.error, ValueError):
+            return None
+
+    @staticmethod
+    def _restore(batch: bytes, filename: str, total_chunks: int) -> List[Dict[str, Any]]:
+        """解压一段文档块，按 filename 还原文件名相关字段"""
+        chunks = json.loads(zlib.decompress(batch))
+        for chunk in chunks:
+            metadata = chunk["metadata"]
+            chunk["id"] = f"{filename}_{metadata['chunk_id']}"
+            metadata["source"] = filename
+            metadata["source_info"] = PDFProcessor.source_info(filename, metadata)
+            metadata["total_chunks"] = total_chunks
+        return chunks
+
+    @staticmethod
+    def _encode(chunks: List[Dict[str, Any]]) -> bytes:
+        stored = [{
+            "content": chunk["content"],
+            "metadata": {k: v for k, v in chunk["metadata"].items() if k not in PDFChunkCache._FILENAME_FIELDS},
+        } for chunk in chunks]
+        return zlib.compress(json.dumps(stored, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+    @staticmethod
+    def get(cache_key: Optional[str], filename: str) -> Optional[Dict[str, Any]]:
+        """读取缓存的解析结果：{"total_pages": int, "chunks": [...]}，文档块按 filename 还原"""
+        loaded = PDFChunkCache._load(cache_key)
+        if loaded is None:
+            return None
+        head, batches = loaded
+        try:
+            chunks = [chunk for batch in batches
+                      for chunk in PDFChunkCache._restore(batch, filename, head["total_chunks"])]
+        except (zlib.error, ValueError):
+            return None
+        if len(chunks) != head["total_chunks"]:
+            return None
+        return {"total_pages": head["total_pages"], "chunks": chunks}
+
+    @staticmethod
+    async def process_stream(upload: PDFUpload,
+                             on_chunks: Optional[ChunkSink] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        带缓存的 PDF 流式处理，事件格式同 PDFProcessor.process_pdf_stream
+        文档块逐段交给 on_chunks（命中缓存时按缓存的分段依次交给它），未命中时同时逐段写入缓存
+        pdf_ready 事件增加 document_hash（文档哈希）和 from_cache（文档块是否来自缓存）字段
+        """
+        started = time.monotonic()
+        filename = upload.filename
+        # 文件内容哈希在读取上传时已增量计算，这里只需组合分块参数
+        cache_key = PDFChunkCache.document_hash(upload)
+        cached = await asyncio.to_thread(PDFChunkCache._load, cache_key)
+        if cached:
+            head, batches = cached
+            if on_chunks is not None:
+                for batch in batches:
+                    await on_chunks(PDFChunkCache._restore(batch, filename, head["total_chunks"]))
+            yield {
+                "type": "pdf_ready",
+                "filename": filename,
+                "total_pages": head["total_pages"],
+                "total_chunks": head["total_chunks"],
+                "elapsed": round(time.monotonic() - started, 3),
+                "document_hash": cache_key,
+                "from_cache": True,
+            }
+            return
+
+        staging = constant.PDF_CHUNK_STAGING.format(cache_key, uuid.uuid4().hex) if settings.PDF_CACHE_ENABLED else None
+        staged = True  # 所有分段都已写入暂存列表（有写入失败时不提交，避免缓存不完整的条目）
+
+        async def sink(chunks: List[Dict[str, Any]]):
+            nonlocal staged
+            if staging is not None and staged:
+                staged = await asyncio.to_thread(redis_client.cache_stage_bytes, staging,
+                                                 PDFChunkCache._encode(chunks), settings.PDF_CACHE_TTL)
+            if on_chunks is not None:
+                await on_chunks(chunks)
+
+        try:
+            # 扫描页交给视觉模型识别
+            async for event in PDFProcessor(ocr_handler=PageOCR.transcribe).process_pdf_stream(upload, on_chunks=sink):
+                if event["type"] == "pdf_ready":
+                    if staging is not None and staged:
+                        head = json.dumps({"total_pages": event["total_pages"], "total_chunks": event["total_chunks"]})
+                        await asyncio.to_thread(
+                            redis_client.cache_commit_list, constant.PDF_CHUNK_CACHE, cache_key, staging,
+                            zlib.compress(head.encode("utf-8")), settings.PDF_CACHE_TTL, settings.PDF_CACHE_MAX_ENTRIES)
+                        staging = None
+                    event["document_hash"] = cache_key
+                    event["from_cache"] = False
+                yield event
+        finally:
+            # 解析失败或被取消时删除暂存列表
+            if staging is not None:
+                redis_client.delete(staging)
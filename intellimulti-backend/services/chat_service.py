@@ -1,28 +1,55 @@
 import asyncio
 import json
+import logging
 from datetime import datetime
-from typing import AsyncGenerator, List, Dict, Any
-from fastapi import HTTPException, UploadFile, File, Form
+from typing import AsyncGenerator, Callable, List, Dict, Any, Tuple
+
+import anyio
+from fastapi import HTTPException, UploadFile, File, Form, Request
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from langchain.agents import create_agent
 from langchain.agents.structured_output import ToolStrategy, ProviderStrategy
 from langchain_core.messages import BaseMessage, AIMessage
 
 from common import constant
+from common.metrics import metrics
 from common.redis_client import redis_client
+from config.settings import settings
 from schema.schemas import MessageRequest, MessageResponse
 from schema.tool_schemas import WeatherInfo
 from services.message_service import convert_history_to_messages, create_multimodal_message, \
-    extract_references_from_content
-from services.model_service import get_chat_model, build_deepseek_model, build_dashscope_model
+    CitationTracker, attach_pdf_context, attach_audio, hash_messages, message_text
+from services.admission_service import admission, Priority
+from services.cache_service import ResponseCache, PDFChunkCache
+from services.document_service import DocumentService
+from services.history_service import HistoryCompactor
+from services.media_service import MediaStore
+from services.retrieval_service import ChunkRetriever
+from services.session_service import SessionService
+from services.singleflight_service import singleflight
+from services.transcription_service import AudioTranscriber
+from services.model_service import build_deepseek_model, CHAT_MODEL, CHAT_PROVIDER
+from services.router_service import chat_router
 from utils.mcp_tools import get_weather_by_ip, get_weather_by_city
-from utils.pdf_utils import PDFProcessor
+from utils.audio_utils import AudioUpload
+from utils.pdf_utils import PDFUpload, ChunkCollector
+from utils.sse_utils import SSEEncoder, DisconnectMonitor, ClientDisconnected
+
+logger = logging.getLogger("chat_service")
+logger.setLevel(logging.INFO)
 
 
 async def generate_streaming_response(
         messages: List[BaseMessage],
-        pdf_chunks: List[Dict[str, Any]] = None
-) -> AsyncGenerator[str, None]:
+        pdf_chunks: List[Dict[str, Any]] = None,
+        encoder: SSEEncoder = None,
+        request: Request = None,
+        on_complete: Callable[[str], Any] = None,
+        pdf_upload: PDFUpload = None,
+        documents: List[Tuple[str, List[Dict[str, Any]]]] = None,
+        audio_upload: AudioUpload = None
+) -> AsyncGenerator[bytes, None]:
     """
         生成流式响应
         采用 SSE（text/event-stream），可以理解成：可流式传输的HTTP
@@ -31,63 +58,163 @@ async def generate_streaming_response(
             - 单向通信（服务端发送给客户端）
             - 自动重连
         数据格式为 data: {JSON字符串}\n\n，客户端会按 \n\n 分割，逐行解析 data
+        相邻的增量由 SSEEncoder 按刷新策略合并成一帧，可选压缩
+        客户端断开连接时立即取消上游模型生成，并记录已产出的输出块数
+        开启响应缓存时先查缓存，命中则按增量回放缓存的回答
+        on_complete 在回答完整生成后以完整回答调用（如写入会话历史）
+        传入 pdf_upload 时先在流中解析 PDF，推送 pdf_progress / pdf_ready 事件，
+        再把文档块附加到当前消息并开始生成
+        documents 为文档库中已解析的文档 [(文档哈希, 文档块列表)]，与上传的 PDF 一起参与检索
+        传入 audio_upload 时先在流中处理音频：短音频压缩后附加到当前消息，
+        长音频分段并发转写，按顺序推送 audio_transcript 事件，转写文本附加到当前消息
     """
+    encoder = encoder or SSEEncoder()
+    # 已产出的上游输出块数（不等于 token 数）
+    chunk_count = 0
+    finished = False
+    text_stream = None
+    deltas = None
+    metrics.gauge("chat_stream_inflight", 1)
     try:
-        model = await get_chat_model()
-        # 创建流式响应
-        full_response = ""
-
-        chunk_count = 0
-        # model.astream内部也是利用yield异步生成器，async for 会逐次获取模型的输出块
-        async for chunk in model.astream(messages):
-            chunk_count += 1
-            if hasattr(chunk, 'content') and chunk.content:
-                content = chunk.content
-                full_response += content
-
-                # 把当前块包装成 SSE 格式，通过 yield 推送给前端
-                data = {
-                    "type": "content_delta",
-                    "content": content,
-                    "timestamp": datetime.now().isoformat()
-                }
-                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
-
-        # 提取引用信息
-        references = extract_references_from_content(full_response, pdf_chunks) if pdf_chunks else []
+        if audio_upload is not None:
+            audio = {}
+            try:
+                async for event in AudioTranscriber.process_stream(audio_upload):
+                    if event["type"] == "audio_ready":
+                        # 压缩后的音频只交给模型，不推送给前端
+                        audio = {"data_url": event.pop("data_url", None), "transcript": event.get("transcript")}
+                    yield encoder.event(event)
+            finally:
+                audio_upload.close()
+            messages = [*messages[:-1], attach_audio(messages[-1], **audio)]
+
+        documents = list(documents or [])
+        if pdf_upload is not None:
+            # 相同文件重复上传时直接使用缓存的文档块；文档块逐段收集，参与本轮检索
+            collector = ChunkCollector()
+            try:
+                async for event in PDFChunkCache.process_stream(pdf_upload, on_chunks=collector):
+                    if event["type"] == "pdf_ready":
+                        documents.append((event["document_hash"], collector.finish()))
+                    yield encoder.event(event)
+            finally:
+                # 解析完成后立即释放上传内容（删除临时文件），不占用到生成结束
+                pdf_upload.close()
+        if documents:
+            # 只把与当前问题最相关的文档块放进提示词，引用编号为文档块在所有文档中的序号
+            pdf_chunks, indices = await ChunkRetriever.select_many(
+                documents, message_text(messages[-1], placeholders=False))
+            # 按模型输入预算的一定比例打包参考内容，合并相邻块，引用编号映射交给追踪器
+            token_budget = int(HistoryCompactor.get_budget(CHAT_MODEL) * settings.RETRIEVAL_CONTEXT_RATIO)
+            current_message, pdf_chunks = attach_pdf_context(messages[-1], pdf_chunks, indices, token_budget)
+            messages = [*messages[:-1], current_message]
+
+        # 增量追踪引用，完整回答在追踪器中以列表缓存，结束时只拼接一次
+        tracker = CitationTracker(pdf_chunks)
+        # 响应缓存键（未开启缓存时为 None），包含 PDF 参考内容
+        cache_key = ResponseCache.build_key(messages, CHAT_MODEL)
+        cached = ResponseCache.get(cache_key)
+        # 按模型 token 预算压缩历史（命中缓存时不调用模型，无需压缩）
+        token_stats = None
+        if not cached:
+            # 相同请求合并的键基于压缩前的完整消息
+            flight_key = (cache_key or hash_messages(messages, CHAT_MODEL)) if settings.SINGLEFLIGHT_ENABLED else None
+            messages, token_stats = await HistoryCompactor.compact(messages, CHAT_MODEL)
+            # 压缩后才展开媒体引用，被摘要掉的历史图片、音频不再读取和编码
+            messages = await MediaStore.materialize(messages, CHAT_MODEL)
+        async with DisconnectMonitor(request) as monitor:
+            if cached:
+                text_stream = ResponseCache.replay(cached["content"])
+            else:
+                # 正在生成的相同请求直接订阅其增量，否则由本请求驱动上游生成
+                # 路由器负责选择端点、对冲和降级，每次上游调用都经过准入控制，合并的跟随者不占用名额
+                text_stream = singleflight.stream(flight_key, lambda: chat_router.stream(messages))
+            deltas = encoder.paced(monitor.guard(text_stream))
+            async for content in deltas:
+                if content is None:
+                    # 上游停顿，刷新窗口已到期：发送缓冲中的增量
+                    yield encoder.flush()
+                    continue
+                chunk_count += 1
+                new_references = tracker.feed(content)
+
+                # 把当前块交给编码器，满足刷新条件时推送给前端
+                frame = encoder.delta(content)
+                if frame:
+                    yield frame
+                # 引用第一次出现时立即推送，不必等到回答结束
+                for reference in new_references:
+                    yield encoder.event({
+                        "type": "reference",
+                        "reference": reference
+                    })
 
         # 发送完成信号
-        final_data = {
+        finished = True
+        full_content = tracker.full_text()
+        if not cached:
+            ResponseCache.save(cache_key, full_content)
+        if on_complete:
+            on_complete(full_content)
+        yield encoder.event({
             "type": "message_complete",
-            "full_content": full_response,
-            "timestamp": datetime.now().isoformat(),
-            "references": references
-        }
-        yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
+            "full_content": full_content,
+            "references": tracker.references,
+            "cached": bool(cached),
+            "input_tokens": token_stats
+        })
+    except ClientDisconnected:
+        pass
     except Exception as e:
-        error_data = {
+        finished = True
+        yield encoder.event({
             "type": "error",
-            "error": str(e),
-            "timestamp": datetime.now().isoformat()
-        }
-        yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+            "error": str(e)
+        })
+    finally:
+        # 无论正常结束、客户端断连还是被 Starlette 取消，都关闭上游流
+        if text_stream is not None:
+            with anyio.CancelScope(shield=True):
+                if deltas is not None:
+                    await deltas.aclose()
+                await text_stream.aclose()
+        metrics.gauge("chat_stream_inflight", -1)
+        if not finished:
+            metrics.incr("chat_stream_aborted_total")
+            metrics.observe("chat_stream_aborted_chunks", chunk_count)
+            logger.info(f"客户端已断开，取消模型生成，已产出 {chunk_count} 个输出块")
+    yield encoder.close()
 
 
 async def handle_chat_sync(request: MessageRequest) -> MessageResponse:
     """处理同步聊天请求"""
     try:
-        messages = convert_history_to_messages(request.history)
-        current_message = create_multimodal_message(request, None, None)
+        messages = await convert_history_to_messages(request.history)
+        current_message = await create_multimodal_message(request, None)
         messages.append(current_message)
 
-        model = await get_chat_model()
-        response = await model.ainvoke(messages)
+        cache_key = ResponseCache.build_key(messages, CHAT_MODEL)
+        cached = ResponseCache.get(cache_key)
+        if cached:
+            return MessageResponse(
+                content=cached["content"],
+                role="assistant",
+                timestamp=datetime.now().isoformat(),
+                cached=True,
+            )
+
+        messages, _ = await HistoryCompactor.compact(messages, CHAT_MODEL)
+        messages = await MediaStore.materialize(messages, CHAT_MODEL)
+        response = await chat_router.invoke(messages)
+        ResponseCache.save(cache_key, response.content)
 
         return MessageResponse(
             content=response.content,
             role="assistant",
             timestamp=datetime.now().isoformat(),
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -96,49 +223,123 @@ async def handle_chat_stream(
         content_blocks: str = Form(default="[]"),
         history: str = Form(default="[]"),
         audio_file: UploadFile | None = File(None),
-        pdf_file: UploadFile | None = File(None)
+        pdf_file: UploadFile | None = File(None),
+        request: Request = None,
+        document_ids: str = Form(default="[]")
 ):
     """流式聊天接口（支持多模态）"""
     try:
+        # 模型调用排队已满时直接返回 429
+        admission.check(CHAT_PROVIDER)
+
         # 解析 JSON 字符串
         try:
             content_blocks_data = json.loads(content_blocks)
             history_data = json.loads(history)
+            document_ids_data = json.loads(document_ids)
         except json.JSONDecodeError as e:
             raise HTTPException(status_code=400, detail=f"JSON 解析错误: {str(e)}")
+        if not isinstance(document_ids_data, list) or not all(isinstance(i, str) for i in document_ids_data):
+            raise HTTPException(status_code=400, detail="document_ids 必须是文档 ID 字符串数组")
 
-        if pdf_file:
-            pdf_processor = PDFProcessor()
-            pdf_content = await pdf_file.read()
-            pdf_chunks = await pdf_processor.process_pdf(file_content=pdf_content, filename=pdf_file.filename)
-            request_data = MessageRequest(content_blocks=content_blocks_data, history=history_data,
-                                          pdf_chunks=pdf_chunks)
-        else:
-            # 创建请求对象（用于传递给其他函数）
-            request_data = MessageRequest(content_blocks=content_blocks_data, history=history_data)
+        # 创建请求对象（用于传递给其他函数）
+        request_data = MessageRequest(content_blocks=content_blocks_data, history=history_data)
 
         # 转换消息历史
-        messages = convert_history_to_messages(request_data.history)
+        messages = await convert_history_to_messages(request_data.history)
 
         # 添加当前用户消息（支持多模态）
-        current_message = create_multimodal_message(request_data, image_file=image_file, audio_file=audio_file)
+        current_message = await create_multimodal_message(request_data, image_file=image_file)
         messages.append(current_message)
         print(messages)
 
-        # 返回流式响应
-        return StreamingResponse(
-            generate_streaming_response(messages, pdf_chunks if pdf_file is not None else None),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Content-Type": "text/event-stream",
-            }
-        )
+        # 引用的文档库文档在开始推流前加载，文档不存在或未解析完成时直接返回错误
+        documents = await DocumentService.load_documents(document_ids_data) if document_ids_data else None
+
+        # PDF 只分块读取上传内容（大文件落盘），解析放到流式响应中进行，解析进度实时推送给前端
+        pdf_upload = await PDFUpload.from_upload(pdf_file) if pdf_file else None
+        # 音频同样先落盘，解码、切分和转写在流式响应中进行
+        audio_upload = await AudioUpload.from_upload(audio_file) if audio_file else None
+        return _streaming_response(messages, request, pdf_upload=pdf_upload, documents=documents,
+                                   audio_upload=audio_upload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def handle_session_stream(
+        session_id: str,
+        image_file: UploadFile | None = File(None),
+        content_blocks: str = Form(default="[]"),
+        audio_file: UploadFile | None = File(None),
+        pdf_file: UploadFile | None = File(None),
+        request: Request = None
+):
+    """会话流式聊天：历史消息从服务端会话加载，客户端只发送本轮新内容"""
+    try:
+        admission.check(CHAT_PROVIDER)
+
+        try:
+            content_blocks_data = json.loads(content_blocks)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"JSON 解析错误: {str(e)}")
+
+        messages = SessionService.load_messages(session_id)
+
+        # 写入会话历史的是用户原始消息，PDF 参考内容和音频（转写）只用于本轮调用模型
+        user_message = await create_multimodal_message(MessageRequest(content_blocks=content_blocks_data),
+                                                       image_file=image_file)
+        messages.append(user_message)
+        pdf_upload = await PDFUpload.from_upload(pdf_file) if pdf_file else None
+        audio_upload = await AudioUpload.from_upload(audio_file) if audio_file else None
+
+        def save_turn(full_content: str):
+            SessionService.append_messages(session_id, [user_message, AIMessage(content=full_content)])
+
+        return _streaming_response(messages, request, on_complete=save_turn, pdf_upload=pdf_upload,
+                                   audio_upload=audio_upload)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _streaming_response(
+        messages: List[BaseMessage],
+        request: Request | None,
+        on_complete: Callable[[str], Any] = None,
+        pdf_upload: PDFUpload = None,
+        documents: List[Tuple[str, List[Dict[str, Any]]]] = None,
+        audio_upload: AudioUpload = None
+) -> StreamingResponse:
+    """构建 SSE 流式响应（协商压缩）"""
+    # 根据 Accept-Encoding 协商是否压缩
+    encoder = SSEEncoder(content_encoding=SSEEncoder.negotiate_encoding(
+        request.headers.get("accept-encoding") if request else None))
+
+    # 返回流式响应
+    return StreamingResponse(
+        generate_streaming_response(messages, None, encoder, request, on_complete, pdf_upload, documents,
+                                    audio_upload),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Content-Type": "text/event-stream",
+            **encoder.headers,
+        },
+        # 流没有开始（客户端提前断开）时也释放上传的 PDF 和音频
+        background=BackgroundTask(_close_uploads, pdf_upload, audio_upload) if pdf_upload or audio_upload else None
+    )
+
+
+def _close_uploads(*uploads):
+    for upload in uploads:
+        if upload is not None:
+            upload.close()
+
+
 async def get_current_weather() -> WeatherInfo:
     agent = create_agent(
         model=await build_deepseek_model(),
@@ -156,9 +357,11 @@ async def get_current_weather() -> WeatherInfo:
              '''
     )
 
-    response = await agent.ainvoke(
-        {'messages': [{'role': 'user', 'content': '天气怎么样?'}]
-    })
+    # 天气属于后台任务，排在交互式对话之后
+    async with admission.slot("deepseek", Priority.BATCH):
+        response = await agent.ainvoke(
+            {'messages': [{'role': 'user', 'content': '天气怎么样?'}]
+        })
     # 要用deepseek模型，qwen不能输出自定义响应结构
     result = response['structured_response']
     print(type(result))
@@ -0,0 +1,357 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Tuple
+
+from fastapi import HTTPException
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+from services.cache_service import PDFChunkCache
+from services.vector_service import VectorRetriever
+from utils.pdf_utils import PDFUpload
+
+logger = logging.getLogger("document_service")
+logger.setLevel(logging.INFO)
+
+# 文档状态
+STATUS_QUEUED = "queued"
+STATUS_PROCESSING = "processing"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+CREATE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS documents (
+        id VARCHAR(32) NOT NULL PRIMARY KEY,
+        filename VARCHAR(255) NOT NULL,
+        sha256 CHAR(64) NOT NULL,
+        document_hash CHAR(64) NOT NULL,
+        size BIGINT NOT NULL,
+        status VARCHAR(16) NOT NULL,
+        total_pages INT NULL,
+        total_chunks INT NULL,
+        error TEXT NULL,
+        created_at DATETIME NOT NULL,
+        updated_at DATETIME NOT NULL,
+        KEY idx_documents_sha256 (sha256)
+    ) DEFAULT CHARSET=utf8mb4
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS document_chunks (
+        document_id VARCHAR(32) NOT NULL,
+        chunk_index INT NOT NULL,
+        content MEDIUMTEXT NOT NULL,
+        metadata JSON NOT NULL,
+        PRIMARY KEY (document_id, chunk_index)
+    ) DEFAULT CHARSET=utf8mb4
+    """,
+]
+
+
+def _db():
+    """
+    获取 MySQL 客户端
+    连接池在导入时创建，文档库之外的功能不依赖 MySQL，因此在首次使用时才导入
+    """
+    from common.mysql_client import mysql_client
+    return mysql_client
+
+
+class DocumentService:
+    """
+    文档库
+    - 上传时只保存文件（按内容哈希命名）并写入解析任务队列，立即返回文档 ID
+    - 后台 worker 复用 PDFProcessor 解析，文档块写入 MySQL，解析进度写入 Redis
+    - 对话时按文档 ID 加载文档块，不再随每次请求上传和解析文件
+    """
+
+    @staticmethod
+    async def create_document(upload: PDFUpload) -> Dict[str, Any]:
+        """保存上传的文档并加入解析队列"""
+        document_id = uuid.uuid4().hex
+        path = DocumentService._storage_path(upload.sha256)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(settings.DOCUMENT_STORAGE_DIR, exist_ok=True)
+                await asyncio.to_thread(upload.save_to, path)
+        finally:
+            upload.close()
+
+        now = datetime.now()
+        await asyncio.to_thread(
+            _db().execute_modify,
+            "INSERT INTO documents (id, filename, sha256, document_hash, size, status, created_at, updated_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            (document_id, upload.filename, upload.sha256, PDFChunkCache.document_hash(upload), upload.size,
+             STATUS_QUEUED, now, now),
+        )
+        DocumentService._set_progress(document_id, {"status": STATUS_QUEUED})
+        redis_client.rpush(constant.DOCUMENT_JOBS, document_id)
+        metrics.incr("document_jobs_total", status=STATUS_QUEUED)
+        return {"document_id": document_id, "filename": upload.filename, "size": upload.size,
+                "status": STATUS_QUEUED}
+
+    @staticmethod
+    async def get_document(document_id: str) -> Dict[str, Any]:
+        """获取文档信息和解析状态，文档不存在时返回 404"""
+        rows = await asyncio.to_thread(
+            _db().execute_query,
+            "SELECT id, filename, size, status, total_pages, total_chunks, error, document_hash "
+            "FROM documents WHERE id = %s",
+            (document_id,),
+        )
+        if not rows:
+            raise HTTPException(status_code=404, detail=f"文档不存在: {document_id}")
+        row = rows[0]
+        document = {
+            "document_id": row["id"],
+            "filename": row["filename"],
+            "size": row["size"],
+            "status": row["status"],
+            "total_pages": row["total_pages"],
+            "total_chunks": row["total_chunks"],
+            "error": row["error"],
+            "document_hash": row["document_hash"],
+        }
+        # 解析中的文档附带实时进度
+        if row["status"] in (STATUS_QUEUED, STATUS_PROCESSING):
+            document["progress"] = redis_client.get_object(constant.DOCUMENT_STATUS.format(document_id))
+        return document
+
+    @staticmethod
+    async def load_documents(document_ids: List[str]) -> List[Tuple[str, List[Dict[str, Any]]]]:
+        """
+        加载已解析完成的文档块，顺序与 document_ids 一致
+
+        Returns:
+            [(文档哈希, 文档块列表)]
+        """
+        if len(document_ids) > settings.DOCUMENT_MAX_PER_CHAT:
+            raise HTTPException(status_code=400, detail=f"单次对话最多引用 {settings.DOCUMENT_MAX_PER_CHAT} 个文档")
+
+        documents = []
+        for document_id in dict.fromkeys(document_ids):
+            document = await DocumentService.get_document(document_id)
+            if document["status"] != STATUS_READY:
+                raise HTTPException(status_code=409, detail=f"文档尚未解析完成: {document_id}（{document['status']}）")
+
+            # 优先使用文档块缓存，未命中时从 MySQL 读取
+            cached = await asyncio.to_thread(PDFChunkCache.get, document["document_hash"], document["filename"])
+            if cached:
+                chunks = cached["chunks"]
+            else:
+                chunks = await DocumentService._read_chunks(document_id, document["total_chunks"])
+            documents.append((document["document_hash"], chunks))
+        return documents
+
+    @staticmethod
+    async def _read_chunks(document_id: str, total_chunks: Optional[int]) -> List[Dict[str, Any]]:
+        """从 MySQL 读取文档块（解析时逐段写入，total_chunks 在读取时填写）"""
+        rows = await asyncio.to_thread(
+            _db().execute_query,
+            "SELECT content, metadata FROM document_chunks WHERE document_id = %s ORDER BY chunk_index",
+            (document_id,),
+        )
+        chunks = [DocumentService._row_to_chunk(row) for row in rows]
+        for chunk in chunks:
+            chunk["metadata"]["total_chunks"] = total_chunks if total_chunks is not None else len(chunks)
+        return chunks
+
+    @staticmethod
+    async def ingest(document_id: str):
+        """解析文档（worker 调用），失败时记录错误"""
+        rows = await asyncio.to_thread(
+            _db().execute_query,
+            "SELECT filename, sha256, document_hash, size, status FROM documents WHERE id = %s",
+            (document_id,),
+        )
+        if not rows or rows[0]["status"] == STATUS_READY:
+            return
+        row = rows[0]
+
+        started = time.monotonic()
+        if not await DocumentService._claim(document_id):
+            # 重复入队，或其他 worker 正在解析且未超时
+            logger.info(f"文档 {document_id} 已由其他 worker 处理，跳过")
+            return
+        touched = started
+        upload = PDFUpload(row["filename"], row["size"], row["sha256"], path=DocumentService._storage_path(row["sha256"]))
+
+        async def save_chunks(chunks: List[Dict[str, Any]]):
+            # 每段页面产出的文档块立即写入 MySQL，不在内存中攒齐整个文档
+            await asyncio.to_thread(DocumentService._save_chunks, document_id, chunks)
+
+        try:
+            # 清除上次未完成的解析写入的文档块
+            await asyncio.to_thread(DocumentService._clear_chunks, document_id)
+            async for event in PDFChunkCache.process_stream(upload, on_chunks=save_chunks):
+                if event["type"] != "pdf_ready":
+                    DocumentService._set_progress(document_id, {"status": STATUS_PROCESSING, **event})
+                    # 定期刷新更新时间，解析时间长的文档不会被当作卡住的任务重新入队
+                    if time.monotonic() - touched > settings.DOCUMENT_STALE_SECONDS / 3:
+                        touched = time.monotonic()
+                        await DocumentService._update(document_id, status=STATUS_PROCESSING)
+                    continue
+
+                if settings.VECTOR_ENABLED:
+                    # 解析时预先构建向量索引，首次对话不必等待向量化
+                    chunks = await DocumentService._read_chunks(document_id, event["total_chunks"])
+                    await VectorRetriever.get_index(row["document_hash"], chunks)
+                await DocumentService._update(document_id, status=STATUS_READY, total_pages=event["total_pages"],
+                                              total_chunks=event["total_chunks"])
+                DocumentService._set_progress(document_id, {"status": STATUS_READY})
+        except Exception as e:
+            logger.error(f"文档解析失败 {document_id}: {str(e)}", exc_info=True)
+            await DocumentService._update(document_id, status=STATUS_FAILED, error=str(e)[:1000])
+            DocumentService._set_progress(document_id, {"status": STATUS_FAILED, "error": str(e)})
+            metrics.incr("document_jobs_total", status=STATUS_FAILED)
+            return
+        metrics.incr("document_jobs_total", status=STATUS_READY)
+        metrics.observe("document_ingest_seconds", time.monotonic() - started)
+        logger.info(f"文档解析完成 {document_id}，耗时 {time.monotonic() - started:.3f}s")
+
+    @staticmethod
+    def ensure_tables():
+        """创建文档库数据表（不存在时）"""
+        for sql in CREATE_TABLES:
+            _db().execute_modify(sql)
+
+    @staticmethod
+    def requeue_stale() -> int:
+        """
+        重新入队卡住的文档：排队或解析中、超过 DOCUMENT_STALE_SECONDS 未更新
+        （入队失败、worker 所在进程退出时任务已从队列中取出），返回重新入队的文档数
+        """
+        stale_before = datetime.now() - timedelta(seconds=settings.DOCUMENT_STALE_SECONDS)
+        rows = _db().execute_query(
+            "SELECT id FROM documents WHERE status IN (%s, %s) AND updated_at < %s",
+            (STATUS_QUEUED, STATUS_PROCESSING, stale_before),
+        )
+        document_ids = [row["id"] for row in rows]
+        if document_ids:
+            redis_client.rpush(constant.DOCUMENT_JOBS, *document_ids)
+        return len(document_ids)
+
+    @staticmethod
+    async def _claim(document_id: str) -> bool:
+        """
+        认领解析任务：排队中、失败或解析超时的文档改为解析中
+        同一文档被重复入队时只有一个 worker 认领成功
+        """
+        now = datetime.now()
+        claimed = await asyncio.to_thread(
+            _db().execute_modify,
+            "UPDATE documents SET status = %s, updated_at = %s "
+            "WHERE id = %s AND (status IN (%s, %s) OR (status = %s AND updated_at < %s))",
+            (STATUS_PROCESSING, now, document_id, STATUS_QUEUED, STATUS_FAILED, STATUS_PROCESSING,
+             now - timedelta(seconds=settings.DOCUMENT_STALE_SECONDS)),
+        )
+        return claimed > 0
+
+    @staticmethod
+    def _clear_chunks(document_id: str):
+        _db().execute_modify("DELETE FROM document_chunks WHERE document_id = %s", (document_id,))
+
+    @staticmethod
+    def _save_chunks(document_id: str, chunks: List[Dict[str, Any]]):
+        """写入一段文档块，序号为文档块在整个文档中的编号"""
+        if chunks:
+            _db().execute_many(
+                "INSERT INTO document_chunks (document_id, chunk_index, content, metadata) VALUES (%s, %s, %s, %s)",
+                [(document_id, chunk["metadata"]["chunk_id"], chunk["content"],
+                  json.dumps({**chunk["metadata"], "id": chunk["id"]}, ensure_ascii=False))
+                 for chunk in chunks],
+            )
+
+    @staticmethod
+    def _row_to_chunk(row: Dict[str, Any]) -> Dict[str, Any]:
+        metadata = row["metadata"]
+        if isinstance(metadata, (str, bytes)):
+            metadata = json.loads(metadata)
+        chunk_id = metadata.pop("id", None)
+        return {"id": chunk_id, "content": row["content"], "metadata": metadata}
+
+    @staticmethod
+    async def _update(document_id: str, **fields):
+        fields["updated_at"] = datetime.now()
+        assignments = ", ".join(f"{name} = %s" for name in fields)
+        await asyncio.to_thread(
+            _db().execute_modify,
+            f"UPDATE documents SET {assignments} WHERE id = %s",
+            (*fields.values(), document_id),
+        )
+
+    @staticmethod
+    def _set_progress(document_id: str, progress: Dict[str, Any]):
+        redis_client.set_object(constant.DOCUMENT_STATUS.format(document_id), progress,
+                                ex=settings.DOCUMENT_STATUS_TTL)
+
+    @staticmethod
+    def _storage_path(sha256: str) -> str:
+        return os.path.join(settings.DOCUMENT_STORAGE_DIR, f"{sha256}.pdf")
+
+
+class DocumentWorkerPool:
+    """
+    文档解析 worker
+    每个应用进程启动 DOCUMENT_WORKERS 个协程，从 Redis 队列中取任务；多个进程共同消费同一个队列
+    启动时先在后台初始化数据表并重新入队卡住的文档，不阻塞应用启动
+    """
+
+    def __init__(self):
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if settings.DOCUMENT_WORKERS <= 0 or self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._start())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _start(self):
+        try:
+            await asyncio.to_thread(DocumentService.ensure_tables)
+        except Exception as e:
+            logger.error(f"文档库数据表初始化失败，不启动解析 worker: {str(e)}")
+            return
+        try:
+            requeued = await asyncio.to_thread(DocumentService.requeue_stale)
+            if requeued:
+                logger.info(f"重新入队 {requeued} 个卡住的文档")
+        except Exception as e:
+            logger.error(f"检查卡住的文档失败: {str(e)}")
+        self._tasks.extend(asyncio.create_task(self._run(i)) for i in range(settings.DOCUMENT_WORKERS))
+        logger.info(f"文档解析 worker 已启动: {settings.DOCUMENT_WORKERS} 个")
+
+    @staticmethod
+    async def _run(worker_id: int):
+        while True:
+            started = time.monotonic()
+            document_id: Optional[str] = await asyncio.to_thread(redis_client.blpop, constant.DOCUMENT_JOBS, 5)
+            if document_id is None:
+                # Redis 不可用时 blpop 立即返回，避免空转
+                if time.monotonic() - started < 1:
+                    await asyncio.sleep(1)
+                continue
+            logger.info(f"worker {worker_id} 开始解析文档 {document_id}")
+            try:
+                await DocumentService.ingest(document_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"worker {worker_id} 处理文档 {document_id} 失败: {str(e)}", exc_info=True)
+
+
+# 单例实例（全局唯一）
+document_workers = DocumentWorkerPool()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from typing import List, Dict, Any, Tuple
+
+from langchain.messages import SystemMessage, HumanMessage
+from langchain_core.messages import BaseMessage
+
+from common import constant
+from common.redis_client import redis_client
+from config.settings import settings
+from services.admission_service import admission, Priority
+from services.message_service import hash_messages, message_text
+from services.model_service import build_dashscope_model
+from utils.token_utils import estimate_message_tokens, estimate_messages_tokens, estimate_text_tokens
+
+logger = logging.getLogger("history_service")
+logger.setLevel(logging.INFO)
+
+SUMMARY_PROMPT = """请将下面这条对话消息压缩成一句简短的摘要（不超过{max_chars}字），保留关键事实、数字和结论，只输出摘要本身：
+
+{content}"""
+
+
+class HistoryCompactor:
+    """
+    按模型 token 预算压缩对话历史
+    - 系统提示词和当前消息始终保留
+    - 从最近的历史往前保留原文，直到预算用完
+    - 更早的消息按配置丢弃或替换为摘要；每条消息的摘要按内容哈希缓存在 Redis，只生成一次
+    """
+
+    @staticmethod
+    def get_budget(model_name: str) -> int:
+        """获取模型的输入 token 预算"""
+        return settings.MODEL_INPUT_TOKEN_BUDGETS.get(model_name, settings.DEFAULT_INPUT_TOKEN_BUDGET)
+
+    @staticmethod
+    async def compact(messages: List[BaseMessage], model_name: str) -> Tuple[List[BaseMessage], Dict[str, Any]]:
+        """
+        压缩消息列表
+
+        Args:
+            messages: 系统提示词 + 历史消息 + 当前消息
+            model_name: 目标模型名（决定 token 预算）
+
+        Returns:
+            (压缩后的消息列表, {"before": 压缩前 token 数, "after": 压缩后 token 数, "compacted_messages": 被压缩的消息数})
+        """
+        before = estimate_messages_tokens(messages)
+        stats = {"before": before, "after": before, "compacted_messages": 0}
+        budget = HistoryCompactor.get_budget(model_name)
+        if settings.HISTORY_COMPACTION_MODE == "off" or before <= budget or len(messages) <= 2:
+            return messages, stats
+
+        system, history, current = messages[0], messages[1:-1], messages[-1]
+        remaining = budget - estimate_message_tokens(system) - estimate_message_tokens(current)
+
+        # 从最近的消息往前保留原文
+        split = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            tokens = estimate_message_tokens(history[index])
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            split = index
+        older, recent = history[:split], history[split:]
+
+        # 摘要合并进系统提示词，避免出现多条系统消息
+        if older and settings.HISTORY_COMPACTION_MODE == "summarize":
+            system = await HistoryCompactor._summarize(system, older, remaining)
+        compacted = [system, *recent, current]
+
+        stats["after"] = estimate_messages_tokens(compacted)
+        stats["compacted_messages"] = len(older)
+        logger.info(f"历史消息压缩: {before} -> {stats['after']} tokens，压缩 {len(older)} 条消息")
+        return compacted, stats
+
+    @staticmethod
+    async def _summarize(system: BaseMessage, older: List[BaseMessage], budget: int) -> BaseMessage:
+        """将较早消息的摘要追加到系统提示词，摘要超出剩余预算时从最旧的开始舍弃"""
+        semaphore = asyncio.Semaphore(settings.HISTORY_SUMMARY_CONCURRENCY)
+
+        async def summarize(message: BaseMessage) -> str:
+            async with semaphore:
+                return await HistoryCompactor._summarize_message(message)
+
+        summaries = await asyncio.gather(*[summarize(message) for message in older])
+        lines = [f"- {'用户' if message.type == 'human' else '助手'}: {summary}"
+                 for message, summary in zip(older, summaries) if summary]
+
+        while lines:
+            summary_text = "\n\n以下是较早对话的摘要，供参考：\n" + "\n".join(lines)
+            if estimate_text_tokens(summary_text) <= budget:
+                return SystemMessage(content=system.content + summary_text)
+            lines.pop(0)
+        return system
+
+    @staticmethod
+    async def _summarize_message(message: BaseMessage) -> str:
+        """生成单条消息的摘要（按内容哈希缓存），失败时返回空字符串（该消息被直接丢弃）"""
+        text = message_text(message).strip()
+        if not text:
+            return ""
+        if len(text) <= settings.HISTORY_SUMMARY_MAX_CHARS:
+            return text
+
+        cache_key = constant.HISTORY_SUMMARY.format(
+            hash_messages([message], settings.HISTORY_SUMMARY_MODEL))
+        cached = redis_client.get_object(cache_key)
+        if cached:
+            return cached
+
+        try:
+            model = await build_dashscope_model(settings.HISTORY_SUMMARY_MODEL)
+            async with admission.slot("dashscope", Priority.BATCH):
+                response = await model.ainvoke([HumanMessage(content=SUMMARY_PROMPT.format(
+                    max_chars=settings.HISTORY_SUMMARY_MAX_CHARS, content=text))])
+            summary = response.content.strip()
+        except Exception as e:
+            logger.warning(f"历史消息摘要失败，直接丢弃该消息: {str(e)}")
+            return ""
+
+        redis_client.set_object(cache_key, summary, ex=settings.HISTORY_SUMMARY_TTL)
+        return summary
@@ -0,0 +1,444 @@
+import asyncio
+import binascii
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Any, Iterable, Optional, Set
+
+from fastapi import UploadFile, HTTPException
+from langchain_core.messages import BaseMessage
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+from utils.audio_utils import AudioProcessor
+from utils.image_utils import ImageProcessor
+from utils.media_utils import read_upload, offload, encode_data_url, check_data_url_size
+
+logger = logging.getLogger("media_service")
+logger.setLevel(logging.INFO)
+
+MEDIA_SCHEME = "media://"
+_MEDIA_REF = re.compile(r"^media://([0-9a-f]{64})$")
+# 每次淘汰检查的候选数
+_EVICT_BATCH = 100
+# 单个媒体写入/淘汰锁的过期时间（秒），写入方最多等待这么久
+_LOCK_TTL = 10
+# 历史中引用的媒体已被淘汰时的占位文本
+EXPIRED_PLACEHOLDER = {"image": "[图片已过期]", "audio": "[音频已过期]"}
+
+
+class MediaStore:
+    """
+    按内容寻址的媒体存储（图片、音频）
+    - 文件按内容哈希保存在 MEDIA_STORE_DIR，相同内容只存一份；元信息、引用方和最近访问时间记录在 Redis
+    - 上传后返回媒体 ID，内容块和历史记录用 media://<哈希> 引用，不再随每轮请求携带 base64
+    - 引用方为 Redis 键（如会话元信息），键过期或删除后引用自动失效；总大小超过 MEDIA_STORE_MAX_BYTES 时
+      按最近访问时间淘汰没有有效引用的文件；上传后 MEDIA_UPLOAD_TTL 内以上传本身作为引用方，不会被淘汰
+    - 写入和淘汰同一媒体时持有该媒体的锁，不会出现写入返回后文件或元信息被删掉的情况
+    - 不经会话传入的历史中引用的媒体已被淘汰时，替换为占位文本，不再返回 404
+    - 只在调用模型前把引用展开为 data URL（图片按模型预处理），展开结果缓存在进程内
+    - 图片预处理结果也存入本存储，预处理缓存只记录处理后图片的媒体 ID（缓存条目即引用方），Redis 中不保存图片内容
+    """
+
+    _encoded: "OrderedDict[str, str]" = OrderedDict()
+    _encoded_bytes = 0
+
+    @staticmethod
+    async def save_upload(upload: UploadFile, kind: str = None) -> Dict[str, Any]:
+        """
+        保存上传的图片或音频
+        :param kind: 限定媒体类型（image / audio），默认按文件类型判断
+        :return: 媒体元信息（media_id、url、mime_type、size）
+        """
+        mime_type = MediaStore._upload_mime_type(upload)
+        media_kind = mime_type.split("/")[0]
+        if kind and media_kind != kind:
+            raise HTTPException(status_code=400, detail=f"文件类型不匹配，需要{'图片' if kind == 'image' else '音频'}文件")
+        if media_kind == "image":
+            contents = await read_upload(upload, settings.IMAGE_MAX_UPLOAD_BYTES, "图片")
+        else:
+            contents = await read_upload(upload, settings.AUDIO_DIRECT_MAX_BYTES, "音频")
+        media_id = await asyncio.to_thread(MediaStore.put_upload, bytes(contents), mime_type)
+        return {"media_id": media_id, "url": MEDIA_SCHEME + media_id, "mime_type": mime_type, "size": len(contents)}
+
+    @staticmethod
+    def put(data: bytes, mime_type: str, owner: Optional[str] = None, owner_ttl: Optional[int] = None) -> str:
+        """
+        保存媒体内容，返回媒体 ID（内容的 SHA-256）；已存在时只刷新访问时间
+        :param owner: 引用方（Redis 键），在持有锁期间登记，之后的淘汰不会删除刚写入的媒体
+        :param owner_ttl: 指定时创建引用方键并设置过期时间（秒）
+        """
+        media_id = hashlib.sha256(data).hexdigest()
+        # 持有该媒体的锁写文件、元信息和引用方，淘汰不会在这几步之间删除它
+        with MediaStore._lock(media_id, wait=True):
+            redis_client.zadd(constant.MEDIA_LRU, {media_id: time.time()})
+            path = MediaStore._path(media_id)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 先写临时文件再重命名，并发写入同一内容时不会读到半个文件
+                temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+
+            meta_key = constant.MEDIA_META.format(media_id)
+            if redis_client.hsetnx(meta_key, "size", str(len(data))):
+                redis_client.hmset(meta_key, {"mime_type": mime_type, "created_at": str(time.time())})
+                redis_client.incr(constant.MEDIA_BYTES, len(data))
+                metrics.incr("media_store_total", result="stored")
+            else:
+                metrics.incr("media_store_total", result="deduplicated")
+            if owner:
+                if owner_ttl:
+                    redis_client.set(owner, "1", ex=owner_ttl)
+                MediaStore.acquire(owner, [media_id])
+        MediaStore.evict()
+        return media_id
+
+    @staticmethod
+    def put_upload(data: bytes, mime_type: str) -> str:
+        """保存上传的媒体，以带过期时间的上传记录作为引用方"""
+        media_id = hashlib.sha256(data).hexdigest()
+        return MediaStore.put(data, mime_type, owner=constant.MEDIA_UPLOAD_OWNER.format(media_id),
+                              owner_ttl=settings.MEDIA_UPLOAD_TTL)
+
+    @staticmethod
+    def parse_ref(url: str) -> Optional[str]:
+        """解析 media://<哈希> 引用，不是媒体引用时返回 None"""
+        match = _MEDIA_REF.match(url or "")
+        return match.group(1) if match else None
+
+    @staticmethod
+    def check_ref(url: str, kind: str, missing_ok: bool = False) -> Optional[str]:
+        """
+        校验内容块中的媒体引用：格式错误返回 400，不存在（已淘汰）返回 404，类型不符返回 400
+        :param missing_ok: 媒体不存在时返回 None 而不是 404（历史中的引用）
+        """
+        media_id = MediaStore.parse_ref(url)
+        if media_id is None:
+            raise HTTPException(status_code=400, detail=f"无效的媒体引用: {url}")
+        mime_type = redis_client.hget(constant.MEDIA_META.format(media_id), "mime_type")
+        if not mime_type:
+            if missing_ok:
+                metrics.incr("media_expired_refs_total")
+                return None
+            raise HTTPException(status_code=404, detail=f"媒体不存在或已过期，请重新上传: {url}")
+        if not mime_type.startswith(kind + "/"):
+            raise HTTPException(status_code=400, detail=f"媒体类型不匹配: {url} 为 {mime_type}")
+        return url
+
+    @staticmethod
+    def references(messages: Iterable[BaseMessage]) -> Set[str]:
+        """消息中引用的全部媒体 ID"""
+        media_ids = set()
+        for message in messages:
+            for item in MediaStore._media_items(message):
+                media_id = MediaStore.parse_ref(MediaStore._item_url(item))
+                if media_id:
+                    media_ids.add(media_id)
+        return media_ids
+
+    @staticmethod
+    def acquire(owner: str, media_ids: Iterable[str]):
+        """
+        登记引用方（Redis 键），引用方存在期间媒体不会被淘汰
+        引用方过期或删除后不需要显式释放，淘汰时会清理失效的引用方
+        """
+        for media_id in media_ids:
+            redis_client.sadd(constant.MEDIA_REFS.format(media_id), owner)
+            redis_client.zadd(constant.MEDIA_LRU, {media_id: time.time()})
+
+    @staticmethod
+    async def materialize(messages: List[BaseMessage], model_name: str) -> List[BaseMessage]:
+        """
+        把消息中的 media:// 引用展开为 data URL（图片按目标模型预处理），返回新消息列表（原消息不变）
+        历史消息中已被淘汰的媒体替换为占位文本，只有当前消息（最后一条）中的引用不存在时返回 404
+        """
+        result = []
+        for position, message in enumerate(messages):
+            if not MediaStore._media_items(message):
+                result.append(message)
+                continue
+            content = []
+            for item in message.content:
+                if MediaStore._is_media_item(item):
+                    try:
+                        data_url = await MediaStore.data_url(MediaStore._item_url(item), model_name)
+                    except HTTPException as e:
+                        if e.status_code != 404 or position == len(messages) - 1:
+                            raise
+                        content.append(MediaStore.expired_block(item["type"].split("_")[0]))
+                        continue
+                    value = item[item["type"]]
+                    item = {**item, item["type"]: {**value, "url": data_url} if isinstance(value, dict) else data_url}
+                content.append(item)
+            result.append(message.model_copy(update={"content": content}))
+        return result
+
+    @staticmethod
+    async def data_url(url: str, model_name: str) -> str:
+        """展开单个媒体引用；同一媒体、同一模型的结果在进程内缓存"""
+        media_id = MediaStore.parse_ref(url)
+        if media_id is None:
+            raise HTTPException(status_code=400, detail=f"无效的媒体引用: {url}")
+        cache_key = f"{media_id}:{model_name}"
+        cached = MediaStore._encoded.get(cache_key)
+        if cached is not None:
+            MediaStore._encoded.move_to_end(cache_key)
+            redis_client.zadd(constant.MEDIA_LRU, {media_id: time.time()})
+            metrics.incr("media_materialize_total", result="cached")
+            return cached
+
+        meta = redis_client.hgetall(constant.MEDIA_META.format(media_id))
+        try:
+            if not meta:
+                raise FileNotFoundError(media_id)
+            data = await asyncio.to_thread(MediaStore._read, media_id)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"媒体不存在或已过期，请重新上传: {url}")
+        redis_client.zadd(constant.MEDIA_LRU, {media_id: time.time()})
+
+        mime_type = meta.get("mime_type", "application/octet-stream")
+        if mime_type.startswith("image/"):
+            # 媒体 ID 即内容哈希，预处理缓存不必重新计算哈希
+            data_url = await offload(len(data), MediaStore.optimize_image, data, mime_type, model_name, None, media_id)
+        else:
+            data_url = await offload(len(data), encode_data_url, data, mime_type)
+        metrics.incr("media_materialize_total", result="encoded")
+        MediaStore._remember(cache_key, data_url)
+        return data_url
+
+    @staticmethod
+    async def optimize_data_url(data_url: str, model_name: str) -> str:
+        """预处理 data URL 形式的图片（前端内容块、历史消息中的图片），较大的图片在线程中解码和处理"""
+        check_data_url_size(data_url, settings.IMAGE_MAX_UPLOAD_BYTES, "图片")
+        return await offload(len(data_url), MediaStore.optimize_data_url_sync, data_url, model_name)
+
+    @staticmethod
+    def optimize_data_url_sync(data_url: str, model_name: str) -> str:
+        """预处理 data URL 形式的图片，无法解析时原样返回"""
+        header, _, payload = data_url.partition(";base64,")
+        if not payload:
+            return data_url
+        try:
+            contents = binascii.a2b_base64(payload)
+        except binascii.Error:
+            return data_url
+        return MediaStore.optimize_image(contents, header[5:], model_name, original=data_url)
+
+    @staticmethod
+    def optimize_image(contents: bytes, mime_type: str, model_name: str, original: str = None,
+                       digest: str = None) -> str:
+        """
+        图片预处理并编码为 data URL（见 ImageProcessor.preprocess）
+        - 处理后的图片存入媒体存储，预处理缓存按原图内容和处理参数的哈希只记录其媒体 ID，同一张图片在多轮对话中只处理一次
+        - 缓存条目作为处理后图片的引用方，条目过期或被淘汰后图片可以被淘汰；命中缓存但图片已被淘汰时重新处理
+        original 为原图的 data URL，digest 为图片内容的 SHA-256（已有时传入，避免重新编码、重新计算）
+        """
+        if not settings.IMAGE_PREPROCESS_ENABLED:
+            return original or encode_data_url(contents, mime_type)
+
+        started = time.monotonic()
+        max_edge = ImageProcessor.get_max_edge(model_name)
+        image_format = settings.IMAGE_OUTPUT_FORMAT
+        quality = settings.IMAGE_OUTPUT_QUALITY
+        cache_key = (digest or hashlib.sha256(contents).hexdigest()) + f":{max_edge}:{image_format}:{quality}"
+        data_url = MediaStore._cached_image(cache_key)
+        cached = data_url is not None
+        if not cached:
+            try:
+                processed, processed_mime = ImageProcessor.preprocess(contents, max_edge, image_format, quality)
+            except Exception as e:
+                # 无法识别的图片交给模型自行处理
+                logger.warning(f"图片预处理失败，使用原图: {str(e)}")
+                return original or encode_data_url(contents, mime_type)
+            if processed is None:
+                # 不需要处理，缓存空 ID 表示使用原图
+                redis_client.cache_set(constant.IMAGE_CACHE, cache_key, "", ex=settings.IMAGE_CACHE_TTL,
+                                       max_entries=settings.IMAGE_CACHE_MAX_ENTRIES)
+                data_url = ""
+            else:
+                # 先写缓存条目再保存图片：缓存条目即引用方，保存时的淘汰不会删除刚写入的图片
+                redis_client.cache_set(constant.IMAGE_CACHE, cache_key, hashlib.sha256(processed).hexdigest(),
+                                       ex=settings.IMAGE_CACHE_TTL, max_entries=settings.IMAGE_CACHE_MAX_ENTRIES)
+                MediaStore.put(processed, processed_mime, owner=f"{constant.IMAGE_CACHE}:{cache_key}")
+                data_url = encode_data_url(processed, processed_mime)
+        data_url = data_url or original or encode_data_url(contents, mime_type)
+
+        elapsed = time.monotonic() - started
+        # 原图 data URL 的长度：前缀 + base64 长度
+        original_length = len(original) if original else len(f"data:{mime_type};base64,") + 4 * ((len(contents) + 2) // 3)
+        saved = original_length - len(data_url)
+        metrics.observe("image_preprocess_seconds", elapsed)
+        metrics.incr("image_preprocess_total", result="cached" if cached else "processed")
+        metrics.incr("image_bytes_saved_total", max(saved, 0))
+        logger.info(f"图片预处理{'（缓存）' if cached else ''}: {original_length} -> {len(data_url)} 字节，"
+                    f"节省 {saved} 字节，耗时 {elapsed * 1000:.1f}ms")
+        return data_url
+
+    @staticmethod
+    def _cached_image(cache_key: str) -> Optional[str]:
+        """
+        读取预处理缓存，返回处理后图片的 data URL；原图不需要处理时返回空字符串
+        未命中或处理后的图片已被淘汰时返回 None
+        """
+        media_id = redis_client.cache_get(constant.IMAGE_CACHE, cache_key, ex=settings.IMAGE_CACHE_TTL)
+        if media_id is None:
+            return None
+        if not media_id:
+            return ""
+        meta = redis_client.hgetall(constant.MEDIA_META.format(media_id))
+        try:
+            if not meta:
+                raise FileNotFoundError(media_id)
+            data = MediaStore._read(media_id)
+        except FileNotFoundError:
+            return None
+        redis_client.zadd(constant.MEDIA_LRU, {media_id: time.time()})
+        return encode_data_url(data, meta.get("mime_type", "image/jpeg"))
+
+    @staticmethod
+    def expired_block(kind: str) -> Dict[str, Any]:
+        """已被淘汰的媒体在历史消息中的占位内容块"""
+        return {"type": "text", "text": EXPIRED_PLACEHOLDER[kind]}
+
+    @staticmethod
+    def evict():
+        """总大小超过 MEDIA_STORE_MAX_BYTES 时，按最近访问时间淘汰没有有效引用方的媒体（多进程间只有一个执行）"""
+        total = redis_client.get_int(constant.MEDIA_BYTES)
+        if total <= settings.MEDIA_STORE_MAX_BYTES:
+            return
+        if not redis_client.set(constant.MEDIA_EVICT_LOCK, "1", ex=60, nx=True):
+            return
+        try:
+            # 本轮开始后被写入或访问过的媒体不淘汰
+            started = time.time()
+            start, evicted = 0, 0
+            while total > settings.MEDIA_STORE_MAX_BYTES:
+                candidates = redis_client.zrange(constant.MEDIA_LRU, start, start + _EVICT_BATCH - 1)
+                if not candidates:
+                    break
+                for media_id in candidates:
+                    if total <= settings.MEDIA_STORE_MAX_BYTES:
+                        break
+                    freed = MediaStore._evict_one(media_id, started)
+                    if freed is None:
+                        start += 1
+                        continue
+                    total -= freed
+                    evicted += 1
+            if evicted:
+                metrics.incr("media_evicted_total", evicted)
+                logger.info(f"媒体存储淘汰 {evicted} 个文件，当前 {total} 字节")
+        finally:
+            redis_client.delete(constant.MEDIA_EVICT_LOCK)
+
+    @staticmethod
+    def _evict_one(media_id: str, started: float) -> Optional[int]:
+        """持有媒体的锁淘汰单个媒体，返回释放的字节数；正在写入、本轮开始后被访问或仍有引用方时返回 None"""
+        with MediaStore._lock(media_id, wait=False) as locked:
+            if not locked:
+                return None
+            if (redis_client.zscore(constant.MEDIA_LRU, media_id) or 0) >= started:
+                return None
+            if MediaStore._in_use(media_id):
+                return None
+            return MediaStore._delete(media_id)
+
+    @staticmethod
+    @contextmanager
+    def _lock(media_id: str, wait: bool):
+        """
+        单个媒体的写入/淘汰锁，产出是否拿到锁
+        wait 为 True 时最多等待 _LOCK_TTL 秒（锁会过期），Redis 不可用时不加锁继续执行
+        """
+        lock_key = constant.MEDIA_LOCK.format(media_id)
+        deadline = time.monotonic() + _LOCK_TTL
+        locked = redis_client.set(lock_key, "1", ex=_LOCK_TTL, nx=True)
+        while not locked and wait and time.monotonic() < deadline:
+            time.sleep(0.05)
+            locked = redis_client.set(lock_key, "1", ex=_LOCK_TTL, nx=True)
+        try:
+            yield locked or wait
+        finally:
+            if locked:
+                redis_client.delete(lock_key)
+
+    @staticmethod
+    def _in_use(media_id: str) -> bool:
+        """是否还有有效的引用方，顺便清理已失效的引用方"""
+        refs_key = constant.MEDIA_REFS.format(media_id)
+        owners = redis_client.smembers(refs_key)
+        expired = [owner for owner in owners if not redis_client.exists(owner)]
+        if expired:
+            redis_client.srem(refs_key, *expired)
+        return len(owners) > len(expired)
+
+    @staticmethod
+    def _delete(media_id: str) -> int:
+        """删除媒体文件和元信息，返回释放的字节数"""
+        size = int(redis_client.hget(constant.MEDIA_META.format(media_id), "size") or 0)
+        try:
+            os.remove(MediaStore._path(media_id))
+        except FileNotFoundError:
+            pass
+        redis_client.delete(constant.MEDIA_META.format(media_id), constant.MEDIA_REFS.format(media_id))
+        redis_client.zrem(constant.MEDIA_LRU, media_id)
+        redis_client.incr(constant.MEDIA_BYTES, -size)
+        return size
+
+    @staticmethod
+    def _read(media_id: str) -> bytes:
+        with open(MediaStore._path(media_id), "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _path(media_id: str) -> str:
+        # 按哈希前两位分目录，避免单个目录下文件过多
+        return os.path.join(settings.MEDIA_STORE_DIR, media_id[:2], media_id)
+
+    @staticmethod
+    def _upload_mime_type(upload: UploadFile) -> str:
+        extension = (upload.filename or "").split('.')[-1].lower()
+        if (upload.content_type or "").startswith("image/") or extension in ("jpg", "jpeg", "png", "gif", "bmp", "webp"):
+            return ImageProcessor.get_image_mime_type(upload.filename or "")
+        if AudioProcessor.is_valid_audio_type(upload.content_type, upload.filename or ""):
+            return AudioProcessor.get_audio_mime_type(upload.filename or "")
+        raise HTTPException(status_code=400, detail="不支持的媒体格式，支持图片（JPG、PNG、GIF、BMP、WebP）和音频（MP3、WAV、M4A）")
+
+    @staticmethod
+    def _media_items(message: BaseMessage) -> List[Dict[str, Any]]:
+        """消息中以 media:// 引用的图片、音频内容块"""
+        if not isinstance(message.content, list):
+            return []
+        return [item for item in message.content if MediaStore._is_media_item(item)]
+
+    @staticmethod
+    def _is_media_item(item: Any) -> bool:
+        return isinstance(item, dict) and item.get("type") in ("image_url", "audio_url") \
+            and MediaStore._item_url(item).startswith(MEDIA_SCHEME)
+
+    @staticmethod
+    def _item_url(item: Dict[str, Any]) -> str:
+        value = item.get(item["type"]) or ""
+        return (value.get("url") if isinstance(value, dict) else value) or ""
+
+    @classmethod
+    def _remember(cls, cache_key: str, data_url: str):
+        if len(data_url) > settings.MEDIA_ENCODED_CACHE_BYTES:
+            return
+        previous = cls._encoded.pop(cache_key, None)
+        if previous is not None:
+            cls._encoded_bytes -= len(previous)
+        cls._encoded[cache_key] = data_url
+        cls._encoded_bytes += len(data_url)
+        while cls._encoded_bytes > settings.MEDIA_ENCODED_CACHE_BYTES:
+            _, evicted = cls._encoded.popitem(last=False)
+            cls._encoded_bytes -= len(evicted)
@@ -1,37 +1,31 @@
+import base64
+import hashlib
+import json
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 from fastapi import UploadFile
 from langchain.messages import SystemMessage, HumanMessage, AIMessage
 from langchain_core.messages import BaseMessage
+from config.settings import settings
 from schema.schemas import MessageRequest
-from utils.audio_utils import AudioProcessor
-from utils.image_utils import ImageProcessor
+from services.media_service import MediaStore, MEDIA_SCHEME
+from services.model_service import CHAT_MODEL
+from utils.context_utils import pack_context
+from utils.media_utils import offload, check_data_url_size
 
 
-def create_multimodal_message(request: MessageRequest, image_file: UploadFile | None, audio_file:UploadFile | None) -> HumanMessage:
-    """创建多模态消息"""
+async def create_multimodal_message(request: MessageRequest, image_file: UploadFile | None) -> HumanMessage:
+    """创建多模态消息（上传的音频文件在流式响应中处理，见 attach_audio）"""
     message_content = []
 
-    # 如果有图片
+    # 如果有图片：存入媒体存储，消息中只保存 media:// 引用，调用模型前再展开（见 MediaStore.materialize）
     if image_file:
-        processor = ImageProcessor()
-        mime_type = processor.get_image_mime_type(image_file.filename)
-        base64_image = processor.image_to_base64(image_file)
+        media = await MediaStore.save_upload(image_file, "image")
         message_content.append({
             "type": "image_url",
             "image_url": {
-                "url": f"data:{mime_type};base64,{base64_image}"
-            },
-        })
-    if audio_file:
-        processor = AudioProcessor()
-        mime_type = processor.get_audio_mime_type(audio_file.filename)
-        base64_audio = processor.audio_to_base64(audio_file)
-        message_content.append({
-            "type": "audio_url",
-            "audio_url": {
-                "url": f"data:{mime_type};base64,{base64_audio}"
+                "url": media["url"]
             },
         })
 
@@ -48,42 +42,103 @@ def create_multimodal_message(request: MessageRequest, image_file: UploadFile |
                 message_content.append({
                     "type": "image_url",
                     "image_url": {
-                        "url": block.content
+                        "url": await MediaStore.optimize_data_url(block.content, CHAT_MODEL)
+                    },
+                })
+            elif block.content.startswith(MEDIA_SCHEME):
+                message_content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": MediaStore.check_ref(block.content, "image")
                     },
                 })
         elif block.type == "audio":
             if block.content.startswith("data:audio"):
+                check_data_url_size(block.content, settings.AUDIO_DIRECT_MAX_BYTES, "音频")
                 message_content.append({
                     "type": "audio_url",
                     "audio_url": {
                         "url": block.content
                     },
                 })
+            elif block.content.startswith(MEDIA_SCHEME):
+                message_content.append({
+                    "type": "audio_url",
+                    "audio_url": {
+                        "url": MediaStore.check_ref(block.content, "audio")
+                    },
+                })
 
+    message = HumanMessage(content=message_content)
     if request.pdf_chunks:
-        pdf_content = "\n\n=== 参考文档内容 ===\n"
-        for i, chunk in enumerate(request.pdf_chunks):
-            content = chunk.get("content", "")
-            source_info = chunk.get("metadata", {}).get(
-                "source_info", f"文档块 {i}")
-            pdf_content += f"\n[{i}] {content}\n来源: {source_info}\n"
-        pdf_content += "\n请在回答时引用相关内容，使用格式如 [1]、[2] 等。\n"
-
-        for i in range(len(message_content) - 1, -1, -1):
-            item = message_content[i]
+        message, _ = attach_pdf_context(message, request.pdf_chunks)
+    return message
+
+
+def attach_pdf_context(message: HumanMessage, pdf_chunks: List[Dict[str, Any]], indices: List[int] = None,
+                       token_budget: int = None) -> Tuple[HumanMessage, Dict[int, Dict[str, Any]]]:
+    """
+    将PDF文档块作为参考内容追加到消息最后一个文本块，返回新消息（原消息不变）和引用编号映射
+    会话模式下原消息写入会话历史，带参考内容的新消息只用于本轮调用模型
+    indices 为检索选出的文档块序号（按相关度排列，默认全部），在 token_budget 内打包，
+    相邻的块合并、重叠文本去重，引用编号使用每段第一块在 pdf_chunks 中的序号
+    """
+    context, citations = pack_context(pdf_chunks, indices, token_budget)
+    pdf_content = "\n\n=== 参考文档内容 ===\n" + context
+    pdf_content += "\n请在回答时引用相关内容，使用格式如 [1]、[2] 等。\n"
+
+    message_content = [dict(item) for item in message.content]
+    for i in range(len(message_content) - 1, -1, -1):
+        item = message_content[i]
+        if item['type'] == 'text':
+            item['text'] += pdf_content
+            break
+
+    return HumanMessage(content=message_content), citations
+
+
+def attach_audio(message: HumanMessage, data_url: str = None, transcript: str = None) -> HumanMessage:
+    """
+    将处理后的音频附加到消息，返回新消息（原消息不变）
+    短音频以 data_url 放在图片之后、文本之前；长音频的转写文本追加到最后一个文本块
+    """
+    message_content = [dict(item) for item in message.content]
+    if data_url:
+        position = sum(1 for item in message_content if item['type'] == 'image_url')
+        message_content.insert(position, {"type": "audio_url", "audio_url": {"url": data_url}})
+    elif transcript is not None:
+        audio_content = f"\n\n=== 音频转写内容 ===\n{transcript or '（音频中没有识别到语音）'}\n"
+        for item in reversed(message_content):
             if item['type'] == 'text':
-                item['text'] += pdf_content
+                item['text'] += audio_content
                 break
-
+        else:
+            message_content.append({"type": "text", "text": "请根据下面的音频转写内容回答。" + audio_content})
     return HumanMessage(content=message_content)
 
 
-def convert_history_to_messages(history: List[Dict[str, Any]]) -> List[BaseMessage]:
-    """将历史记录转换为 LangChain 消息格式，支持多模态内容"""
-    messages = []
+def message_text(message: BaseMessage, placeholders: bool = True) -> str:
+    """
+    提取消息中的文本
+    :param placeholders: 媒体内容是否用占位符（[图片]、[音频]）表示，用作检索问题时不需要
+    """
+    if isinstance(message.content, str):
+        return message.content
+    parts = []
+    for item in message.content:
+        if isinstance(item, str):
+            parts.append(item)
+        elif item.get("type") == "text":
+            parts.append(item.get("text", ""))
+        elif placeholders and item.get("type") == "image_url":
+            parts.append("[图片]")
+        elif placeholders and item.get("type") == "audio_url":
+            parts.append("[音频]")
+    return "\n".join(parts)
 
-    # 添加系统消息
-    system_prompt = """
+
+# 系统提示词
+SYSTEM_PROMPT = """
         你是一个专业的多模态 RAG 助手，具备如下能：
         1. 与用户对话的能力。
         2. 图像内容识别和分析能力(OCR, 对象检测， 场景理解)
@@ -107,70 +162,193 @@ def convert_history_to_messages(history: List[Dict[str, Any]]) -> List[BaseMessa
         请以专业、准确、友好的方式回答，并严格遵循引用格式。当有参考文档时，优先使用文档内容回答。
     """
 
-    messages.append(SystemMessage(content=system_prompt))
+
+async def convert_history_to_messages(history: List[Dict[str, Any]],
+                                      system_prompt: str = SYSTEM_PROMPT) -> List[BaseMessage]:
+    """
+    将历史记录转换为 LangChain 消息格式，支持多模态内容
+    历史中的图片需要解码和预处理，媒体内容超过 MEDIA_OFFLOAD_BYTES 时整体放到线程中转换
+    """
+    media_size = sum(len(block.get("content", "")) for msg in history for block in msg.get("content_blocks", [])
+                     if block.get("type") in ("image", "audio"))
+    return await offload(media_size, _convert_history, history, system_prompt)
+
+
+def _convert_history(history: List[Dict[str, Any]], system_prompt: str) -> List[BaseMessage]:
+    # 添加系统消息
+    messages = [SystemMessage(content=system_prompt)]
 
     # 转换历史消息
-    for i, msg in enumerate(history):
-        content = msg.get("content", "")
-        content_blocks = msg.get("content_blocks", [])
-        message_content = []
-        if msg["role"] == "user":
-            for block in content_blocks:
-                if block.get("type") == "text":
+    for msg in history:
+        message = convert_turn(msg)
+        if message is not None:
+            messages.append(message)
+
+    return messages
+
+
+def convert_turn(msg: Dict[str, Any]) -> BaseMessage | None:
+    """转换单条历史记录（user/assistant），其他角色返回 None"""
+    content = msg.get("content", "")
+    content_blocks = msg.get("content_blocks", [])
+    message_content = []
+    if msg["role"] == "user":
+        for block in content_blocks:
+            if block.get("type") == "text":
+                message_content.append({
+                    "type": "text",
+                    "text": block.get("content", "")
+                })
+            elif block.get("type") == "image":
+                image_data = block.get("content", "")
+                if image_data.startswith("data:image"):
+                    # 历史中的图片每轮都会重新发送，同样预处理（命中缓存时只有一次 Redis 读取）
                     message_content.append({
-                        "type": "text",
-                        "text": block.get("content", "")
+                        "type": "image_url",
+                        "image_url": {
+                            "url": MediaStore.optimize_data_url_sync(image_data, CHAT_MODEL)
+                        }
                     })
-                elif block.get("type") == "image":
-                    image_data = block.get("content", "")
-                    if image_data.startswith("data:image"):
-                        message_content.append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_data
-                            }
-                        })
-                elif block.get("type") == "audio":
-                    audio_data = block.get("content", "")
-                    if audio_data.startswith("data:audio"):
-                        message_content.append({
-                            "type": "audio_url",
-                            "image_url": {
-                                "url": audio_data
-                            }
-                        })
-            messages.append(HumanMessage(content=message_content))
-        elif msg["role"] == "assistant":
-            messages.append(AIMessage(content=content))
+                elif image_data.startswith(MEDIA_SCHEME):
+                    # 媒体引用原样保留，调用模型前再展开；已被淘汰的替换为占位文本
+                    url = MediaStore.check_ref(image_data, "image", missing_ok=True)
+                    message_content.append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": url
+                        }
+                    } if url else MediaStore.expired_block("image"))
+            elif block.get("type") == "audio":
+                audio_data = block.get("content", "")
+                if audio_data.startswith("data:audio") or audio_data.startswith(MEDIA_SCHEME):
+                    url = MediaStore.check_ref(audio_data, "audio", missing_ok=True) \
+                        if audio_data.startswith(MEDIA_SCHEME) else audio_data
+                    message_content.append({
+                        "type": "audio_url",
+                        "audio_url": {
+                            "url": url
+                        }
+                    } if url else MediaStore.expired_block("audio"))
+        return HumanMessage(content=message_content)
+    elif msg["role"] == "assistant":
+        return AIMessage(content=content)
+    return None
 
-    return messages
 
+def _canonical_content(content: Any) -> Any:
+    """规范化消息内容：data URL 形式的媒体按解码后的字节内容计算哈希，而不是按 base64 文本"""
+    if isinstance(content, str):
+        if content.startswith("data:") and ";base64," in content:
+            header, payload = content.split(";base64,", 1)
+            try:
+                digest = hashlib.sha256(base64.b64decode(payload)).hexdigest()
+            except ValueError:
+                digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            return {"media": header[5:], "sha256": digest}
+        return content
+    if isinstance(content, list):
+        return [_canonical_content(item) for item in content]
+    if isinstance(content, dict):
+        return {key: _canonical_content(value) for key, value in content.items()}
+    return content
 
-def extract_references_from_content(content: str, pdf_chunks: list = None) -> list:
+
+def hash_messages(messages: List[BaseMessage], model_name: str = "") -> str:
+    """计算消息列表的规范化哈希（消息类型 + 内容 + 模型名），用于响应缓存与请求去重"""
+    canonical = [[message.type, _canonical_content(message.content)] for message in messages]
+    payload = json.dumps([model_name, canonical], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# 引用标记，如 [1]、[12]
+REFERENCE_PATTERN = re.compile(r'\[(\d+)\]')
+# 引用标记最大长度（"[" + 最多6位数字 + "]"），超过该长度的未闭合 "[" 不再跨块等待
+MAX_REFERENCE_MARKER_LEN = 8
+
+
+def build_reference(ref_num: int, chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """根据引用编号和对应的文档块构建引用信息"""
+    content = chunk.get("content", "")
+    metadata = chunk.get("metadata", {})
+    return {
+        "id": ref_num,
+        "text": content[:200] + "..." if len(content) > 200 else content,
+        "source": metadata.get("source", "未知来源"),
+        "page": metadata.get("page_number", 1),
+        "page_end": metadata.get("page_end", metadata.get("page_number", 1)),
+        "chunk_id": metadata.get("chunk_id", 0),
+        "source_info": metadata.get("source_info", "未知来源")
+    }
+
+
+def as_citations(pdf_chunks: List[Dict[str, Any]] | Dict[int, Dict[str, Any]] | None) -> Dict[int, Dict[str, Any]]:
+    """引用编号映射：文档块列表按序号编号，attach_pdf_context 返回的映射原样使用"""
+    if isinstance(pdf_chunks, dict):
+        return pdf_chunks
+    return dict(enumerate(pdf_chunks or []))
+
+
+def extract_references_from_content(content: str, pdf_chunks: list | dict = None) -> list:
     print('模型输出内容:',content)
     references = []
 
-    reference_pattern = r'[(\d+)]'
-    matches = re.findall(reference_pattern, content)
+    matches = REFERENCE_PATTERN.findall(content)
     print(matches)
 
-    if matches and pdf_chunks:
+    citations = as_citations(pdf_chunks)
+    if matches and citations:
+        seen = set()
         for match in matches:
             ref_num = int(match)
-            if ref_num <= len(pdf_chunks):
-                chunk = pdf_chunks[ref_num]  # 索引从0开始
-                reference = {
-                    "id": ref_num,
-                    "text": chunk.get("content", "")[:200] + "..." if len(
-                        chunk.get("content", "")) > 200 else chunk.get("content", ""),
-                    "source": chunk.get("metadata", {}).get("source", "未知来源"),
-                    "page": chunk.get("metadata", {}).get("page_number", 1),
-                    "chunk_id": chunk.get("metadata", {}).get("chunk_id", 0),
-                    "source_info": chunk.get("metadata", {}).get("source_info", "未知来源")
-                }
-                references.append(reference)
+            # 索引从0开始，与 attach_pdf_context 中的编号一致
+            if ref_num in citations and ref_num not in seen:
+                seen.add(ref_num)
+                references.append(build_reference(ref_num, citations[ref_num]))
 
     return references
 
 
+class CitationTracker:
+    """
+    增量引用追踪器
+    - 模型每输出一个增量就扫描一次，引用标记被拆在两个增量之间时（如 "[1" + "2]"）会暂存未闭合部分
+    - 每个有效的 [n] 只在第一次出现时返回引用信息，重复引用去重
+    - 完整回答保存在列表中，结束时只拼接一次
+    """
+
+    def __init__(self, pdf_chunks: List[Dict[str, Any]] | Dict[int, Dict[str, Any]] = None):
+        # 引用编号 -> 文档块
+        self.citations = as_citations(pdf_chunks)
+        self.references: List[Dict[str, Any]] = []
+        self._parts: List[str] = []
+        self._carry = ""
+        self._seen = set()
+
+    def feed(self, delta: str) -> List[Dict[str, Any]]:
+        """写入一个增量，返回本次新出现的引用"""
+        self._parts.append(delta)
+        if not self.citations:
+            return []
+
+        text = self._carry + delta
+        new_references = []
+        for match in REFERENCE_PATTERN.finditer(text):
+            ref_num = int(match.group(1))
+            if ref_num in self.citations and ref_num not in self._seen:
+                self._seen.add(ref_num)
+                reference = build_reference(ref_num, self.citations[ref_num])
+                self.references.append(reference)
+                new_references.append(reference)
+
+        # 暂存末尾未闭合的引用标记，等待下一个增量
+        index = text.rfind("[")
+        tail = text[index:] if index != -1 else ""
+        if tail and len(tail) < MAX_REFERENCE_MARKER_LEN and (tail == "[" or tail[1:].isdigit()):
+            self._carry = tail
+        else:
+            self._carry = ""
+        return new_references
 
+    def full_text(self) -> str:
+        """拼接完整回答"""
+        return "".join(self._parts)
@@ -1,20 +1,144 @@
+import logging
+import os
+from typing import AsyncGenerator, Dict, List, Tuple
+
+import anyio
+import httpx
 from fastapi import HTTPException
 from langchain.chat_models import init_chat_model
-import os
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+
+from config.settings import settings
+
+logger = logging.getLogger("model_service")
+logger.setLevel(logging.INFO)
+
+# 服务商配置：base_url、API Key 环境变量、init_chat_model 的 model_provider
+PROVIDERS = {
+    "dashscope": {
+        "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",  # 百炼兼容OpenAI的固定地址
+        "api_key_env": "DASHSCOPE_API_KEY",
+        "model_provider": "openai",  # 百炼兼容 openai 协议，必须显式指定
+    },
+    "deepseek": {
+        "base_url": "https://api.deepseek.com",
+        "api_key_env": "DEEPSEEK_API_KEY",
+        "model_provider": None,  # 由模型名 deepseek-chat 自动推断
+    },
+}
+
+CHAT_PROVIDER = "dashscope"
+CHAT_MODEL = "qwen3-omni-flash"
+DEEPSEEK_MODEL = "deepseek-chat"
+DASHSCOPE_MODEL = "qwen-max"
+
+# 启动时预先初始化的模型
+PRELOAD_MODELS = [("dashscope", CHAT_MODEL), ("deepseek", DEEPSEEK_MODEL)]
+
+
+class ModelRegistry:
+    """
+    进程级模型注册表
+    - 每个服务商持有一个长连接（keep-alive）的 httpx.AsyncClient，所有模型共享连接池
+    - 每个 (服务商, 模型) 只初始化一次，避免每次请求重新建连、重新 TLS 握手
+    - 在 FastAPI lifespan 中启动（预热连接）和关闭（释放连接池）
+    """
+
+    def __init__(self):
+        self._models: Dict[Tuple[str, str], BaseChatModel] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _get_client(self, provider: str) -> httpx.AsyncClient:
+        """获取服务商共享的异步 HTTP 客户端（懒加载）"""
+        client = self._clients.get(provider)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings.MODEL_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.MODEL_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=settings.MODEL_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(settings.MODEL_HTTP_TIMEOUT, connect=settings.MODEL_CONNECT_TIMEOUT),
+            )
+            self._clients[provider] = client
+        return client
+
+    def get_model(self, provider: str, model_name: str) -> BaseChatModel:
+        """获取 (服务商, 模型) 对应的模型实例，不存在时初始化并缓存"""
+        key = (provider, model_name)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        if provider not in PROVIDERS:
+            raise ValueError(f"未知的模型服务商: {provider}")
+        config = PROVIDERS[provider]
+        kwargs = {
+            "model": model_name,
+            "base_url": config["base_url"],
+            "api_key": os.getenv(config["api_key_env"]),
+            "http_async_client": self._get_client(provider),
+        }
+        if config["model_provider"]:
+            kwargs["model_provider"] = config["model_provider"]
+
+        model = init_chat_model(**kwargs)
+        self._models[key] = model
+        logger.info(f"模型初始化成功: {provider}/{model_name}")
+        return model
+
+    async def startup(self):
+        """启动时初始化常用模型，并按配置预先建立连接"""
+        for provider, model_name in PRELOAD_MODELS:
+            try:
+                self.get_model(provider, model_name)
+            except Exception as e:
+                logger.error(f"模型预加载失败 {provider}/{model_name}: {str(e)}", exc_info=True)
+
+        if settings.MODEL_WARMUP:
+            for provider in {provider for provider, _ in PRELOAD_MODELS}:
+                await self._warmup(provider)
+
+    async def _warmup(self, provider: str):
+        """请求一次 /models，让连接池中提前建立好 TCP + TLS 连接"""
+        config = PROVIDERS[provider]
+        api_key = os.getenv(config["api_key_env"])
+        try:
+            await self._get_client(provider).get(
+                f"{config['base_url']}/models",
+                headers={"Authorization": f"Bearer {api_key}"} if api_key else None,
+            )
+            logger.info(f"模型连接预热完成: {provider}")
+        except Exception as e:
+            # 预热失败不影响启动，首个请求时会重新建连
+            logger.warning(f"模型连接预热失败 {provider}: {str(e)}")
+
+    async def shutdown(self):
+        """关闭所有服务商的连接池"""
+        for provider, client in self._clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"关闭模型连接池失败 {provider}: {str(e)}")
+        self._clients.clear()
+        self._models.clear()
+        logger.info("模型连接池已关闭")
+
+
+# 单例实例（全局唯一）
+model_registry = ModelRegistry()
+
 
 async def build_deepseek_model():
     """构建 DeepSeek 模型实例（封装模型初始化逻辑）"""
     try:
         '''
-            构建并返回一个deepseek模型实例。
+            返回注册表中共享的deepseek模型实例。
             统一配置模型参数，方便全局复用。
             :return:
             '''
-        return init_chat_model(
-            model="deepseek-chat",
-            base_url="https://api.deepseek.com",
-            api_key=os.getenv("DEEPSEEK_API_KEY")
-        )
+        return model_registry.get_model("deepseek", DEEPSEEK_MODEL)
     except Exception as e:
         raise Exception(f"模型初始化失败：{str(e)}")
 
@@ -27,27 +151,28 @@ async def get_chat_model():
     :return: BaseChatModel 实例
     '''
     try:
-        model = init_chat_model(
-            model="qwen3-omni-flash",
-            model_provider="openai",
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-            api_key=os.getenv("DASHSCOPE_API_KEY"),
-        )
-        return model
+        return model_registry.get_model("dashscope", CHAT_MODEL)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"模型初始化失败: {str(e)}")
 
-async def build_dashscope_model():
+async def build_dashscope_model(model_name: str = DASHSCOPE_MODEL):
     '''
-    构建并返回一个百炼模型实例。
+    返回注册表中共享的百炼模型实例。
     统一配置模型参数，方便全局复用。
-    这里将openai设置服务商，因为百炼兼容且必须设置
+    :param model_name: 百炼模型名（qwen-turbo/qwen-plus/qwen-max）
     :return: BaseChatModel 实例
     '''
-    return init_chat_model(
-        model="qwen-max",  # 百炼模型名（qwen-turbo/qwen-plus/qwen-max）
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",  # 百炼兼容OpenAI的固定地址
-        api_key=os.getenv("DASHSCOPE_API_KEY"),  # 你的百炼API_KEY环境变量
-        model_provider="openai"  # 关键：显式指定提供商（必加，否则报错）
-    )
+    return model_registry.get_model("dashscope", model_name)
+
 
+async def stream_model_text(model: BaseChatModel, messages: List[BaseMessage]) -> AsyncGenerator[str, None]:
+    """逐块产出模型输出的文本增量，关闭生成器时同时关闭上游流（归还连接池中的连接）"""
+    # model.astream内部也是利用yield异步生成器，async for 会逐次获取模型的输出块
+    stream = model.astream(messages)
+    try:
+        async for chunk in stream:
+            if hasattr(chunk, 'content') and chunk.content:
+                yield chunk.content
+    finally:
+        with anyio.CancelScope(shield=True):
+            await stream.aclose()
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from typing import List, Dict, Tuple
+
+from langchain.messages import HumanMessage
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+from services.admission_service import admission
+from services.model_service import model_registry, stream_model_text
+from utils.media_utils import to_data_url
+
+logger = logging.getLogger("ocr_service")
+logger.setLevel(logging.INFO)
+
+OCR_PROMPT = """下面依次是一份 PDF 文档第 {pages} 页的扫描图片。
+请逐页识别图片中的全部文字，保持原有的段落和阅读顺序，不要翻译、总结或补充内容。
+每页的结果以单独一行「=== 第N页 ===」开头（N 为上面给出的页码），没有文字的页面只输出该标题行。"""
+
+PAGE_HEADER = re.compile(r'^=== 第(\d+)页 ===\s*$', re.MULTILINE)
+
+
+class PageOCR:
+    """
+    扫描页 OCR
+    - 多页合并成一次视觉模型调用，批次之间并发执行（受 PDF_OCR_CONCURRENCY 和准入控制限制）
+    - 识别结果按页面图片哈希缓存在 Redis，相同页面只识别一次
+    """
+
+    @staticmethod
+    async def transcribe(images: List[Tuple[int, bytes]]) -> Dict[int, str]:
+        """
+        识别页面图片中的文字
+
+        Args:
+            images: [(页序号, 图片字节)]，页序号从 0 开始
+
+        Returns:
+            {页序号: 文本}，识别失败的页面不包含在结果中
+        """
+        results: Dict[int, str] = {}
+        pending = []
+        for page_num, data in images:
+            cache_key = constant.PDF_OCR_CACHE.format(hashlib.sha256(data).hexdigest())
+            cached = redis_client.get_object(cache_key)
+            if cached is not None:
+                results[page_num] = cached
+            else:
+                pending.append((page_num, data, cache_key))
+        metrics.incr("pdf_ocr_pages_total", len(images) - len(pending), result="cached")
+
+        batch_size = max(1, settings.PDF_OCR_BATCH_PAGES)
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        semaphore = asyncio.Semaphore(settings.PDF_OCR_CONCURRENCY)
+
+        async def run(batch: List[Tuple[int, bytes, str]]):
+            async with semaphore:
+                texts = await PageOCR._transcribe_batch(batch)
+            for page_num, _, cache_key in batch:
+                if page_num in texts:
+                    results[page_num] = texts[page_num]
+                    redis_client.set_object(cache_key, texts[page_num], ex=settings.PDF_OCR_CACHE_TTL)
+
+        await asyncio.gather(*[run(batch) for batch in batches])
+        return results
+
+    @staticmethod
+    async def _transcribe_batch(batch: List[Tuple[int, bytes, str]]) -> Dict[int, str]:
+        """调用视觉模型识别一批页面，失败时返回空结果（这些页面保持无文字）"""
+        mime = "image/webp" if settings.PDF_OCR_IMAGE_FORMAT == "webp" else "image/jpeg"
+        page_labels = [page_num + 1 for page_num, _, _ in batch]
+        content = [{"type": "text", "text": OCR_PROMPT.format(pages="、".join(map(str, page_labels)))}]
+        for _, data, _ in batch:
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": await to_data_url(data, mime)},
+            })
+
+        started = time.monotonic()
+        try:
+            model = model_registry.get_model("dashscope", settings.PDF_OCR_MODEL)
+            async with admission.slot("dashscope"):
+                output = "".join([delta async for delta in stream_model_text(model, [HumanMessage(content=content)])])
+        except Exception as e:
+            logger.warning(f"扫描页识别失败（第 {page_labels} 页）: {str(e)}")
+            metrics.incr("pdf_ocr_pages_total", len(batch), result="error")
+            return {}
+        metrics.observe("pdf_ocr_batch_seconds", time.monotonic() - started)
+        metrics.incr("pdf_ocr_pages_total", len(batch), result="recognized")
+
+        return PageOCR._split_pages(output, page_labels)
+
+    @staticmethod
+    def _split_pages(output: str, page_labels: List[int]) -> Dict[int, str]:
+        """按「=== 第N页 ===」标题拆分模型输出；只有一页且没有标题时整段作为该页文本"""
+        headers = list(PAGE_HEADER.finditer(output))
+        if not headers:
+            return {page_labels[0] - 1: output.strip()} if len(page_labels) == 1 else {}
+
+        texts = {}
+        for i, header in enumerate(headers):
+            page_label = int(header.group(1))
+            if page_label not in page_labels:
+                continue
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(output)
+            texts[page_label - 1] = output[header.end():end].strip()
+        return texts
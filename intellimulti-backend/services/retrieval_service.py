@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import logging
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+from services.vector_service import VectorRetriever
+from utils.bm25_utils import BM25Index
+
+# 倒数排名融合（RRF）的平滑常数
+RRF_K = 60
+
+logger = logging.getLogger("retrieval_service")
+logger.setLevel(logging.INFO)
+
+
+class ChunkRetriever:
+    """
+    PDF 文档块检索
+    - 按文档哈希构建 BM25 倒排索引，持久化到 Redis，同一文档只构建一次
+    - 最近使用的索引同时保留在进程内，避免重复反序列化
+    - 开启向量检索时与向量检索结果按排名融合，可选 MMR 去除内容重复的结果
+    - 每轮只把与当前问题最相关的 top-k 个文档块放进提示词
+    """
+
+    _local: "OrderedDict[str, BM25Index]" = OrderedDict()
+
+    @staticmethod
+    async def select_many(documents: List[Tuple[Optional[str], List[Dict[str, Any]]]],
+                          query: str) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """
+        在多个文档中选出与问题最相关的文档块
+
+        Args:
+            documents: [(文档哈希, 文档块列表)]
+            query: 当前问题
+
+        Returns:
+            (按文档顺序拼接的全部文档块, 选中的文档块在拼接列表中的序号，按相关度从高到低排列)
+        """
+        pdf_chunks = [chunk for _, chunks in documents for chunk in chunks]
+        top_k = settings.RETRIEVAL_TOP_K
+        if not settings.RETRIEVAL_ENABLED or len(pdf_chunks) <= top_k:
+            return pdf_chunks, list(range(len(pdf_chunks)))
+
+        started = time.monotonic()
+        # 开启向量检索时两路各取更多候选，融合后再选 top-k
+        limit = max(top_k, settings.VECTOR_CANDIDATES) if settings.VECTOR_ENABLED else top_k
+        hits = []
+        offset = 0
+        for document_hash, chunks in documents:
+            if chunks:
+                index = await ChunkRetriever._get_index(document_hash, chunks)
+                hits.extend((offset + doc_id, score) for doc_id, score in index.search(
+                    query, limit, k1=settings.RETRIEVAL_BM25_K1, b=settings.RETRIEVAL_BM25_B))
+            offset += len(chunks)
+        # 各文档的 BM25 得分基于各自的统计量，直接按得分合并取全局 top-k
+        hits = heapq.nlargest(limit, hits, key=lambda item: item[1])
+        if settings.VECTOR_ENABLED:
+            # 向量检索补充字面不匹配的相关内容（同义改写的问题），与 BM25 结果按排名融合
+            query_vector = await VectorRetriever.embed_query(query)
+            dense_hits = await VectorRetriever.search(documents, query_vector, limit)
+            hits = ChunkRetriever._fuse([hits, dense_hits])
+            if settings.VECTOR_MMR_ENABLED and len(hits) > top_k:
+                hits = [(doc_id, 0.0) for doc_id in
+                        await VectorRetriever.diversify(documents, query_vector, hits, top_k)]
+        if hits:
+            indices = [doc_id for doc_id, _ in hits[:top_k]]
+        else:
+            # 问题与文档没有共同词项（如"总结一下"），使用文档开头的文档块
+            indices = list(range(top_k))
+        metrics.observe("retrieval_seconds", time.monotonic() - started)
+        metrics.incr("retrieval_total", result="hit" if hits else "fallback")
+        logger.info(f"文档块检索: 共 {len(pdf_chunks)} 块，选中 {indices}")
+        return pdf_chunks, indices
+
+    @staticmethod
+    def _fuse(rankings: List[List[Tuple[int, float]]]) -> List[Tuple[int, float]]:
+        """倒数排名融合：得分 = Σ 1 / (RRF_K + 排名)，不依赖各路得分的量纲"""
+        scores: Dict[int, float] = {}
+        for ranking in rankings:
+            for rank, (doc_id, _) in enumerate(ranking):
+                scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    @staticmethod
+    async def _get_index(document_hash: Optional[str], pdf_chunks: List[Dict[str, Any]]) -> BM25Index:
+        """获取文档的索引：进程内缓存 -> Redis -> 重新构建"""
+        if document_hash:
+            index = ChunkRetriever._local.get(document_hash)
+            if index is not None:
+                ChunkRetriever._local.move_to_end(document_hash)
+                return index
+
+            data = redis_client.cache_get_bytes(constant.PDF_BM25_INDEX, document_hash, ex=settings.PDF_CACHE_TTL)
+            if data:
+                try:
+                    index = BM25Index.from_bytes(data)
+                except (zlib.error, ValueError, struct.error) as e:
+                    logger.warning(f"BM25 索引损坏，重新构建: {str(e)}")
+                    index = None
+                if index is not None and len(index) == len(pdf_chunks):
+                    ChunkRetriever._remember(document_hash, index)
+                    return index
+
+        # 构建索引是纯 CPU 计算，放到线程中执行
+        index = await asyncio.to_thread(BM25Index.build, [chunk.get("content", "") for chunk in pdf_chunks])
+        if document_hash:
+            redis_client.cache_set_bytes(
+                constant.PDF_BM25_INDEX,
+                document_hash,
+                index.to_bytes(),
+                ex=settings.PDF_CACHE_TTL,
+                max_entries=settings.PDF_CACHE_MAX_ENTRIES,
+            )
+            ChunkRetriever._remember(document_hash, index)
+        return index
+
+    @staticmethod
+    def _remember(document_hash: str, index: BM25Index):
+        ChunkRetriever._local[document_hash] = index
+        ChunkRetriever._local.move_to_end(document_hash)
+        while len(ChunkRetriever._local) > settings.RETRIEVAL_LOCAL_INDEXES:
+            ChunkRetriever._local.popitem(last=False)
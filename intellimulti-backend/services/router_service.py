@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import anyio
+from langchain_core.messages import BaseMessage
+
+from common.metrics import metrics
+from config.settings import settings
+from services.admission_service import admission, AdmissionRejected
+from services.model_service import model_registry, stream_model_text, CHAT_PROVIDER, CHAT_MODEL
+
+logger = logging.getLogger("router_service")
+logger.setLevel(logging.INFO)
+
+# 端点：(服务商, 模型名)
+Endpoint = Tuple[str, str]
+
+
+def _endpoint_name(endpoint: Endpoint) -> str:
+    return f"{endpoint[0]}/{endpoint[1]}"
+
+
+def _is_multimodal(messages: List[BaseMessage]) -> bool:
+    """消息中是否包含图片、音频（纯文本降级模型无法处理）"""
+    for message in messages:
+        if isinstance(message.content, list):
+            for item in message.content:
+                if isinstance(item, dict) and item.get("type") in ("image_url", "audio_url"):
+                    return True
+    return False
+
+
+class _EndpointStats:
+    """端点近期调用结果，用于计算错误率"""
+
+    def __init__(self):
+        self.results: deque = deque(maxlen=settings.ROUTER_STATS_WINDOW)  # (时间, 是否成功)
+
+    def record(self, ok: bool):
+        self.results.append((time.monotonic(), ok))
+
+    def error_rate(self) -> Tuple[float, int]:
+        """返回 (错误率, 统计窗口内的样本数)"""
+        horizon = time.monotonic() - settings.ROUTER_STATS_SECONDS
+        recent = [ok for at, ok in self.results if at >= horizon]
+        if not recent:
+            return 0.0, 0
+        return 1 - sum(recent) / len(recent), len(recent)
+
+
+class _Attempt:
+    """
+    一次上游调用：等待首个增量的任务 + 上游流
+    获得准入名额后才开始计时（admitted 的结果），排队时间不计入 TTFT 和对冲截止时间
+    """
+
+    def __init__(self, endpoint: Endpoint, factory: Callable[[], AsyncIterator[str]]):
+        self.endpoint = endpoint
+        self.admitted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.stream = admission.guarded_stream(endpoint[0], lambda: self._admit(factory))
+        self.first: asyncio.Task = asyncio.ensure_future(self.stream.__anext__())
+        self.failed = False
+
+    def _admit(self, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """在准入名额内创建上游流时调用，记录开始时间"""
+        if not self.admitted.done():
+            self.admitted.set_result(time.monotonic())
+        return factory()
+
+    @property
+    def started(self) -> Optional[float]:
+        return self.admitted.result() if self.admitted.done() else None
+
+    async def close(self):
+        """取消并关闭上游流（归还准入名额和连接）"""
+        with anyio.CancelScope(shield=True):
+            if not self.first.done():
+                self.first.cancel()
+            await asyncio.gather(self.first, return_exceptions=True)
+            await self.stream.aclose()
+
+
+class ModelRouter:
+    """
+    基于延迟的多端点路由
+    - 记录每个端点近期的首 token 时延（TTFT）和错误率
+    - 主端点获得准入名额后，在 TTFT 分位数截止时间内还没有输出首 token 时发起一次对冲请求，先出首 token 的一方胜出，
+      另一方被取消；优先对冲到未降级的降级端点，没有时向同一端点发送重复请求（ROUTER_HEDGE_SAME_ENDPOINT）
+    - 主端点错误率过高（降级）时，纯文本请求改走更便宜的降级模型（如 qwen-turbo）
+    - 首 token 之前失败时自动切换到降级模型重试一次
+    - 路由决策、TTFT、错误都记录到 metrics；准入拒绝（本地排队已满）不计入端点错误率
+    """
+
+    def __init__(self, primary: Endpoint, fallback: Optional[Endpoint],
+                 multimodal_fallback: Optional[Endpoint] = None):
+        self.primary = primary
+        self.fallback = fallback
+        self.multimodal_fallback = multimodal_fallback
+        self._stats: Dict[Endpoint, _EndpointStats] = {}
+
+    def _stats_for(self, endpoint: Endpoint) -> _EndpointStats:
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            stats = _EndpointStats()
+            self._stats[endpoint] = stats
+        return stats
+
+    def is_degraded(self, endpoint: Endpoint) -> bool:
+        error_rate, samples = self._stats_for(endpoint).error_rate()
+        return samples >= settings.ROUTER_MIN_SAMPLES and error_rate >= settings.ROUTER_DEGRADED_ERROR_RATE
+
+    def hedge_delay(self, endpoint: Endpoint) -> float:
+        """对冲截止时间：端点 TTFT 的分位数，限制在配置的上下限之间"""
+        ttft = metrics.percentile("router_ttft_seconds", settings.ROUTER_HEDGE_PERCENTILE,
+                                  default=settings.ROUTER_HEDGE_DEFAULT_DELAY, endpoint=_endpoint_name(endpoint))
+        return min(max(ttft, settings.ROUTER_HEDGE_MIN_DELAY), settings.ROUTER_HEDGE_MAX_DELAY)
+
+    def _fallback_for(self, multimodal: bool) -> Optional[Endpoint]:
+        """降级端点（纯文本降级模型无法处理图片、音频，多模态请求使用单独配置的降级模型）"""
+        return self.multimodal_fallback if multimodal else self.fallback
+
+    def _hedge_target(self, running: Endpoint, multimodal: bool) -> Optional[Endpoint]:
+        """对冲端点：与正在调用的端点不同且未降级的降级端点；没有时为正在调用的端点本身（重复请求），关闭时返回 None"""
+        fallback = self._fallback_for(multimodal)
+        if fallback and fallback != running and not self.is_degraded(fallback):
+            return fallback
+        if settings.ROUTER_HEDGE_SAME_ENDPOINT and not self.is_degraded(running):
+            return running
+        return None
+
+    def _select_primary(self, multimodal: bool) -> Endpoint:
+        fallback = self._fallback_for(multimodal)
+        if fallback and self.is_degraded(self.primary) and not self.is_degraded(fallback):
+            self._decision("degraded_fallback", fallback)
+            return fallback
+        return self.primary
+
+    def _start(self, endpoint: Endpoint, messages: List[BaseMessage]) -> _Attempt:
+        model = model_registry.get_model(*endpoint)
+        return _Attempt(endpoint, lambda: stream_model_text(model, messages))
+
+    def _record(self, endpoint: Endpoint, ok: bool):
+        self._stats_for(endpoint).record(ok)
+        if not ok:
+            metrics.incr("router_errors_total", endpoint=_endpoint_name(endpoint))
+
+    @staticmethod
+    def _decision(decision: str, endpoint: Endpoint):
+        metrics.incr("router_decision_total", decision=decision, endpoint=_endpoint_name(endpoint))
+
+    async def stream(self, messages: List[BaseMessage]) -> AsyncGenerator[str, None]:
+        """流式调用：对冲 + 降级，产出胜出端点的文本增量"""
+        multimodal = _is_multimodal(messages)
+        primary = self._select_primary(multimodal)
+        deadline = self.hedge_delay(primary)
+        attempts = [self._start(primary, messages)]
+        hedged = not (settings.ROUTER_ENABLED and settings.ROUTER_HEDGE_ENABLED)
+        fallback_tried = primary != self.primary
+        winner: Optional[_Attempt] = None
+        hedge: Optional[_Attempt] = None
+        first_delta: Optional[str] = None  # None 表示上游没有任何输出
+        last_error: Optional[BaseException] = None
+
+        try:
+            while winner is None:
+                pending = {attempt.first: attempt for attempt in attempts if not attempt.failed}
+                if not pending:
+                    # 所有调用都在首 token 前失败，切换到降级模型重试一次
+                    fallback = self._fallback_for(multimodal)
+                    if fallback is None or fallback_tried or isinstance(last_error, AdmissionRejected):
+                        # 准入拒绝是本地排队已满，降级模型使用同一服务商的名额，重试只会再排一次队
+                        raise last_error
+                    fallback_tried = True
+                    self._decision("error_fallback", fallback)
+                    attempts.append(self._start(fallback, messages))
+                    continue
+
+                timeout = None
+                waiters = set(pending)
+                if not hedged:
+                    if attempts[0].started is not None:
+                        timeout = max(0.0, deadline - (time.monotonic() - attempts[0].started))
+                    else:
+                        # 主端点还在排队，获得名额后才开始计算截止时间
+                        waiters.add(attempts[0].admitted)
+                done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 主端点超过截止时间仍无首 token，发起对冲请求
+                    hedged = True
+                    target = self._hedge_target(primary, multimodal)
+                    if target is None:
+                        self._decision("hedge_skipped", primary)
+                        continue
+                    self._decision("hedge", target)
+                    hedge = self._start(target, messages)
+                    attempts.append(hedge)
+                    continue
+
+                for task in done:
+                    attempt = pending.get(task)
+                    if attempt is None:
+                        # 主端点获得名额，下一轮按截止时间等待
+                        continue
+                    try:
+                        first_delta = task.result()
+                    except StopAsyncIteration:
+                        first_delta = None
+                    except Exception as e:
+                        attempt.failed = True
+                        last_error = e
+                        if not isinstance(e, AdmissionRejected):
+                            self._record(attempt.endpoint, ok=False)
+                        logger.warning(f"模型调用失败 {_endpoint_name(attempt.endpoint)}: {str(e)}")
+                        continue
+                    winner = attempt
+                    break
+
+            metrics.observe("router_ttft_seconds", time.monotonic() - winner.started,
+                            endpoint=_endpoint_name(winner.endpoint))
+            if winner is attempts[0]:
+                self._decision("primary_win", winner.endpoint)
+            else:
+                self._decision("hedge_win" if winner is hedge else "fallback_win", winner.endpoint)
+            # 取消落败的调用
+            for attempt in attempts:
+                if attempt is not winner:
+                    await attempt.close()
+
+            if first_delta is not None:
+                yield first_delta
+                async for delta in winner.stream:
+                    yield delta
+            self._record(winner.endpoint, ok=True)
+        except Exception as e:
+            if winner is not None and not isinstance(e, AdmissionRejected):
+                self._record(winner.endpoint, ok=False)
+            raise
+        finally:
+            for attempt in attempts:
+                await attempt.close()
+
+    async def invoke(self, messages: List[BaseMessage]):
+        """同步调用：主端点降级或失败时切换到降级模型"""
+        multimodal = _is_multimodal(messages)
+        primary = self._select_primary(multimodal)
+        endpoints = [primary]
+        fallback = self._fallback_for(multimodal)
+        if fallback and fallback != primary:
+            endpoints.append(fallback)
+
+        last_error = None
+        for endpoint in endpoints:
+            model = model_registry.get_model(*endpoint)
+            try:
+                async with admission.slot(endpoint[0]):
+                    started = time.monotonic()
+                    response = await model.ainvoke(messages)
+            except AdmissionRejected:
+                # 本地排队已满，不计入端点错误率，也不用同一服务商的降级模型重试
+                raise
+            except Exception as e:
+                self._record(endpoint, ok=False)
+                last_error = e
+                if endpoint is not endpoints[-1]:
+                    self._decision("error_fallback", endpoints[-1])
+                continue
+            self._record(endpoint, ok=True)
+            metrics.observe("router_latency_seconds", time.monotonic() - started, endpoint=_endpoint_name(endpoint))
+            return response
+        raise last_error
+
+    def snapshot(self) -> Dict[str, dict]:
+        """各端点的路由状态"""
+        result = {}
+        endpoints = {self.primary, *self._stats.keys()}
+        endpoints.update(endpoint for endpoint in (self.fallback, self.multimodal_fallback) if endpoint)
+        for endpoint in endpoints:
+            error_rate, samples = self._stats_for(endpoint).error_rate()
+            result[_endpoint_name(endpoint)] = {
+                "error_rate": round(error_rate, 4),
+                "samples": samples,
+                "degraded": self.is_degraded(endpoint),
+                "hedge_delay": round(self.hedge_delay(endpoint), 3),
+            }
+        return result
+
+
+def _fallback_endpoint(model_name: str) -> Optional[Endpoint]:
+    return (CHAT_PROVIDER, model_name) if settings.ROUTER_ENABLED and model_name else None
+
+
+# 聊天路由（单例）：主模型 qwen3-omni-flash，纯文本降级模型默认 qwen-turbo
+chat_router = ModelRouter(
+    primary=(CHAT_PROVIDER, CHAT_MODEL),
+    fallback=_fallback_endpoint(settings.ROUTER_FALLBACK_MODEL),
+    multimodal_fallback=_fallback_endpoint(settings.ROUTER_MULTIMODAL_FALLBACK_MODEL),
+)
@@ -0,0 +1,87 @@
+import json
+import uuid
+from datetime import datetime
+from typing import List, Dict, Any
+
+from fastapi import HTTPException
+from langchain.messages import SystemMessage
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+from common import constant
+from common.redis_client import redis_client
+from config.settings import settings
+from services.media_service import MediaStore
+from services.message_service import SYSTEM_PROMPT, convert_turn
+
+
+class SessionService:
+    """
+    服务端会话（存储在 Redis）
+    - 元信息：系统提示词、创建时间
+    - 消息列表：已转换好的 LangChain 消息，每条消息一个列表元素，追加时无需重写整段历史
+    - 图片、音频以 media:// 引用保存（见 MediaStore），会话本身不保存 base64
+    客户端每轮只需发送新内容，不必重复上传整段历史（含图片、音频）
+    """
+
+    @staticmethod
+    def create_session(system_prompt: str | None = None) -> str:
+        """创建会话，返回 session_id"""
+        session_id = uuid.uuid4().hex
+        meta = {
+            "system_prompt": system_prompt or SYSTEM_PROMPT,
+            "created_at": datetime.now().isoformat(),
+        }
+        if not redis_client.set_dict(constant.SESSION_META.format(session_id), meta, ex=settings.SESSION_TTL):
+            raise HTTPException(status_code=500, detail="会话创建失败")
+        return session_id
+
+    @staticmethod
+    def get_meta(session_id: str) -> Dict[str, Any]:
+        """获取会话元信息，会话不存在时返回 404"""
+        meta = redis_client.get_dict(constant.SESSION_META.format(session_id))
+        if not meta:
+            raise HTTPException(status_code=404, detail=f"会话不存在或已过期: {session_id}")
+        return meta
+
+    @staticmethod
+    def load_messages(session_id: str) -> List[BaseMessage]:
+        """加载会话的完整消息列表（系统提示词 + 历史消息）"""
+        meta = SessionService.get_meta(session_id)
+        stored = redis_client.lrange(constant.SESSION_MESSAGES.format(session_id))
+        messages: List[BaseMessage] = [SystemMessage(content=meta["system_prompt"])]
+        messages.extend(messages_from_dict([json.loads(item) for item in stored]))
+        SessionService._touch(session_id)
+        return messages
+
+    @staticmethod
+    def append_messages(session_id: str, messages: List[BaseMessage]) -> int:
+        """追加已转换的消息，返回会话中的消息条数"""
+        if not messages:
+            return redis_client.llen(constant.SESSION_MESSAGES.format(session_id))
+        values = [json.dumps(message_to_dict(message), ensure_ascii=False) for message in messages]
+        count = redis_client.rpush(constant.SESSION_MESSAGES.format(session_id), *values)
+        if count is None:
+            raise HTTPException(status_code=500, detail="会话消息写入失败")
+        # 会话存在期间，其中引用的图片、音频不会被媒体存储淘汰
+        MediaStore.acquire(constant.SESSION_META.format(session_id), MediaStore.references(messages))
+        SessionService._touch(session_id)
+        return count
+
+    @staticmethod
+    def append_turns(session_id: str, turns: List[Dict[str, Any]]) -> int:
+        """追加客户端格式的历史记录（与 history 字段格式相同）"""
+        SessionService.get_meta(session_id)
+        messages = [message for message in (convert_turn(turn) for turn in turns) if message is not None]
+        return SessionService.append_messages(session_id, messages)
+
+    @staticmethod
+    def delete_session(session_id: str) -> bool:
+        """删除会话"""
+        return redis_client.delete(constant.SESSION_META.format(session_id),
+                                   constant.SESSION_MESSAGES.format(session_id)) > 0
+
+    @staticmethod
+    def _touch(session_id: str):
+        """刷新会话过期时间"""
+        redis_client.expire(constant.SESSION_META.format(session_id), settings.SESSION_TTL)
+        redis_client.expire(constant.SESSION_MESSAGES.format(session_id), settings.SESSION_TTL)
@@ -0,0 +1,381 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+import anyio
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+
+logger = logging.getLogger("singleflight_service")
+logger.setLevel(logging.INFO)
+
+# 当前进程标识（写入 Redis 租约，便于排查）
+WORKER_ID = uuid.uuid4().hex
+
+
+# 没有跨进程跟随者时，检查跟随者是否出现的间隔（秒）
+_FOLLOWER_CHECK_INTERVAL = 1.0
+
+
+class _LeaderLost(Exception):
+    """跨进程领导者在产生任何增量之前消失（崩溃或租约过期），跟随者可以自行生成"""
+
+
+class _RemoteListener:
+    """
+    本进程共享的跨进程订阅
+    一个后台线程按模式订阅所有 single-flight 频道，按频道把消息转发到各跟随者的 asyncio 队列，
+    跟随者在事件循环中等待队列，不必每个跟随者占用一个线程
+    订阅生效之前发布的消息由跟随者从日志补齐
+    """
+
+    def __init__(self):
+        self._queues: Dict[str, Set[asyncio.Queue]] = {}
+        self._started: Optional[asyncio.Future] = None
+
+    async def subscribe(self, channel: str) -> asyncio.Queue:
+        """登记频道的接收队列，首次调用时启动订阅线程"""
+        queue = asyncio.Queue()
+        self._queues.setdefault(channel, set()).add(queue)
+        try:
+            if self._started is None:
+                self._started = asyncio.ensure_future(asyncio.to_thread(self._start, asyncio.get_running_loop()))
+            await asyncio.shield(self._started)
+        except BaseException:
+            if self._started is not None and self._started.done() and self._started.exception() is not None:
+                # 启动失败（Redis 不可用），下次订阅时重新启动
+                self._started = None
+            self.unsubscribe(channel, queue)
+            raise
+        return queue
+
+    def unsubscribe(self, channel: str, queue: asyncio.Queue):
+        queues = self._queues.get(channel)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._queues[channel]
+
+    def _start(self, loop: asyncio.AbstractEventLoop):
+        pubsub = redis_client.pubsub()
+        pubsub.psubscribe(constant.SINGLEFLIGHT_CHANNEL.format("*"))
+        threading.Thread(target=self._listen, args=(pubsub, loop), name="singleflight-listener", daemon=True).start()
+
+    def _listen(self, pubsub, loop: asyncio.AbstractEventLoop):
+        """订阅线程：读取消息并交给事件循环分发（连接断开时 redis-py 重连并恢复订阅）"""
+        while not loop.is_closed():
+            try:
+                message = pubsub.get_message(timeout=1.0)
+            except Exception as e:
+                logger.warning(f"跨进程订阅读取失败: {str(e)}")
+                time.sleep(1.0)
+                continue
+            if message is None or message["type"] != "pmessage":
+                continue
+            try:
+                loop.call_soon_threadsafe(self._dispatch, message["channel"], message["data"])
+            except RuntimeError:
+                # 事件循环已关闭
+                break
+        pubsub.close()
+
+    def _dispatch(self, channel: str, data: str):
+        for queue in self._queues.get(channel, ()):
+            queue.put_nowait(data)
+
+
+class _Flight:
+    """一次进行中的上游生成：已产生的增量 + 订阅者计数"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.deltas: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.remote = False  # 是否持有跨进程租约（有其他进程的跟随者时通过 Redis 发布）
+        self.remote_followers = False  # 是否已出现其他进程的跟随者
+        self.published = 0  # 已写入 Redis 日志的增量数
+        self._updated = asyncio.Event()
+
+    def notify(self):
+        """唤醒所有等待新增量的订阅者"""
+        event, self._updated = self._updated, asyncio.Event()
+        event.set()
+
+    async def wait(self):
+        await self._updated.wait()
+
+
+class SingleFlight:
+    """
+    相同请求合并（single-flight）
+    - 以规范化消息哈希为键，第一个请求成为领导者，在后台任务中驱动上游 model.astream
+    - 同一进程内的相同请求作为跟随者订阅领导者的增量：先回放已产生的增量，再接收后续增量
+    - 开启 SINGLEFLIGHT_REDIS 时跨进程通过 Redis 租约选出领导者（进程内的生成先登记再竞争租约，
+      竞争期间到达的相同请求直接加入），未获得租约的进程跟随其他进程的生成，进程内只有一个跨进程跟随；其他进程的跟随者登记后，
+      领导者按 SINGLEFLIGHT_PUBLISH_INTERVAL 批量把增量追加到日志并通过 pub/sub 发布（在线程中执行，不阻塞事件循环），
+      没有跨进程跟随者时不写 Redis
+    - 租约按心跳续约，领导者进程崩溃后租约在 SINGLEFLIGHT_LEASE_TTL 内过期，跟随者随即接手生成
+    - 所有订阅者都断开后取消上游生成
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._listener = _RemoteListener()
+
+    async def stream(self, key: Optional[str],
+                     factory: Callable[[], AsyncIterator[str]]) -> AsyncGenerator[str, None]:
+        """
+        获取 key 对应请求的增量流
+
+        Args:
+            key: 规范化消息哈希，为 None 或未开启合并时直接调用 factory
+            factory: 创建上游增量流的函数（只在成为领导者时调用）
+        """
+        if not key or not settings.SINGLEFLIGHT_ENABLED:
+            async for delta in factory():
+                yield delta
+            return
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            metrics.incr("singleflight_total", role="follower")
+        else:
+            # 先登记再竞争跨进程租约，竞争期间到达的相同请求直接跟随这次生成
+            flight = self._start(key, factory)
+
+        async for delta in self._follow(flight):
+            yield delta
+
+    def _start(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> _Flight:
+        flight = _Flight(key)
+        self._flights[key] = flight
+        flight.task = asyncio.create_task(self._run(flight, factory))
+        return flight
+
+    async def _run(self, flight: _Flight, factory: Callable[[], AsyncIterator[str]]):
+        """
+        本进程的生成任务：开启跨进程合并时先竞争租约，未获得租约时跟随其他进程的生成，
+        否则驱动上游生成；增量都写入 flight，由本进程的订阅者共享
+        """
+        try:
+            for attempt in range(2 if settings.SINGLEFLIGHT_REDIS else 0):
+                lease = await asyncio.to_thread(self._acquire_lease, flight.key)
+                if lease is not False:
+                    flight.remote = lease is True
+                    break
+                metrics.incr("singleflight_total", role="remote_follower")
+                try:
+                    async for delta in self._follow_remote(flight.key):
+                        flight.deltas.append(delta)
+                        flight.notify()
+                    return
+                except _LeaderLost:
+                    if attempt:
+                        raise RuntimeError("上游生成已中断")
+                    # 领导者没有产生任何增量就消失了，重新竞争租约，由本进程或其他跟随者接手生成
+                    metrics.incr("singleflight_total", role="takeover")
+                    logger.warning(f"跨进程领导者已中断，重新选择领导者: {flight.key}")
+            metrics.incr("singleflight_total", role="leader")
+            await self._generate(flight, factory)
+        except asyncio.CancelledError as e:
+            flight.error = e
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.notify()
+            self._flights.pop(flight.key, None)
+
+    async def _generate(self, flight: _Flight, factory: Callable[[], AsyncIterator[str]]):
+        """领导者：驱动上游生成，向本进程订阅者分发；跨进程发布由单独的任务批量完成"""
+        stream = factory()
+        publisher = asyncio.create_task(self._publish_loop(flight)) if flight.remote else None
+        error: Optional[BaseException] = None
+        try:
+            async for delta in stream:
+                flight.deltas.append(delta)
+                flight.notify()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with anyio.CancelScope(shield=True):
+                await stream.aclose()
+            if publisher is not None:
+                publisher.cancel()
+                message = None
+                if isinstance(error, asyncio.CancelledError):
+                    message = "上游生成已取消"
+                elif error is not None:
+                    message = str(error) or type(error).__name__
+                with anyio.CancelScope(shield=True):
+                    await asyncio.gather(publisher, return_exceptions=True)
+                    await asyncio.to_thread(self._finish_remote, flight, message)
+
+    async def _publish_loop(self, flight: _Flight):
+        """跨进程发布：定期续约租约，有其他进程的跟随者时批量发布新增量"""
+        renewed = checked = time.monotonic()
+        while True:
+            await asyncio.sleep(settings.SINGLEFLIGHT_PUBLISH_INTERVAL)
+            now = time.monotonic()
+            try:
+                if now - renewed >= settings.SINGLEFLIGHT_LEASE_TTL / 3:
+                    await asyncio.to_thread(redis_client.expire, constant.SINGLEFLIGHT_LEASE.format(flight.key),
+                                            settings.SINGLEFLIGHT_LEASE_TTL)
+                    renewed = now
+                if not flight.remote_followers and now - checked >= _FOLLOWER_CHECK_INTERVAL:
+                    checked = now
+                    flight.remote_followers = bool(await asyncio.to_thread(
+                        redis_client.exists, constant.SINGLEFLIGHT_FOLLOWERS.format(flight.key)))
+                if flight.remote_followers and flight.published < len(flight.deltas):
+                    await asyncio.to_thread(self._flush, flight)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"跨进程发布失败: {str(e)}")
+
+    def _flush(self, flight: _Flight):
+        """把尚未发布的增量作为一批写入日志并发布（第一批包含跟随者出现之前的全部增量）"""
+        end = len(flight.deltas)
+        if end > flight.published:
+            self._publish(flight.key, {"seq": flight.published, "deltas": flight.deltas[flight.published:end]})
+            flight.published = end
+
+    def _finish_remote(self, flight: _Flight, error: Optional[str]):
+        """生成结束：有跨进程跟随者时发布剩余增量和结束标记，然后释放租约"""
+        if flight.remote_followers or redis_client.exists(constant.SINGLEFLIGHT_FOLLOWERS.format(flight.key)):
+            self._flush(flight)
+            self._publish(flight.key, {"done": True, "error": error}, ex=settings.SINGLEFLIGHT_LOG_TTL)
+        redis_client.delete(constant.SINGLEFLIGHT_LEASE.format(flight.key),
+                            constant.SINGLEFLIGHT_FOLLOWERS.format(flight.key))
+
+    async def _follow(self, flight: _Flight) -> AsyncGenerator[str, None]:
+        """订阅本进程内的生成：先回放已产生的增量，再跟随后续增量"""
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(flight.deltas):
+                    delta = flight.deltas[index]
+                    index += 1
+                    yield delta
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise RuntimeError(f"上游生成失败: {flight.error}")
+                    return
+                await flight.wait()
+        finally:
+            flight.subscribers -= 1
+            # 所有订阅者都已离开，取消上游生成
+            if flight.subscribers == 0 and not flight.done and flight.task:
+                flight.task.cancel()
+
+    async def _follow_remote(self, key: str) -> AsyncGenerator[str, None]:
+        """
+        订阅其他进程领导者的生成：先订阅频道并登记为跟随者，再回放日志，按序号去重
+        收到的批次与已接收的增量之间有缺口时（领导者补发了登记之前的增量）从日志补齐
+        领导者在产生任何增量之前消失时抛出 _LeaderLost
+        """
+        channel = constant.SINGLEFLIGHT_CHANNEL.format(key)
+        queue = await self._listener.subscribe(channel)
+        try:
+            await asyncio.to_thread(self._register_follower, key)
+            deltas, seq, done = await asyncio.to_thread(self._read_log, key, 0)
+            for delta in deltas:
+                yield delta
+            while done is None:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    message = None
+                if message is None:
+                    if await asyncio.to_thread(redis_client.exists, constant.SINGLEFLIGHT_LEASE.format(key)):
+                        continue
+                    # 租约已释放或过期：日志中有结束标记时补齐剩余增量，否则领导者已中断
+                    deltas, seq, done = await asyncio.to_thread(self._read_log, key, seq)
+                    for delta in deltas:
+                        yield delta
+                    if done is None:
+                        if seq == 0:
+                            raise _LeaderLost(key)
+                        raise RuntimeError("上游生成已中断")
+                    break
+                entry = json.loads(message)
+                if entry.get("done"):
+                    done = entry
+                    break
+                if entry["seq"] > seq:
+                    deltas, seq, _ = await asyncio.to_thread(self._read_log, key, seq)
+                    for delta in deltas:
+                        yield delta
+                seq, deltas = self._take(entry, seq)
+                for delta in deltas:
+                    yield delta
+            if done.get("error"):
+                raise RuntimeError(f"上游生成失败: {done['error']}")
+        finally:
+            self._listener.unsubscribe(channel, queue)
+
+    @staticmethod
+    def _take(entry: dict, seq: int) -> Tuple[int, List[str]]:
+        """从一批增量中取出序号 seq 及之后的部分"""
+        start, deltas = entry["seq"], entry["deltas"]
+        if start <= seq < start + len(deltas):
+            deltas = deltas[seq - start:]
+            return seq + len(deltas), deltas
+        return seq, []
+
+    @staticmethod
+    def _read_log(key: str, seq: int) -> Tuple[List[str], int, Optional[dict]]:
+        """从日志中读取序号 seq 之后的增量，返回 (增量, 新序号, 结束标记)"""
+        result = []
+        for item in redis_client.lrange(constant.SINGLEFLIGHT_LOG.format(key)):
+            entry = json.loads(item)
+            if entry.get("done"):
+                return result, seq, entry
+            seq, deltas = SingleFlight._take(entry, seq)
+            result.extend(deltas)
+        return result, seq, None
+
+    @staticmethod
+    def _register_follower(key: str):
+        followers_key = constant.SINGLEFLIGHT_FOLLOWERS.format(key)
+        redis_client.incr(followers_key)
+        redis_client.expire(followers_key, settings.SINGLEFLIGHT_LEASE_TTL * 4)
+
+    @staticmethod
+    def _acquire_lease(key: str) -> Optional[bool]:
+        """
+        尝试成为跨进程领导者
+        :return: True 获得租约；False 其他进程正在生成；None Redis 不可用（只在本进程内合并）
+        """
+        lease_key = constant.SINGLEFLIGHT_LEASE.format(key)
+        if redis_client.set(lease_key, WORKER_ID, ex=settings.SINGLEFLIGHT_LEASE_TTL, nx=True):
+            redis_client.delete(constant.SINGLEFLIGHT_LOG.format(key), constant.SINGLEFLIGHT_FOLLOWERS.format(key))
+            return True
+        return False if redis_client.exists(lease_key) else None
+
+    @staticmethod
+    def _publish(key: str, entry: dict, ex: int = None):
+        redis_client.append_and_publish(
+            constant.SINGLEFLIGHT_LOG.format(key),
+            constant.SINGLEFLIGHT_CHANNEL.format(key),
+            json.dumps(entry, ensure_ascii=False),
+            ex=ex or settings.SINGLEFLIGHT_LEASE_TTL * 4,
+        )
+
+
+# 单例实例（全局唯一）
+singleflight = SingleFlight()
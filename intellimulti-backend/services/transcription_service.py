@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import AsyncGenerator, Dict, Any, Optional
+
+from langchain.messages import HumanMessage
+
+from common import constant
+from common.metrics import metrics
+from common.redis_client import redis_client
+from config.settings import settings
+from services.admission_service import admission
+from services.model_service import model_registry, stream_model_text
+from utils.audio_utils import AudioUpload, AudioProcessor
+from utils.media_utils import to_data_url
+
+logger = logging.getLogger("transcription_service")
+logger.setLevel(logging.INFO)
+
+TRANSCRIBE_PROMPT = "请逐字转写这段音频中的全部语音内容，保持原语言，不要翻译、总结或补充，只输出转写文本；没有语音时输出空行。"
+
+
+class AudioTranscriber:
+    """
+    音频处理流水线
+    - 解码、重采样为单声道，去掉静音并按静音边界切分成不超过 AUDIO_SEGMENT_MAX_SECONDS 的片段
+    - 语音总时长不超过 AUDIO_DIRECT_MAX_SECONDS 时，压缩后的音频直接交给对话模型
+    - 更长的音频并发转写各片段（受 AUDIO_CONCURRENCY 和准入控制限制），按片段顺序推送转写结果
+    - 片段转写结果按音频内容哈希缓存在 Redis
+    """
+
+    @staticmethod
+    async def process_stream(upload: AudioUpload) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        逐步产出处理进度（audio_progress）和各片段转写结果（audio_transcript），
+        最后产出 audio_ready：短音频包含 data_url，长音频包含完整的 transcript
+        """
+        started = time.monotonic()
+        yield {"type": "audio_progress", "stage": "received", "filename": upload.filename, "size": upload.size}
+
+        sample_rate = settings.AUDIO_SAMPLE_RATE
+        try:
+            pcm = await AudioProcessor.decode(upload.path, sample_rate, settings.AUDIO_MAX_SECONDS)
+        except FileNotFoundError:
+            # 没有安装 ffmpeg：小文件按原样交给模型，大文件无法处理
+            if upload.size > settings.AUDIO_DIRECT_MAX_BYTES:
+                raise RuntimeError("服务器未安装 ffmpeg，无法处理较大的音频文件")
+            logger.warning("未找到 ffmpeg，音频不做预处理")
+            contents = await asyncio.to_thread(upload.read)
+            mime_type = AudioProcessor.get_audio_mime_type(upload.filename)
+            yield {"type": "audio_ready", "mode": "direct", "elapsed": round(time.monotonic() - started, 3),
+                   "data_url": await to_data_url(contents, mime_type)}
+            return
+
+        segments = await asyncio.to_thread(
+            AudioProcessor.split_on_silence, pcm, sample_rate, settings.AUDIO_SEGMENT_MAX_SECONDS,
+            settings.AUDIO_SILENCE_THRESHOLD_DB, settings.AUDIO_MIN_SILENCE_MS, settings.AUDIO_PADDING_MS)
+        duration = len(pcm) / sample_rate
+        speech_duration = sum(end - start for segment in segments for start, end in segment) / sample_rate
+        yield {"type": "audio_progress", "stage": "segmented", "duration": round(duration, 2),
+               "speech_duration": round(speech_duration, 2), "segments": len(segments),
+               "truncated": duration >= settings.AUDIO_MAX_SECONDS}
+        metrics.observe("audio_duration_seconds", duration)
+
+        if not segments:
+            yield {"type": "audio_ready", "mode": "transcript", "transcript": "", "segments": 0,
+                   "elapsed": round(time.monotonic() - started, 3)}
+            return
+
+        if speech_duration <= settings.AUDIO_DIRECT_MAX_SECONDS:
+            # 短音频：去掉静音后整体压缩，直接交给对话模型（保留语气等信息）
+            speech = AudioProcessor.join_segment(pcm, [region for segment in segments for region in segment])
+            data, mime_type = await AudioProcessor.encode(speech, sample_rate, settings.AUDIO_SEGMENT_FORMAT)
+            logger.info(f"音频预处理: {upload.size} -> {len(data)} 字节，时长 {duration:.1f}s -> {speech_duration:.1f}s")
+            yield {"type": "audio_ready", "mode": "direct", "elapsed": round(time.monotonic() - started, 3),
+                   "data_url": await to_data_url(data, mime_type)}
+            return
+
+        semaphore = asyncio.Semaphore(settings.AUDIO_CONCURRENCY)
+
+        async def run(index: int) -> Optional[str]:
+            async with semaphore:
+                try:
+                    data, mime_type = await AudioProcessor.encode(
+                        AudioProcessor.join_segment(pcm, segments[index]), sample_rate, settings.AUDIO_SEGMENT_FORMAT)
+                except Exception as e:
+                    # 编码失败只影响当前片段，按转写失败推送
+                    logger.warning(f"音频片段 {index} 编码失败: {str(e)}")
+                    metrics.incr("audio_segments_total", result="error")
+                    return None
+                return await AudioTranscriber._transcribe_segment(data, mime_type, index)
+
+        # 全部片段同时排队，按片段顺序等待结果，先完成的后续片段暂存在任务中
+        tasks = [asyncio.ensure_future(run(index)) for index in range(len(segments))]
+        texts = []
+        try:
+            for index, task in enumerate(tasks):
+                text = await task
+                texts.append(text or "")
+                yield {"type": "audio_transcript", "segment": index, "total_segments": len(segments),
+                       "start": round(segments[index][0][0] / sample_rate, 2),
+                       "end": round(segments[index][-1][1] / sample_rate, 2),
+                       "text": text or "", "error": text is None}
+        finally:
+            # 客户端断开时取消尚未完成的转写
+            for task in tasks:
+                task.cancel()
+
+        elapsed = time.monotonic() - started
+        metrics.observe("audio_transcribe_seconds", elapsed)
+        logger.info(f"音频转写完成: 时长 {duration:.1f}s，{len(segments)} 个片段，耗时 {elapsed:.3f}s")
+        yield {"type": "audio_ready", "mode": "transcript", "transcript": "\n".join(text for text in texts if text),
+               "segments": len(segments), "elapsed": round(elapsed, 3)}
+
+    @staticmethod
+    async def _transcribe_segment(data: bytes, mime_type: str, index: int) -> Optional[str]:
+        """转写一个片段，失败时返回 None"""
+        cache_key = constant.AUDIO_TRANSCRIPT_CACHE.format(hashlib.sha256(data).hexdigest())
+        cached = redis_client.get_object(cache_key)
+        if cached is not None:
+            metrics.incr("audio_segments_total", result="cached")
+            return cached
+
+        content = [
+            {"type": "text", "text": TRANSCRIBE_PROMPT},
+            {"type": "audio_url", "audio_url": {"url": await to_data_url(data, mime_type)}},
+        ]
+        started = time.monotonic()
+        try:
+            model = model_registry.get_model("dashscope", settings.AUDIO_TRANSCRIBE_MODEL)
+            async with admission.slot("dashscope"):
+                text = "".join([delta async for delta in stream_model_text(model, [HumanMessage(content=content)])])
+        except Exception as e:
+            logger.warning(f"音频片段 {index} 转写失败: {str(e)}")
+            metrics.incr("audio_segments_total", result="error")
+            return None
+        metrics.observe("audio_segment_seconds", time.monotonic() - started)
+        metrics.incr("audio_segments_total", result="transcribed")
+
+        text = text.strip()
+        redis_client.set_object(cache_key, text, ex=settings.AUDIO_TRANSCRIPT_CACHE_TTL)
+        return text
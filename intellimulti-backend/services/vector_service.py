@@ -0,0 +1,140 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+from common.metrics import metrics
+from config.settings import settings
+from utils.vector_utils import EmbeddingBackend, VectorIndex, create_embedding_backend, mmr
+
+logger = logging.getLogger("vector_service")
+logger.setLevel(logging.INFO)
+
+
+class VectorRetriever:
+    """
+    PDF 文档块向量检索
+    - 按文档哈希构建 int8 量化的向量索引，保存在 VECTOR_INDEX_DIR，检索时内存映射加载
+    - 索引行号与文档块序号一致，检索结果沿用文档块原有的 ID、元数据和引用编号
+    - 多个文档的结果按内积合并（向量已归一化，得分可直接比较）
+    """
+
+    _backend: Optional[EmbeddingBackend] = None
+    _local: "OrderedDict[str, VectorIndex]" = OrderedDict()
+    # 正在加载或构建的索引（索引路径 -> 任务）
+    _pending: Dict[str, "asyncio.Future[VectorIndex]"] = {}
+
+    @classmethod
+    def get_backend(cls) -> EmbeddingBackend:
+        """获取向量化后端（懒加载，进程内共享）"""
+        if cls._backend is None:
+            cls._backend = create_embedding_backend(settings.VECTOR_EMBEDDING_BACKEND)
+            logger.info(f"向量化后端: {cls._backend.name}")
+        return cls._backend
+
+    @classmethod
+    async def embed_query(cls, query: str) -> np.ndarray:
+        return (await asyncio.to_thread(cls.get_backend().embed, [query]))[0]
+
+    @classmethod
+    async def search(cls, documents: List[Tuple[Optional[str], List[Dict[str, Any]]]], query_vector: np.ndarray,
+                     limit: int) -> List[Tuple[int, float]]:
+        """
+        在多个文档中检索与查询向量最相近的文档块
+
+        Returns:
+            [(在拼接列表中的序号, 得分)]，按得分从高到低，只包含得分大于 0 的文档块
+        """
+        started = time.monotonic()
+        hits = []
+        offset = 0
+        for document_hash, chunks in documents:
+            if chunks:
+                index = await cls.get_index(document_hash, chunks)
+                ids, scores = await asyncio.to_thread(index.search, query_vector, limit)
+                hits.extend((offset + int(i), float(s)) for i, s in zip(ids[0], scores[0]) if s > 0)
+            offset += len(chunks)
+        hits.sort(key=lambda item: item[1], reverse=True)
+        metrics.observe("vector_search_seconds", time.monotonic() - started)
+        return hits[:limit]
+
+    @classmethod
+    async def diversify(cls, documents: List[Tuple[Optional[str], List[Dict[str, Any]]]], query_vector: np.ndarray,
+                        candidates: List[Tuple[int, float]], top_k: int) -> List[int]:
+        """对候选文档块（[(拼接列表中的序号, 相关度)]）做 MMR 重排，返回选中的序号"""
+        offsets, offset = [], 0
+        for _, chunks in documents:
+            offsets.append(offset)
+            offset += len(chunks)
+
+        vectors = []
+        for doc_id, _ in candidates:
+            position = bisect.bisect_right(offsets, doc_id) - 1
+            document_hash, chunks = documents[position]
+            index = await cls.get_index(document_hash, chunks)
+            vectors.append(index.vectors([doc_id - offsets[position]])[0])
+        selected = mmr(query_vector, np.stack(vectors), np.array([score for _, score in candidates]), top_k,
+                       diversity=settings.VECTOR_MMR_DIVERSITY)
+        return [candidates[i][0] for i in selected]
+
+    @classmethod
+    async def get_index(cls, document_hash: Optional[str], pdf_chunks: List[Dict[str, Any]]) -> VectorIndex:
+        """获取文档的向量索引：进程内缓存 -> 索引文件 -> 重新构建；同一索引同时只加载或构建一次"""
+        backend = cls.get_backend()
+        if not document_hash:
+            return await cls._load_or_build(backend, None, pdf_chunks)
+        path = os.path.join(settings.VECTOR_INDEX_DIR, f"{document_hash}.{backend.name}")
+        index = cls._local.get(path)
+        if index is not None:
+            cls._local.move_to_end(path)
+            return index
+
+        # 其他请求正在加载或构建同一索引时等待其结果
+        task = cls._pending.get(path)
+        if task is None:
+            task = asyncio.ensure_future(cls._load_or_build(backend, path, pdf_chunks))
+            cls._pending[path] = task
+            task.add_done_callback(lambda _: cls._pending.pop(path, None))
+        # 一个等待方被取消时不影响其他等待方
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def _load_or_build(cls, backend: EmbeddingBackend, path: Optional[str],
+                             pdf_chunks: List[Dict[str, Any]]) -> VectorIndex:
+        if path and VectorIndex.exists(path):
+            try:
+                index = await asyncio.to_thread(VectorIndex.load, path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"向量索引损坏，重新构建: {str(e)}")
+                index = None
+            if index is not None and len(index) == len(pdf_chunks):
+                cls._remember(path, index)
+                return index
+
+        # 向量化是纯 CPU 计算，放到线程中执行
+        started = time.monotonic()
+        index = await asyncio.to_thread(cls._build, backend, [chunk.get("content", "") for chunk in pdf_chunks])
+        metrics.observe("vector_index_build_seconds", time.monotonic() - started)
+        if path:
+            os.makedirs(settings.VECTOR_INDEX_DIR, exist_ok=True)
+            await asyncio.to_thread(index.save, path)
+            cls._remember(path, index)
+        return index
+
+    @staticmethod
+    def _build(backend: EmbeddingBackend, texts: List[str]) -> VectorIndex:
+        batch = max(1, settings.VECTOR_EMBED_BATCH)
+        embeddings = [backend.embed(texts[i:i + batch]) for i in range(0, len(texts), batch)]
+        return VectorIndex.build(np.concatenate(embeddings) if embeddings else np.zeros((0, backend.dim), np.float32))
+
+    @classmethod
+    def _remember(cls, path: str, index: VectorIndex):
+        cls._local[path] = index
+        cls._local.move_to_end(path)
+        while len(cls._local) > settings.RETRIEVAL_LOCAL_INDEXES:
+            cls._local.popitem(last=False)
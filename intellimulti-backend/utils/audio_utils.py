@@ -1,39 +1,219 @@
-import base64
+import asyncio
+import io
+import math
+import tempfile
+import wave
+from typing import List, Tuple, IO
 
+import numpy as np
 from fastapi import UploadFile, HTTPException
 
+from config.settings import settings
+
+# 一段音频：若干个 (起始采样点, 结束采样点) 的语音区间，区间之间的长静音已去掉
+Segment = List[Tuple[int, int]]
+
+# 读取 ffmpeg 输出的块大小
+_READ_CHUNK_BYTES = 1024 * 1024
+# 计算音量时每块的帧数（30ms 帧、16kHz 时约 5 分钟，float32 临时数组约 19MB）
+_LEVEL_BLOCK_FRAMES = 10000
+
+
+class AudioUpload:
+    """
+    上传的音频文件
+    分块写入唯一命名的临时文件（m4a 等格式需要可随机读取的文件才能解码），关闭时自动删除
+    """
+
+    def __init__(self, filename: str, size: int, spool: IO[bytes]):
+        self.filename = filename
+        self.size = size
+        self.spool = spool
+
+    @property
+    def path(self) -> str:
+        return self.spool.name
+
+    @classmethod
+    async def from_upload(cls, upload: UploadFile) -> "AudioUpload":
+        """校验格式并分块读取上传文件，超过 AUDIO_MAX_UPLOAD_BYTES 时立即拒绝"""
+        if not AudioProcessor.is_valid_audio_type(upload.content_type, upload.filename):
+            raise HTTPException(
+                status_code=400,
+                detail="不支持的音频格式，支持的格式有: MP3, WAV, M4A"
+            )
+        spool = tempfile.NamedTemporaryFile(prefix="audio-", suffix="." + upload.filename.split('.')[-1].lower())
+        size = 0
+        try:
+            while chunk := await upload.read(settings.MEDIA_READ_CHUNK_BYTES):
+                size += len(chunk)
+                if size > settings.AUDIO_MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413,
+                                        detail=f"音频文件过大，最大支持 {settings.AUDIO_MAX_UPLOAD_BYTES // (1024 * 1024)}MB")
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.flush()
+        return cls(upload.filename, size, spool)
+
+    def read(self) -> bytes:
+        """读取原始文件内容"""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        """删除临时文件"""
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
 
 class AudioProcessor:
     """音频处理工具类"""
 
+    # 计算音量的帧长（毫秒）
+    FRAME_MS = 30
+
     @staticmethod
-    def audio_to_base64(audio_file: UploadFile) -> str:
+    async def decode(path: str, sample_rate: int, max_seconds: int) -> np.ndarray:
+        """
+        用 ffmpeg 解码并重采样为单声道 16 位 PCM，超过 max_seconds 的部分截断
+        输出分块读取后逐块拷入结果数组，峰值内存约为 PCM 大小加一个读取块
+        """
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-i", path, "-t", str(max_seconds),
+            "-vn", "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "pipe:1",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+
+        async def read_stdout() -> List[bytes]:
+            chunks = []
+            while chunk := await process.stdout.read(_READ_CHUNK_BYTES):
+                chunks.append(chunk)
+            return chunks
+
         try:
-            # 验证文件类型
-            if not AudioProcessor.is_valid_audio_type(audio_file.content_type, audio_file.filename):
-                raise HTTPException(
-                    status_code=400,
-                    detail="不支持的音频格式，支持的格式有: MP3, WAV, OGG, M4A, FLAC"
-                )
-
-            # 读取文件内容
-            contents = audio_file.file.read()
-
-            # 验证文件大小（可选：限制为10MB）
-            max_size = 10 * 1024 * 1024  # 10MB
-            if len(contents) > max_size:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"音频文件过大，最大支持 {max_size // 1024 // 1024}MB"
-                )
-
-            base64_encoded = base64.b64encode(contents).decode('utf-8')
-            return base64_encoded
-
-        except HTTPException:
+            chunks, stderr = await asyncio.gather(read_stdout(), process.stderr.read())
+            await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
             raise
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"音频编码失败: {str(e)}")
+        if process.returncode != 0:
+            raise ValueError(f"音频解码失败: {stderr.decode('utf-8', errors='ignore')[-200:]}")
+
+        total = sum(len(chunk) for chunk in chunks) // 2 * 2
+        pcm = np.empty(total // 2, dtype=np.int16)
+        view, offset = pcm.view(np.uint8), 0
+        # 逐块拷贝并释放，避免拼接时再复制一份完整输出
+        chunks.reverse()
+        while chunks and offset < total:
+            chunk = chunks.pop()
+            size = min(len(chunk), total - offset)
+            view[offset:offset + size] = np.frombuffer(chunk, dtype=np.uint8, count=size)
+            offset += size
+        return pcm
+
+    @staticmethod
+    def frame_levels(pcm: np.ndarray, frame: int) -> np.ndarray:
+        """
+        每帧音量（dBFS）
+        按 _LEVEL_BLOCK_FRAMES 帧分块计算，临时的浮点数组只有一块大小，不随音频时长增长
+        """
+        frame_count = len(pcm) // frame
+        levels = np.empty(frame_count, dtype=np.float32)
+        for start in range(0, frame_count, _LEVEL_BLOCK_FRAMES):
+            end = min(start + _LEVEL_BLOCK_FRAMES, frame_count)
+            block = pcm[start * frame:end * frame].reshape(end - start, frame).astype(np.float32)
+            block /= 32768
+            levels[start:end] = 10 * np.log10(np.einsum("ij,ij->i", block, block) / frame + 1e-20)
+        return levels
+
+    @staticmethod
+    def split_on_silence(pcm: np.ndarray, sample_rate: int, max_seconds: float, threshold_db: float,
+                         min_silence_ms: int, padding_ms: int) -> List[Segment]:
+        """
+        去掉静音并按静音边界切分
+        - 按帧计算音量，低于 threshold_db 的帧为静音；短于 min_silence_ms 的停顿视为语音的一部分
+        - 语音区间两侧保留 padding_ms，区间之间的长静音丢弃
+        - 相邻区间合并成不超过 max_seconds 的片段；单个区间过长时在末段最安静的帧处切开
+        """
+        frame = sample_rate * AudioProcessor.FRAME_MS // 1000
+        frame_count = len(pcm) // frame
+        if frame_count == 0:
+            return []
+        levels = AudioProcessor.frame_levels(pcm, frame)
+        voiced = levels > threshold_db
+
+        # 语音帧的连续区间（帧序号），合并短停顿
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], voiced.astype(np.int8), [0]])))
+        runs = list(zip(edges[::2], edges[1::2]))
+        min_gap = math.ceil(min_silence_ms / AudioProcessor.FRAME_MS)
+        padding = math.ceil(padding_ms / AudioProcessor.FRAME_MS)
+        regions: List[List[int]] = []
+        for start, end in runs:
+            start, end = max(0, start - padding), min(frame_count, end + padding)
+            if regions and start - regions[-1][1] < min_gap:
+                regions[-1][1] = max(regions[-1][1], end)
+            else:
+                regions.append([start, end])
+
+        max_frames = max(1, int(max_seconds * 1000 / AudioProcessor.FRAME_MS))
+        segments: List[List[Tuple[int, int]]] = []
+        current, current_frames = [], 0
+        for start, end in regions:
+            while end - start > max_frames:
+                # 在最后 20% 的范围内找最安静的帧切开
+                window_start = start + max_frames * 4 // 5
+                cut = window_start + int(np.argmin(levels[window_start:start + max_frames])) + 1
+                if current:
+                    segments.append(current)
+                    current, current_frames = [], 0
+                segments.append([(start, cut)])
+                start = cut
+            if current and current_frames + end - start > max_frames:
+                segments.append(current)
+                current, current_frames = [], 0
+            current.append((start, end))
+            current_frames += end - start
+        if current:
+            segments.append(current)
+        # 帧序号换算为采样点，最后一帧延伸到音频末尾
+        return [[(int(start) * frame, len(pcm) if end == frame_count else int(end) * frame) for start, end in segment]
+                for segment in segments]
+
+    @staticmethod
+    def join_segment(pcm: np.ndarray, segment: Segment) -> np.ndarray:
+        return np.concatenate([pcm[start:end] for start, end in segment])
+
+    @staticmethod
+    async def encode(pcm: np.ndarray, sample_rate: int, audio_format: str) -> Tuple[bytes, str]:
+        """
+        编码音频片段
+        :return: (音频字节, MIME 类型)；wav 直接封装 PCM，mp3 由 ffmpeg 按 AUDIO_SEGMENT_BITRATE 压缩
+        """
+        if audio_format == "wav":
+            return AudioProcessor.to_wav(pcm, sample_rate), "audio/wav"
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "s16le", "-ac", "1", "-ar", str(sample_rate),
+            "-i", "pipe:0", "-b:a", settings.AUDIO_SEGMENT_BITRATE, "-f", "mp3", "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(pcm.astype("<i2").tobytes())
+        if process.returncode != 0:
+            raise ValueError(f"音频编码失败: {stderr.decode('utf-8', errors='ignore')[-200:]}")
+        return stdout, "audio/mpeg"
+
+    @staticmethod
+    def to_wav(pcm: np.ndarray, sample_rate: int) -> bytes:
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(pcm.astype("<i2").tobytes())
+        return buffer.getvalue()
 
     @staticmethod
     def get_audio_mime_type(filename: str) -> str:
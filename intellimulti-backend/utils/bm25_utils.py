@@ -0,0 +1,140 @@
+import heapq
+import json
+import math
+import re
+import struct
+import sys
+import zlib
+from array import array
+from typing import Dict, List, Tuple
+
+# 中文（含日文假名、韩文）连续片段，以及英文单词/数字
+_CJK_RUN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+_WORD = re.compile(r'[a-z0-9]+(?:[._-][a-z0-9]+)*')
+
+# 序列化格式：魔数 + 版本，后接 JSON 头部长度和各数组
+_MAGIC = b"BM25"
+_VERSION = 1
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中英文混合分词
+    - 中文按单字 + 相邻二字切分（不依赖分词词典，二字组提升短语匹配精度）
+    - 英文、数字按单词切分并转小写
+    """
+    tokens = []
+    for run in _CJK_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD.findall(_CJK_RUN.sub(" ", text.lower())))
+    return tokens
+
+
+class BM25Index:
+    """
+    BM25 倒排索引
+    - 每个词项的倒排表以连续数组存储：offsets[t]:offsets[t+1] 为词项 t 在 doc_ids / freqs 中的区间
+    - 文档编号即文档块在列表中的序号，检索结果可直接对应原始文档块
+    """
+
+    def __init__(self, terms: Dict[str, int], offsets: array, doc_ids: array, freqs: array, doc_lengths: array):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+        self.doc_lengths = doc_lengths
+        self.avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: List[str]) -> "BM25Index":
+        """从文本列表构建索引"""
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_lengths = array("I")
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc_id, count))
+
+        terms: Dict[str, int] = {}
+        offsets, doc_ids, freqs = array("I", [0]), array("I"), array("I")
+        for term, entries in postings.items():
+            terms[term] = len(terms)
+            for doc_id, count in entries:
+                doc_ids.append(doc_id)
+                freqs.append(count)
+            offsets.append(len(doc_ids))
+        return cls(terms, offsets, doc_ids, freqs, doc_lengths)
+
+    def search(self, query: str, top_k: int, k1: float = 1.5, b: float = 0.75) -> List[Tuple[int, float]]:
+        """
+        检索与查询最相关的文档
+
+        Returns:
+            [(文档编号, BM25 得分)]，按得分从高到低，只包含得分大于 0 的文档
+        """
+        total = len(self.doc_lengths)
+        if not total:
+            return []
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            df = end - start
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for i in range(start, end):
+                doc_id = self.doc_ids[i]
+                tf = self.freqs[i]
+                norm = k1 * (1 - b + b * self.doc_lengths[doc_id] / (self.avg_length or 1))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def to_bytes(self) -> bytes:
+        """序列化为压缩的二进制（数组统一按小端字节序存储）"""
+        header = json.dumps(list(self.terms), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        parts = [_MAGIC, struct.pack("<BI", _VERSION, len(header)), header]
+        for values in (self.offsets, self.doc_ids, self.freqs, self.doc_lengths):
+            values = _little_endian(values)
+            parts.append(struct.pack("<I", len(values)))
+            parts.append(values.tobytes())
+        return zlib.compress(b"".join(parts), 6)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "BM25Index":
+        """从 to_bytes 的结果恢复索引"""
+        data = zlib.decompress(data)
+        if data[:4] != _MAGIC:
+            raise ValueError("不是有效的 BM25 索引数据")
+        version, header_length = struct.unpack_from("<BI", data, 4)
+        if version != _VERSION:
+            raise ValueError(f"不支持的 BM25 索引版本: {version}")
+        position = 9
+        terms = {term: i for i, term in enumerate(json.loads(data[position:position + header_length]))}
+        position += header_length
+
+        arrays = []
+        for _ in range(4):
+            (length,) = struct.unpack_from("<I", data, position)
+            position += 4
+            values = array("I")
+            values.frombytes(data[position:position + length * values.itemsize])
+            position += length * values.itemsize
+            arrays.append(_little_endian(values))
+        return cls(terms, *arrays)
+
+
+def _little_endian(values: array) -> array:
+    """大端机器上转换字节序（转换是对称的，读写共用）"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
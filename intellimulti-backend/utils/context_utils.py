@@ -0,0 +1,106 @@
+from typing import List, Dict, Any, Optional, Tuple
+
+from utils.pdf_utils import PDFProcessor
+from utils.token_utils import estimate_text_tokens
+
+
+def _block_text(citation: int, chunk: Dict[str, Any]) -> str:
+    """单个参考内容块在提示词中的文本"""
+    source_info = chunk.get("metadata", {}).get("source_info", f"文档块 {citation}")
+    return f"\n[{citation}] {chunk.get('content', '')}\n来源: {source_info}\n"
+
+
+def _overlap(previous: Dict[str, Any], current: Dict[str, Any]) -> Optional[int]:
+    """
+    相邻文档块开头与前一块重复的字符数
+    两块不是同一文档中连续的块（或缺少位置信息）时返回 None
+    """
+    a, b = previous.get("metadata", {}), current.get("metadata", {})
+    if a.get("source") != b.get("source") or b.get("chunk_id") != a.get("chunk_id", -2) + 1:
+        return None
+    if a.get("end_index") is None or b.get("start_index") is None:
+        return None
+    return max(0, a["end_index"] - b["start_index"])
+
+
+def _chunk_cost(pdf_chunks: List[Dict[str, Any]], selected: set, index: int) -> int:
+    """加入一个文档块增加的 token 数：去掉与已选相邻块重复的部分，不与已选块合并时加上标题和来源"""
+    chunk = pdf_chunks[index]
+    content = chunk.get("content", "")
+    start, end, merged = 0, len(content), False
+    if index - 1 in selected:
+        overlap = _overlap(pdf_chunks[index - 1], chunk)
+        if overlap is not None:
+            start, merged = overlap, True
+    if index + 1 in selected:
+        overlap = _overlap(chunk, pdf_chunks[index + 1])
+        if overlap is not None:
+            end, merged = max(start, end - overlap), True
+    tokens = estimate_text_tokens(content[start:end])
+    if not merged:
+        tokens += estimate_text_tokens(_block_text(index, {**chunk, "content": ""}))
+    return tokens
+
+
+def _merge(chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """合并同一文档中连续的文档块，去掉相邻块之间重复的重叠文本"""
+    if len(chunks) == 1:
+        return chunks[0]
+    parts = [chunks[0].get("content", "")]
+    for previous, current in zip(chunks, chunks[1:]):
+        metadata_a, metadata_b = previous["metadata"], current["metadata"]
+        if metadata_b["start_index"] > metadata_a["end_index"]:
+            parts.append("\n")
+        parts.append(current.get("content", "")[_overlap(previous, current):])
+    content = "".join(parts)
+
+    first, last = chunks[0], chunks[-1]
+    metadata = {
+        **first["metadata"],
+        "chunk_size": len(content),
+        "page_end": last["metadata"].get("page_end", last["metadata"].get("page_number")),
+        "end_index": last["metadata"]["end_index"],
+        "merged_chunk_ids": [chunk["metadata"].get("chunk_id") for chunk in chunks],
+    }
+    if "page_number" in metadata:
+        metadata["source_info"] = PDFProcessor.source_info(metadata.get("source", ""), metadata)
+    return {"id": first.get("id"), "content": content, "metadata": metadata}
+
+
+def pack_context(pdf_chunks: List[Dict[str, Any]], ranked_indices: List[int] = None,
+                 token_budget: int = None) -> Tuple[str, Dict[int, Dict[str, Any]]]:
+    """
+    在 token 预算内打包参考文档内容
+    - 按相关度从高到低依次加入文档块，下一块放不下时停止（至少保留最相关的一块）
+    - 同一文档中相邻或重叠的块合并为一段，重叠文本只保留一份
+    - 输出按文档位置排列，每段的引用编号为其第一块在 pdf_chunks 中的序号
+
+    Args:
+        pdf_chunks: 全部文档块
+        ranked_indices: 按相关度排列的文档块序号，默认全部文档块按文档顺序
+        token_budget: 参考内容的 token 上限，为 None 时不限制
+
+    Returns:
+        (参考内容文本, {引用编号: 文档块（合并后的块包含全部内容和起止页）})
+    """
+    ranked = range(len(pdf_chunks)) if ranked_indices is None else dict.fromkeys(ranked_indices)
+    selected = set()
+    used = 0
+    for index in ranked:
+        cost = _chunk_cost(pdf_chunks, selected, index)
+        if token_budget is not None and selected and used + cost > token_budget:
+            break
+        selected.add(index)
+        used += cost
+
+    citations: Dict[int, Dict[str, Any]] = {}
+    group: List[int] = []
+    for index in sorted(selected):
+        if group and (group[-1] != index - 1 or _overlap(pdf_chunks[group[-1]], pdf_chunks[index]) is None):
+            citations[group[0]] = _merge([pdf_chunks[i] for i in group])
+            group = []
+        group.append(index)
+    if group:
+        citations[group[0]] = _merge([pdf_chunks[i] for i in group])
+
+    return "".join(_block_text(citation, chunk) for citation, chunk in citations.items()), citations
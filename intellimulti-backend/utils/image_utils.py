@@ -1,21 +1,56 @@
-import base64
-from fastapi import UploadFile, HTTPException
+import io
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from config.settings import settings
+
+OUTPUT_MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
 
 
 class ImageProcessor:
     """图像处理工具类"""
 
     @staticmethod
-    def image_to_base64(image_file: UploadFile) -> str:
-        try:
-            # 读取文件内容
-            with image_file.file as f:
-                contents = f.read()
-            # 进行base64编码
-            base64_encoded = base64.b64encode(contents).decode('utf-8')
-            return base64_encoded
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"图像编码失败: {str(e)}")
+    def preprocess(contents: bytes, max_edge: int, image_format: str,
+                   quality: int) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        旋正、缩放并重新压缩图片：按 EXIF 方向旋正，最长边缩放到 max_edge，转为 JPEG / WebP 并去掉元数据
+        :return: (处理后的图片字节, MIME 类型)；动图，或不需要缩放、不含元数据且重新压缩后不会变小的图片返回 (None, None)
+        """
+        with Image.open(io.BytesIO(contents)) as source:
+            if getattr(source, "is_animated", False):
+                return None, None
+            has_metadata = bool(source.getexif()) or "icc_profile" in source.info
+            image = ImageOps.exif_transpose(source)
+            resized = max(image.size) > max_edge
+            if resized:
+                image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+            if has_alpha and image_format == "jpeg":
+                # JPEG 不支持透明通道，铺白色背景
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            elif image.mode not in ("RGB", "L") and not (has_alpha and image_format == "webp"):
+                image = image.convert("RGB")
+
+            buffer = io.BytesIO()
+            if image_format == "webp":
+                image.save(buffer, format="WEBP", quality=quality, method=4)
+            else:
+                image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+
+        processed = buffer.getvalue()
+        if not resized and not has_metadata and len(processed) >= len(contents):
+            return None, None
+        return processed, OUTPUT_MIME_TYPES[image_format]
+
+    @staticmethod
+    def get_max_edge(model_name: str) -> int:
+        """目标模型的图片最长边上限（像素）"""
+        return settings.IMAGE_MAX_EDGE_BY_MODEL.get(model_name, settings.IMAGE_MAX_EDGE)
 
     @staticmethod
     def get_image_mime_type(filename: str) -> str:
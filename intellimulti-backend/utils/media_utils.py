@@ -0,0 +1,57 @@
+import asyncio
+import binascii
+from typing import Callable, Optional, TypeVar
+
+from fastapi import UploadFile, HTTPException
+
+from config.settings import settings
+
+T = TypeVar("T")
+
+
+def encode_data_url(data: bytes, mime_type: str) -> str:
+    """
+    编码为 data URL
+    前缀与编码结果在字节层面拼接后只解码一次，中间结果用完即释放，同时存在的编码副本不超过两份
+    """
+    return (f"data:{mime_type};base64,".encode("ascii") + binascii.b2a_base64(data, newline=False)).decode("ascii")
+
+
+async def to_data_url(data: bytes, mime_type: str) -> str:
+    """编码为 data URL，超过 MEDIA_OFFLOAD_BYTES 时在线程中编码，不阻塞事件循环"""
+    return await offload(len(data), encode_data_url, data, mime_type)
+
+
+async def offload(size: int, func: Callable[..., T], *args) -> T:
+    """按数据量决定执行位置：小数据直接执行，超过 MEDIA_OFFLOAD_BYTES 时放到线程池执行"""
+    if size > settings.MEDIA_OFFLOAD_BYTES:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+async def read_upload(upload: UploadFile, max_bytes: int, label: str) -> bytearray:
+    """
+    分块读取上传文件
+    已知文件大小时先校验并按大小预分配缓冲区，读取过程中超过 max_bytes 立即拒绝
+    """
+    size_hint: Optional[int] = getattr(upload, "size", None)
+    if size_hint is not None and size_hint > max_bytes:
+        raise HTTPException(status_code=413, detail=f"{label}文件过大，最大支持 {max_bytes // (1024 * 1024)}MB")
+    buffer = bytearray(size_hint or 0)
+    size = 0
+    while chunk := await upload.read(settings.MEDIA_READ_CHUNK_BYTES):
+        if size + len(chunk) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"{label}文件过大，最大支持 {max_bytes // (1024 * 1024)}MB")
+        if size + len(chunk) > len(buffer):
+            buffer.extend(b"\0" * (size + len(chunk) - len(buffer)))
+        buffer[size:size + len(chunk)] = chunk
+        size += len(chunk)
+    del buffer[size:]
+    return buffer
+
+
+def check_data_url_size(data_url: str, max_bytes: int, label: str):
+    """按 base64 长度估算 data URL 解码后的大小，超过 max_bytes 时拒绝（不必先解码）"""
+    index = data_url.find(";base64,")
+    if index != -1 and (len(data_url) - index - 8) * 3 // 4 > max_bytes:
+        raise HTTPException(status_code=413, detail=f"{label}过大，最大支持 {max_bytes // (1024 * 1024)}MB")
@@ -1,45 +1,324 @@
-import base64
+import asyncio
+import bisect
+import collections
+import hashlib
 import io
+import itertools
+import multiprocessing
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import fitz  # PyMuPDF
 from PIL import Image
-from typing import List, Dict, Any, Iterator
+from typing import List, Dict, Any, Iterator, AsyncGenerator, Tuple, Optional, IO, Callable, Awaitable
+from fastapi import UploadFile, HTTPException
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import os
 
-class PDFProcessor:
+from common.metrics import metrics
+from config.settings import settings
+
+# PDF 来源：内存中的文件内容，或落盘文件的路径
+PDFSource = bytes | str
+
+# 接收一段新产出文档块的回调（如逐段写入缓存或数据库）
+ChunkSink = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+
+
+def _open_pdf(source: PDFSource) -> fitz.Document:
+    """打开PDF：内存内容直接按字节流打开，落盘文件按路径打开（按需读取页面，不整体载入内存）"""
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def _count_pages(source: PDFSource) -> int:
+    """读取PDF页数（只解析文档结构，不提取文本）"""
+    with _open_pdf(source) as doc:
+        return len(doc)
+
+
+def _extract_page_range(source: PDFSource, start: int, end: int) -> Tuple[int, List[str], float]:
+    """
+    提取 [start, end) 页的文本（在进程池中执行，必须是模块级函数）
+    :return: (起始页序号, 每页文本, 耗时秒数)
+    """
+    started = time.perf_counter()
+    with _open_pdf(source) as doc:
+        texts = [doc[page_num].get_text() for page_num in range(start, end)]
+    return start, texts, time.perf_counter() - started
+
+
+def _render_pages(source: PDFSource, page_numbers: List[int], dpi: int, image_format: str,
+                  quality: int) -> Tuple[int, List[Tuple[int, bytes]], float]:
+    """
+    把指定页渲染成压缩图片（在进程池中执行，必须是模块级函数）
+    JPEG 由 fitz 直接编码，WebP 才经过 PIL 转换
+    :return: (第一页序号, [(页序号, 图片字节)], 耗时秒数)
+    """
+    started = time.perf_counter()
+    images = []
+    with _open_pdf(source) as doc:
+        for page_num in page_numbers:
+            pix = doc[page_num].get_pixmap(dpi=dpi, alpha=False)
+            if image_format == "webp":
+                buffer = io.BytesIO()
+                Image.frombytes("RGB", (pix.width, pix.height), pix.samples).save(
+                    buffer, format="WEBP", quality=quality)
+                data = buffer.getvalue()
+            else:
+                data = pix.tobytes("jpeg", jpg_quality=quality)
+            images.append((page_num, data))
+    return page_numbers[0], images, time.perf_counter() - started
+
+
+# OCR 处理函数：传入 [(页序号, 图片字节)]，返回 {页序号: 识别出的文本}
+OCRHandler = Callable[[List[Tuple[int, bytes]]], Awaitable[Dict[int, str]]]
+
+
+class StreamingSplitter:
+    """
+    增量分块：按页序追加文本，已经确定的块立即产出
+    - 缓冲区只保留最后一个块（后续文本可能让它变长）起点之后的文本，内存与单页文本量相当
+    - 最后一个块从原起点重新切分，与前一个块的重叠跨页保留
+    """
+
+    def __init__(self, splitter: RecursiveCharacterTextSplitter):
+        self.splitter = splitter
+        self.buffer = ""
+        self.offset = 0  # 缓冲区第一个字符在全文中的位置
+
+    def feed(self, text: str) -> List[Tuple[int, str]]:
+        """追加文本，返回已经确定的块 [(在全文中的起始位置, 块文本)]"""
+        self.buffer += text
+        documents = self.splitter.create_documents([self.buffer])
+        if len(documents) <= 1:
+            return []
+        keep = documents[-1].metadata["start_index"]
+        if keep <= 0:
+            return []
+        chunks = [(self.offset + document.metadata["start_index"], document.page_content)
+                  for document in documents[:-1]]
+        self.buffer = self.buffer[keep:]
+        self.offset += keep
+        return chunks
+
+    def finish(self) -> List[Tuple[int, str]]:
+        """全部文本追加完成后，返回剩余的块"""
+        chunks = [(self.offset + document.metadata["start_index"], document.page_content)
+                  for document in self.splitter.create_documents([self.buffer])] if self.buffer else []
+        self.offset += len(self.buffer)
+        self.buffer = ""
+        return chunks
+
+
+class ChunkCollector:
+    """在内存中收集逐段产出的文档块，供需要完整文档块列表的调用方使用（作为 ChunkSink 传入）"""
+
     def __init__(self):
+        self.chunks: List[Dict[str, Any]] = []
+
+    async def __call__(self, chunks: List[Dict[str, Any]]):
+        self.chunks.extend(chunks)
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """全部产出后填写每个文档块的 total_chunks"""
+        for chunk in self.chunks:
+            chunk["metadata"]["total_chunks"] = len(self.chunks)
+        return self.chunks
+
+
+class PDFUpload:
+    """
+    上传的PDF文件
+    - 不超过 PDF_MEMORY_THRESHOLD 的文件保存在内存中
+    - 更大的文件分块写入唯一命名的临时文件（不使用上传文件名，避免同名冲突；写入在线程中执行），关闭或被回收时自动删除
+    - 读取过程中增量计算 SHA-256，并在超过 PDF_MAX_UPLOAD_BYTES 时立即拒绝
+    - 也可以指向已保存的文件（文档库），此时关闭不会删除文件
+    临时文件写完即关闭，由 fitz 和进程池按路径重新打开
+    """
+
+    def __init__(self, filename: str, size: int, sha256: str, content: Optional[bytes] = None,
+                 peak_memory: int = 0, path: Optional[str] = None, temporary: bool = False):
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.content = content
+        self.path = path
+        self.temporary = temporary  # path 是否为本对象创建的临时文件（关闭时删除）
+        self.peak_memory = peak_memory  # 读取过程中占用的最大内存（字节）
+
+    @property
+    def source(self) -> PDFSource:
+        """交给 fitz 打开的来源：内存内容或文件路径"""
+        return self.path if self.path is not None else self.content
+
+    @property
+    def storage(self) -> str:
+        return "disk" if self.path is not None else "memory"
+
+    def save_to(self, path: str):
+        """保存到指定路径（先写临时文件再改名，避免并发写入时读到不完整的文件）"""
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        if self.path is not None:
+            shutil.copyfile(self.path, tmp_path)
+        else:
+            with open(tmp_path, "wb") as f:
+                f.write(self.content)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_bytes(cls, content: bytes, filename: str) -> "PDFUpload":
+        return cls(filename, len(content), hashlib.sha256(content).hexdigest(), content=content,
+                   peak_memory=len(content))
+
+    @classmethod
+    async def from_upload(cls, upload: UploadFile) -> "PDFUpload":
+        """分块读取上传文件，内存占用不超过 PDF_MEMORY_THRESHOLD + PDF_READ_CHUNK_BYTES"""
+        digest = hashlib.sha256()
+        buffer = bytearray()
+        spool: Optional[IO[bytes]] = None
+        path = None
+        size = 0
+        peak_memory = 0
+        try:
+            while chunk := await upload.read(settings.PDF_READ_CHUNK_BYTES):
+                size += len(chunk)
+                if size > settings.PDF_MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413,
+                                        detail=f"PDF文件过大，最大支持 {settings.PDF_MAX_UPLOAD_BYTES // (1024 * 1024)}MB")
+                digest.update(chunk)
+                if spool is None and size > settings.PDF_MEMORY_THRESHOLD:
+                    # 超过内存阈值，已缓冲的内容转存到临时文件
+                    fd, path = tempfile.mkstemp(prefix="pdf-", suffix=".pdf", dir=settings.PDF_SPOOL_DIR)
+                    spool = os.fdopen(fd, "wb")
+                    await asyncio.to_thread(spool.write, buffer)
+                    buffer = bytearray()
+                if spool is not None:
+                    await asyncio.to_thread(spool.write, chunk)
+                    peak_memory = max(peak_memory, len(chunk))
+                else:
+                    buffer += chunk
+                    peak_memory = max(peak_memory, len(buffer))
+            if spool is not None:
+                spool.close()
+        except BaseException:
+            if spool is not None:
+                spool.close()
+                _remove_file(path)
+            raise
+
+        metrics.observe("pdf_upload_peak_memory_bytes", peak_memory)
+        return cls(upload.filename, size, digest.hexdigest(), content=bytes(buffer) if spool is None else None,
+                   peak_memory=peak_memory, path=path, temporary=path is not None)
+
+    def close(self):
+        """释放内存内容，删除临时文件"""
+        self.content = None
+        if self.temporary and self.path is not None:
+            _remove_file(self.path)
+            self.path = None
+            self.temporary = False
+
+    def __del__(self):
+        self.close()
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PDFProcessor:
+    # 分块参数（同时作为文档块缓存键的一部分）
+    CHUNK_SIZE = 1000
+    CHUNK_OVERLAP = 200
+    SEPARATORS = ["\n\n", "\n", " ", ""]
+    # 文档块结构版本，元数据格式变化时递增，使旧缓存失效
+    CHUNK_FORMAT_VERSION = 4
+
+    # PDF 文本提取进程池（进程内共享，懒加载）
+    _pool: Optional[ProcessPoolExecutor] = None
+
+    def __init__(self, ocr_handler: Optional[OCRHandler] = None):
+        # 扫描页（没有文字层）的 OCR 处理函数，为 None 时不做 OCR
+        self.ocr_handler = ocr_handler
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", " ", ""]
+            chunk_size=self.CHUNK_SIZE,
+            chunk_overlap=self.CHUNK_OVERLAP,
+            separators=self.SEPARATORS,
+            add_start_index=True  # 记录每个块在全文中的起始位置，用于计算页码
         )
 
-    @staticmethod
-    async def extract_pdf_pages_as_images(file_content: bytes, max_pages: int = 5) -> List[str]:
-        """
-        因为上传的pdf有时候会是扫描件，无法直接读取文字，通常需要将文档的每页作为图片提取出来并作OCR处理
-        """
-        try:
-            pdf_document = fitz.open(stream=file_content, filetype="pdf")
-            total_pages = len(pdf_document)
-            pages_to_extract = min(max_pages, total_pages)
+    @classmethod
+    def get_pool(cls) -> ProcessPoolExecutor:
+        """获取文本提取进程池，进程数上限由 PDF_EXTRACT_MAX_WORKERS 控制"""
+        if cls._pool is None:
+            # 使用 spawn 启动子进程，避免 fork 带有事件循环线程的父进程
+            cls._pool = ProcessPoolExecutor(max_workers=settings.PDF_EXTRACT_MAX_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return cls._pool
 
-            images = []
-            for page_num in range(pages_to_extract):
-                page = pdf_document.load_page(page_num)
-                pix = page.get_pixmap()
-                img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    @classmethod
+    def shutdown_pool(cls):
+        """关闭进程池（应用关闭时调用）"""
+        if cls._pool is not None:
+            cls._pool.shutdown(wait=False, cancel_futures=True)
+            cls._pool = None
 
-                buffer = io.BytesIO()
-                img.save(buffer, format="PNG")
-                base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
-                images.append(base64_image)
+    @classmethod
+    def splitter_params(cls) -> Dict[str, Any]:
+        """影响分块结果的全部参数"""
+        return {
+            "chunk_size": cls.CHUNK_SIZE,
+            "chunk_overlap": cls.CHUNK_OVERLAP,
+            "separators": cls.SEPARATORS,
+            "version": cls.CHUNK_FORMAT_VERSION,
+            "ocr": [settings.PDF_OCR_MODEL, settings.PDF_OCR_DPI] if settings.PDF_OCR_ENABLED else None,
+        }
 
-            pdf_document.close()
-            return images
+    @staticmethod
+    def source_info(filename: str, metadata: Dict[str, Any]) -> str:
+        """文档块的来源说明（引用溯源时展示），跨页的块显示页码范围"""
+        page_start = metadata.get("page_start", metadata["page_number"])
+        page_end = metadata.get("page_end", page_start)
+        if page_end != page_start:
+            return f"{filename} - 第{page_start}-{page_end}页"
+        return f"{filename} - 第{page_start}页"
 
-        except Exception as e:
-            raise
+    @staticmethod
+    def page_range(page_offsets: List[int], start: int, end: int) -> Tuple[int, int]:
+        """
+        根据字符区间计算页码范围（页码从 1 开始）
+        :param page_offsets: 每页第一个字符在全文中的位置（单调不减）
+        :param start: 区间起始位置
+        :param end: 区间结束位置（不含）
+        """
+        page_start = max(1, bisect.bisect_right(page_offsets, start))
+        page_end = max(page_start, bisect.bisect_right(page_offsets, max(start, end - 1)))
+        return page_start, page_end
+
+    @classmethod
+    async def extract_pdf_pages_as_images(cls, source: PDFSource,
+                                          page_numbers: List[int]) -> List[Tuple[int, bytes]]:
+        """
+        因为上传的pdf有时候会是扫描件，无法直接读取文字，通常需要将文档的每页作为图片提取出来并作OCR处理
+        按 PDF_OCR_DPI 渲染，编码为 PDF_OCR_IMAGE_FORMAT（jpeg / webp），多页时在进程池中并行渲染
+        :return: [(页序号, 图片字节)]，按页序号排列
+        """
+        per_task = max(1, settings.PDF_OCR_PAGES_PER_TASK)
+        tasks = [(source, page_numbers[i:i + per_task], settings.PDF_OCR_DPI, settings.PDF_OCR_IMAGE_FORMAT,
+                  settings.PDF_OCR_IMAGE_QUALITY) for i in range(0, len(page_numbers), per_task)]
+        images = []
+        async for _, rendered, elapsed in cls._map_pages(_render_pages, tasks):
+            metrics.observe("pdf_render_range_seconds", elapsed)
+            images.extend(rendered)
+        return sorted(images)
 
     @staticmethod
     def read_pdf_pages(pdf_path):
@@ -48,85 +327,212 @@ class PDFProcessor:
             print(f"错误：文件 '{pdf_path}' 不存在")
             return {}
 
+    @classmethod
+    def _submitter(cls, func: Callable, tasks: List[tuple]) -> Callable[[tuple], asyncio.Future]:
+        """
+        返回提交单个任务的函数
+        只有一个任务时在线程中直接执行，省去进程间传输的开销；
+        来源是内存中的内容（bytes）时也在线程中执行，避免每个任务都序列化一份完整文件
+        """
+        if len(tasks) <= 1 or isinstance(tasks[0][0], bytes):
+            return lambda args: asyncio.ensure_future(asyncio.to_thread(func, *args))
+        loop = asyncio.get_running_loop()
+        pool = cls.get_pool()
+        return lambda args: loop.run_in_executor(pool, func, *args)
+
+    @classmethod
+    async def _map_pages(cls, func: Callable, tasks: List[tuple]) -> AsyncGenerator[tuple, None]:
+        """并行执行按页拆分的任务，按完成顺序产出结果"""
+        futures = []
+        try:
+            submit = cls._submitter(func, tasks)
+            futures = [submit(args) for args in tasks]
+            for future in asyncio.as_completed(futures):
+                yield await future
+        except BrokenProcessPool:
+            # 子进程异常退出后进程池不可用，下次提取时重建
+            cls._pool = None
+            raise
+        finally:
+            # 客户端断开或提取失败时取消尚未开始的任务
+            for future in futures:
+                future.cancel()
+
+    @classmethod
+    async def _map_pages_ordered(cls, func: Callable, tasks: List[tuple],
+                                 window: int) -> AsyncGenerator[tuple, None]:
+        """
+        并行执行按页拆分的任务，按任务顺序产出结果
+        同时最多 window 个任务在执行或等待产出，已完成但排在后面的结果不会无限堆积
+        """
+        futures = collections.deque()
+        try:
+            submit = cls._submitter(func, tasks)
+            queue = iter(tasks)
+            futures.extend(submit(args) for args in itertools.islice(queue, max(1, window)))
+            while futures:
+                result = await futures.popleft()
+                futures.extend(submit(args) for args in itertools.islice(queue, 1))
+                yield result
+        except BrokenProcessPool:
+            cls._pool = None
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+    @classmethod
+    async def _extract_pages(cls, source: PDFSource, total_pages: int) -> AsyncGenerator[Tuple[int, List[str]], None]:
+        """并行提取全部页面文本，按页序产出 (起始页序号, 每页文本)"""
+        per_task = max(1, settings.PDF_PAGES_PER_TASK)
+        tasks = [(source, start, min(start + per_task, total_pages)) for start in range(0, total_pages, per_task)]
+        async for start, texts, elapsed in cls._map_pages_ordered(_extract_page_range, tasks,
+                                                                  settings.PDF_EXTRACT_WINDOW):
+            metrics.observe("pdf_extract_range_seconds", elapsed)
+            yield start, texts
+
+    async def _ocr_pages(self, upload: PDFUpload, start: int, texts: List[str],
+                         budget: int) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        对一段连续页面中没有文字层的页面（扫描件）做 OCR，识别结果直接写回 texts
+        :param start: texts 第一页的页序号
+        :param budget: 本文档剩余可 OCR 的页数
+        """
+        if not self.ocr_handler or not settings.PDF_OCR_ENABLED or budget <= 0:
+            return
+        blank_pages = [start + i for i, text in enumerate(texts)
+                       if len(text.strip()) < settings.PDF_OCR_MIN_CHARS][:budget]
+        if not blank_pages:
+            return
+
+        started = time.monotonic()
+        images = await self.extract_pdf_pages_as_images(upload.source, blank_pages)
+        recognized = await self.ocr_handler(images)
+        for page_num, text in recognized.items():
+            if text.strip():
+                texts[page_num - start] = text if text.endswith("\n") else text + "\n"
+        print(f"OCR 完成，第 {start + 1}-{start + len(texts)} 页中 {len(blank_pages)} 页为扫描页，"
+              f"识别出 {len(recognized)} 页，耗时 {time.monotonic() - started:.3f}s")
+        yield {"type": "pdf_progress", "stage": "ocr", "ocr_pages": len(blank_pages),
+               "pages_recognized": sum(1 for text in recognized.values() if text.strip())}
+
     async def process_pdf(self, file_content: bytes, filename: str):
         """
-        流式处理PDF文档
-        返回处理进度和结果
+        处理PDF文档，返回文档块列表（不需要进度时使用）
         """
+        upload = PDFUpload.from_bytes(file_content, filename)
+        collector = ChunkCollector()
         try:
-            # Step 1: 保存临时文件
-            print('保存临时文件')
-
-            # 创建临时文件
-            temp = r'temp'
-            # 先创建 temp 目录（如果不存在）, exist_ok=True 表示如果目录已存在，不会报错
-            os.makedirs(temp, exist_ok=True)
-            tmp_file_path = os.path.join(temp, filename)
-            with open(tmp_file_path, 'wb') as f:
-                f.write(file_content)
-
-            full_text = ""
-            doc = fitz.open(tmp_file_path)
-            # 存储每页内容
-            pages_content = {}
-            # 逐页读取内容
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                # 提取文本
-                text = page.get_text()
-                full_text += text
-                # 存储页面内容
-                pages_content[page_num + 1] = text
-            print(f"合并后文本长度: {len(full_text)} 字符")
-
-            # 调试：输出前200个字符看看提取到了什么
-            preview = full_text[:200] if full_text else "空内容"
-            print(f"文本预览: {repr(preview)}")
-
-            # 使用RecursiveCharacterTextSplitter进行智能分块
-            text_chunks = self.text_splitter.split_text(full_text)
-            print(f"文本分块完成，共 {len(text_chunks)} 个块")
-
-            # Step 4: 构建文档块
-            print(f"正在构建 {len(text_chunks)} 个文档块...")
-
-            # 构建带元数据的文档块（包含页码信息）
-            document_chunks = []
-            for i, chunk in enumerate(text_chunks):
-                if chunk.strip():  # 过滤空块
-                    # 尝试从原始文档块中获取页码信息
-                    page_number = 1  # 默认页码
-                    sorted_keys = sorted(pages_content.keys())
-                    for page_number in sorted_keys:
-                        if chunk.strip()[:50] in pages_content[page_number]:
-                            break
-
-                    doc_chunk = {
-                        "id": f"{filename}_{i}",
-                        "content": chunk.strip(),
-                        "metadata": {
-                            "source": filename,
-                            "chunk_id": i,
-                            "chunk_size": len(chunk),
-                            "total_chunks": len(text_chunks),
-                            "page_number": page_number,
-                            "reference_id": f"[{i + 1}]",
-                            "source_info": f"{filename} - 第{page_number}页"
-                        }
-                    }
-                    document_chunks.append(doc_chunk)
-
-            print(document_chunks)
-
-            # Step 5: 完成处理
-            print(f"处理完成！共生成 {len(document_chunks)} 个文档块")
-
-            # 返回处理结果
-            return document_chunks
+            async for event in self.process_pdf_stream(upload, on_chunks=collector):
+                if event["type"] == "pdf_ready":
+                    return collector.finish()
         except Exception as e:
             print(f"PDF处理失败: {str(e)}")
             return {
                 "type": "error",
                 "error": f"PDF处理失败: {str(e)}"
             }
+        finally:
+            upload.close()
+
+    async def process_pdf_stream(self, upload: PDFUpload,
+                                 on_chunks: Optional[ChunkSink] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        流式处理PDF文档
+        逐步产出处理进度（pdf_progress），最后产出处理结果（pdf_ready，只含页数、文档块数等统计）
+        每段页面分块后立即把新文档块交给 on_chunks（如写入缓存或数据库），本方法不保留已产出的文档块；
+        此时总块数未知，文档块的 total_chunks 为 None，由读取方按 pdf_ready 的 total_chunks 填写
+        """
+        started = time.monotonic()
+        filename = upload.filename
+        # 收到文件后立即推送第一条进度，前端不必等待解析完成
+        yield {"type": "pdf_progress", "stage": "received", "filename": filename, "size": upload.size,
+               "storage": upload.storage, "peak_memory": upload.peak_memory}
+
+        # 解析和分块都不在事件循环中执行：按页范围拆分任务，交给进程池并行提取
+        # 页面按页序流过 提取 -> OCR -> 分块，内存中只保留在途的几段页面和分块缓冲区
+        # 内存中的小文件不落盘，在线程中提取；已落盘的大文件按路径交给进程池
+        total_pages = await asyncio.to_thread(_count_pages, upload.source)
+        splitter = StreamingSplitter(self.text_splitter)
+        page_offsets: List[int] = []  # 每页第一个字符在全文中的位置
+        text_length = 0
+        ocr_budget = settings.PDF_OCR_MAX_PAGES
+        chunks_built = 0
+        pages_parsed = 0
+        async for start, texts in self._extract_pages(upload.source, total_pages):
+            # 扫描页没有文字层，渲染成图片后交给视觉模型识别
+            async for event in self._ocr_pages(upload, start, texts, ocr_budget):
+                ocr_budget -= event["ocr_pages"]
+                yield event
+
+            for text in texts:
+                page_offsets.append(text_length)
+                text_length += len(text)
+            chunks = await asyncio.to_thread(splitter.feed, "".join(texts))
+            chunks_built += await self._emit(self._build_chunks(filename, page_offsets, chunks, chunks_built),
+                                             on_chunks)
+            pages_parsed += len(texts)
+            yield {"type": "pdf_progress", "stage": "parsing", "pages_parsed": pages_parsed,
+                   "total_pages": total_pages, "chunks_built": chunks_built,
+                   "pages_per_second": round(pages_parsed / max(time.monotonic() - started, 1e-6), 1)}
+
+        chunks_built += await self._emit(self._build_chunks(filename, page_offsets, splitter.finish(), chunks_built),
+                                         on_chunks)
+        yield {"type": "pdf_progress", "stage": "chunking", "pages_parsed": total_pages,
+               "total_pages": total_pages, "chunks_built": chunks_built}
 
+        elapsed = time.monotonic() - started
+        pages_per_second = round(total_pages / max(elapsed, 1e-6), 1)
+        metrics.observe("pdf_pages_per_second", pages_per_second)
+        print(f"处理完成！共 {total_pages} 页、{text_length} 字符，生成 {chunks_built} 个文档块，"
+              f"耗时 {elapsed:.3f}s（{pages_per_second} 页/秒）")
+
+        # 返回处理结果
+        yield {
+            "type": "pdf_ready",
+            "filename": filename,
+            "total_pages": total_pages,
+            "total_chunks": chunks_built,
+            "elapsed": round(elapsed, 3),
+            "pages_per_second": pages_per_second,
+        }
+
+    @staticmethod
+    async def _emit(chunks: List[Dict[str, Any]], on_chunks: Optional[ChunkSink]) -> int:
+        """把新产出的文档块交给回调，返回块数"""
+        if chunks and on_chunks is not None:
+            await on_chunks(chunks)
+        return len(chunks)
+
+    def _build_chunks(self, filename: str, page_offsets: List[int], chunks: List[Tuple[int, str]],
+                      first_id: int) -> List[Dict[str, Any]]:
+        """构建带元数据的文档块（包含页码信息），total_chunks 由读取方在全部分块完成后填写"""
+        document_chunks = []
+        for index, chunk in chunks:
+            content = chunk.strip()
+            if not content:  # 过滤空块
+                continue
+            # 按去掉首尾空白后的字符区间二分查找页码，跨页的块同时记录起止页
+            start = index + len(chunk) - len(chunk.lstrip())
+            end = start + len(content)
+            page_start, page_end = self.page_range(page_offsets, start, end)
+            chunk_id = first_id + len(document_chunks)
+            doc_chunk = {
+                "id": f"{filename}_{chunk_id}",
+                "content": content,
+                "metadata": {
+                    "source": filename,
+                    "chunk_id": chunk_id,
+                    "chunk_size": len(chunk),
+                    "total_chunks": None,
+                    "page_number": page_start,
+                    "page_start": page_start,
+                    "page_end": page_end,
+                    "start_index": start,
+                    "end_index": end,
+                    "reference_id": f"[{chunk_id + 1}]",
+                }
+            }
+            doc_chunk["metadata"]["source_info"] = self.source_info(filename, doc_chunk["metadata"])
+            document_chunks.append(doc_chunk)
+        return document_chunks
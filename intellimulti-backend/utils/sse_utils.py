@@ -0,0 +1,260 @@
+import asyncio
+import collections
+import json
+import time
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import anyio
+from fastapi import Request
+
+from config.settings import settings
+
+# 预构建的 JSON 编码器，所有事件复用同一个实例
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+# C 实现的字符串转义（不转义非 ASCII 字符），用于固定信封中的 content 字段
+_encode_string = json.encoder.encode_basestring
+
+# 刷新策略
+FLUSH_IMMEDIATE = "immediate"  # 每个增量立即发送（与旧行为一致）
+FLUSH_WINDOW = "window"  # 按时间窗口合并，同时受字节阈值约束
+FLUSH_BYTES = "bytes"  # 累积到字节阈值才发送
+
+# 支持的压缩方式及对应的 zlib wbits
+_ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+class SSEEncoder:
+    """
+    SSE 流式编码器
+    - 将多个 content_delta 增量合并成一帧发送，减少 json 序列化、时间戳计算和写操作次数
+    - window 策略下配合 paced() 使用：上游停顿时缓冲的增量在 flush_interval 到期后发送，不必等下一个增量
+    - content_delta 使用预构建的固定信封，只对 content 做字符串转义
+    - 可选 gzip/deflate 压缩，每帧之后 Z_SYNC_FLUSH，保证客户端能立即解出已发送的事件
+    事件结构与原有 content_delta / message_complete 保持兼容
+    """
+
+    def __init__(self,
+                 flush_policy: str = None,
+                 flush_interval_ms: int = None,
+                 flush_bytes: int = None,
+                 content_encoding: Optional[str] = None):
+        self.flush_policy = flush_policy or settings.SSE_FLUSH_POLICY
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None
+                               else settings.SSE_FLUSH_INTERVAL_MS) / 1000
+        self.flush_bytes = flush_bytes if flush_bytes is not None else settings.SSE_FLUSH_BYTES
+        self.content_encoding = content_encoding if content_encoding in _ENCODINGS else None
+
+        self._pending: List[str] = []
+        self._pending_bytes = 0
+        self._last_flush = time.monotonic()
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, _ENCODINGS[self.content_encoding]) \
+            if self.content_encoding else None
+
+    @staticmethod
+    def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+        """根据请求头 Accept-Encoding 和配置选择压缩方式"""
+        if not settings.SSE_COMPRESSION or not accept_encoding:
+            return None
+        accepted = {item.split(";")[0].strip().lower() for item in accept_encoding.split(",")}
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """压缩时需要附加的响应头"""
+        if self.content_encoding:
+            return {"Content-Encoding": self.content_encoding, "Vary": "Accept-Encoding"}
+        return {}
+
+    def delta(self, content: str) -> bytes:
+        """写入一个文本增量，满足刷新条件时返回待发送的帧，否则返回空字节"""
+        if not content:
+            return b""
+        self._pending.append(content)
+        self._pending_bytes += len(content.encode("utf-8"))
+
+        if self.flush_policy == FLUSH_IMMEDIATE or self._pending_bytes >= self.flush_bytes:
+            return self.flush()
+        if self.flush_policy == FLUSH_WINDOW and time.monotonic() - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return b""
+
+    async def paced(self, stream: AsyncIterator[str]) -> AsyncIterator[Optional[str]]:
+        """
+        逐个产出上游增量；window 策略下缓冲中有增量且距上次发送已超过 flush_interval 时产出 None，
+        调用方收到 None 时调用 flush()，上游停顿期间缓冲的增量也能按时发出
+        上游在一个单独的任务中读取（整个流只创建一个任务），关闭时取消该任务
+        """
+        if self.flush_policy != FLUSH_WINDOW:
+            async for item in stream:
+                yield item
+            return
+
+        loop = asyncio.get_running_loop()
+        items = collections.deque()
+        wakeup: Optional[asyncio.Future] = None
+
+        def notify():
+            if wakeup is not None and not wakeup.done():
+                wakeup.set_result(None)
+
+        async def pump():
+            try:
+                async for item in stream:
+                    items.append(item)
+                    notify()
+            finally:
+                notify()
+
+        reader = asyncio.ensure_future(pump())
+        try:
+            while True:
+                if items:
+                    yield items.popleft()
+                    continue
+                if reader.done():
+                    # 上游结束，有异常时在这里抛出
+                    reader.result()
+                    return
+                wakeup = loop.create_future()
+                timer = None
+                if self._pending:
+                    timer = loop.call_later(max(0.0, self._last_flush + self.flush_interval - time.monotonic()),
+                                            notify)
+                try:
+                    await wakeup
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                if not items and not reader.done() and self._pending:
+                    yield None
+        finally:
+            reader.cancel()
+            # 等待上游完成取消后的清理，调用方之后才能安全地关闭上游
+            with anyio.CancelScope(shield=True):
+                await asyncio.gather(reader, return_exceptions=True)
+
+    def event(self, data: Dict[str, Any]) -> bytes:
+        """发送一个完整事件（先把缓冲的增量刷出去，保证顺序），不修改传入的事件"""
+        pending = self._drain_pending()
+        if "timestamp" not in data:
+            data = {**data, "timestamp": datetime.now().isoformat()}
+        return pending + self._output(f"data: {_json_encoder.encode(data)}\n\n")
+
+    def flush(self) -> bytes:
+        """立即发送缓冲中的增量"""
+        return self._drain_pending()
+
+    def close(self) -> bytes:
+        """结束编码：刷出剩余增量，并写入压缩流结尾"""
+        output = self._drain_pending()
+        if self._compressor:
+            output += self._compressor.flush(zlib.Z_FINISH)
+            self._compressor = None
+        return output
+
+    def _drain_pending(self) -> bytes:
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return b""
+        content = "".join(self._pending)
+        self._pending.clear()
+        self._pending_bytes = 0
+        frame = ('data: {"type":"content_delta","content":' + _encode_string(content)
+                 + ',"timestamp":"' + datetime.now().isoformat() + '"}\n\n')
+        return self._output(frame)
+
+    def _output(self, frame: str) -> bytes:
+        data = frame.encode("utf-8")
+        if self._compressor:
+            return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+
+class ClientDisconnected(Exception):
+    """SSE 客户端已断开连接"""
+
+
+class DisconnectMonitor:
+    """
+    SSE 客户端断连检测
+    - 后台任务按固定间隔检查 ASGI 的 http.disconnect 消息（Request.is_disconnected）
+    - guard() 包装上游异步迭代器：读取上游时登记当前任务，断连时由后台任务直接取消它，
+      取消在上游内部展开并完成清理后转换为 ClientDisconnected；不为每块输出单独创建任务
+    """
+
+    def __init__(self, request: Optional[Request], interval: float = None):
+        self.request = request
+        self.interval = interval if interval is not None else settings.SSE_DISCONNECT_CHECK_INTERVAL
+        self._event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # 正在读取上游的任务，以及是否已因断连取消过它
+        self._consumer: Optional[asyncio.Task] = None
+        self._cancelled = False
+
+    @property
+    def disconnected(self) -> bool:
+        return self._event.is_set()
+
+    async def __aenter__(self):
+        if self.request is not None:
+            self._task = asyncio.create_task(self._watch())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            if await self.request.is_disconnected():
+                self._event.set()
+                if self._consumer is not None:
+                    self._cancelled = True
+                    self._consumer.cancel()
+                return
+            await asyncio.sleep(self.interval)
+
+    async def guard(self, stream: AsyncIterator) -> AsyncIterator:
+        """逐个产出上游数据，客户端断连时取消正在等待的上游读取"""
+        iterator = stream.__aiter__()
+        if self._task is None:
+            async for item in iterator:
+                yield item
+            return
+
+        task = asyncio.current_task()
+        while True:
+            if self.disconnected:
+                raise self._disconnected_error(task)
+            self._consumer = task
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                if not self._cancelled:
+                    raise
+                raise self._disconnected_error(task)
+            finally:
+                self._consumer = None
+            yield item
+
+    def _disconnected_error(self, task: asyncio.Task) -> BaseException:
+        """
+        断连时抛出的异常：撤销本对象发起的取消，转换为 ClientDisconnected
+        任务同时还被其他地方取消（如服务关闭）时保留 CancelledError
+        """
+        if self._cancelled:
+            self._cancelled = False
+            if task.uncancel() > 0:
+                return asyncio.CancelledError()
+        return ClientDisconnected()
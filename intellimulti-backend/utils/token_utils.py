@@ -0,0 +1,49 @@
+import math
+import re
+from typing import Any, List
+
+from langchain_core.messages import BaseMessage
+
+# 中日韩字符（含全角标点），大多数分词器中约 1 个字符 1 个 token
+_CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 图片、音频按固定值估算（模型按分辨率/时长计费，这里取常见上传的量级）
+IMAGE_TOKENS = 1000
+AUDIO_TOKENS = 1500
+
+
+def estimate_text_tokens(text: str) -> int:
+    """估算文本 token 数：中日韩字符按 1 个/字，其余按约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def estimate_content_tokens(content: Any) -> int:
+    """估算消息内容（字符串或多模态内容块列表）的 token 数"""
+    if isinstance(content, str):
+        return estimate_text_tokens(content)
+    tokens = 0
+    for item in content or []:
+        if isinstance(item, str):
+            tokens += estimate_text_tokens(item)
+        elif item.get("type") == "text":
+            tokens += estimate_text_tokens(item.get("text", ""))
+        elif item.get("type") == "image_url":
+            tokens += IMAGE_TOKENS
+        elif item.get("type") == "audio_url":
+            tokens += AUDIO_TOKENS
+    return tokens
+
+
+def estimate_message_tokens(message: BaseMessage) -> int:
+    """估算单条消息的 token 数"""
+    return MESSAGE_OVERHEAD_TOKENS + estimate_content_tokens(message.content)
+
+
+def estimate_messages_tokens(messages: List[BaseMessage]) -> int:
+    """估算消息列表的 token 数"""
+    return sum(estimate_message_tokens(message) for message in messages)
@@ -0,0 +1,230 @@
+import abc
+import math
+import os
+import re
+import uuid
+import zlib
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.bm25_utils import tokenize
+
+# 索引文件后缀
+_INDEX_SUFFIX = ".index.npy"
+
+
+class EmbeddingBackend(abc.ABC):
+    """
+    本地向量化后端（CPU、离线）
+    name 参与索引文件名，更换后端或维度后旧索引自动失效；embed 返回 L2 归一化的 float32 矩阵
+    """
+    name: str
+    dim: int
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        ...
+
+
+class HashingEmbedding(EmbeddingBackend):
+    """
+    特征哈希向量化：词项（与 BM25 相同的分词，中文含二字组）哈希到固定维度，带符号累加对数词频
+    仅供测试使用：不需要模型文件，但只能匹配相同词项，没有语义检索能力，生产环境应配置 sentence-transformers 模型
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                h = zlib.crc32(token.encode("utf-8"))
+                matrix[row, h % self.dim] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(count))
+        return _normalize(matrix)
+
+
+class SentenceTransformerEmbedding(EmbeddingBackend):
+    """sentence-transformers 本地模型（可选依赖，只在配置使用时导入）"""
+
+    def __init__(self, model_name: str, batch_size: int = 32):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError("使用 sentence-transformers 向量化后端需要安装 sentence-transformers") from e
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = "st-" + re.sub(r'[^A-Za-z0-9._-]', '_', model_name)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                   normalize_embeddings=True)
+        return np.asarray(matrix, dtype=np.float32)
+
+
+def create_embedding_backend(spec: str) -> EmbeddingBackend:
+    """
+    根据配置创建向量化后端
+    - sentence-transformers:<模型名或本地路径>
+    - hashing / hashing:<维度>（仅供测试）
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "hashing":
+        return HashingEmbedding(int(arg) if arg else 512)
+    if kind == "sentence-transformers" and arg:
+        return SentenceTransformerEmbedding(arg)
+    raise ValueError(f"不支持的向量化后端: {spec}")
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """
+    int8 量化的向量索引
+    - 每行按最大绝对值对称量化为 int8，另存每行的缩放系数，内积 = (codes · q) * scale
+    - 缩放系数和量化矩阵保存在同一个文件中，加载时量化矩阵内存映射，不把整个矩阵读入内存
+    - 行号即文档块在列表中的序号，检索结果可直接对应原始文档块
+    """
+
+    # 分块计算内积的行数，限制反量化时的临时内存
+    BLOCK_ROWS = 4096
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self) -> int:
+        return len(self.scales)
+
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1]
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray) -> "VectorIndex":
+        """量化 float32 向量矩阵"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+        return cls(codes, scales.astype(np.float32))
+
+    def save(self, path: str):
+        """
+        保存到 {path}.index.npy：缩放系数和量化矩阵依次写入同一个文件
+        先写唯一命名的临时文件再改名，并发保存时读到的总是同一次写入的完整索引
+        """
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, self.scales)
+                np.save(f, self.codes)
+            os.replace(tmp_path, path + _INDEX_SUFFIX)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "VectorIndex":
+        """加载索引，缩放系数读入内存，量化矩阵按内存映射打开"""
+        file_path = path + _INDEX_SUFFIX
+        with open(file_path, "rb") as f:
+            scales = np.lib.format.read_array(f)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if len(shape) != 2 or dtype != np.int8 or fortran_order or shape[0] != len(scales):
+            raise ValueError(f"向量索引文件损坏: {path}")
+        if shape[0] == 0:
+            return cls(np.zeros(shape, dtype=np.int8), scales)
+        codes = np.memmap(file_path, dtype=np.int8, mode="r", offset=offset, shape=shape)
+        return cls(codes, scales)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + _INDEX_SUFFIX)
+
+    def vectors(self, ids: List[int]) -> np.ndarray:
+        """反量化指定行"""
+        ids = np.asarray(ids, dtype=np.int64)
+        return self.codes[ids].astype(np.float32) * self.scales[ids, None]
+
+    def search(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量检索内积最大的 top_k 行
+
+        Args:
+            queries: (查询数, 维度) 的 float32 矩阵
+
+        Returns:
+            (行号, 得分)，形状均为 (查询数, k)，按得分从高到低
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(top_k, len(self))
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        if k <= 0:
+            return best_ids, best_scores
+
+        for start in range(0, len(self), self.BLOCK_ROWS):
+            end = min(start + self.BLOCK_ROWS, len(self))
+            scores = (queries @ self.codes[start:end].astype(np.float32).T) * self.scales[start:end]
+            ids = np.broadcast_to(np.arange(start, end), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_ids = np.concatenate([best_ids, ids], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_ids = np.take_along_axis(best_ids, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def mmr(query: np.ndarray, candidates: np.ndarray, relevance: np.ndarray, top_k: int,
+        diversity: float = 0.3) -> List[int]:
+    """
+    最大边际相关（MMR）重排：每次选择 相关度 - 与已选结果的最大相似度 最高的候选
+
+    Args:
+        query: 查询向量（未使用 relevance 时用于计算相关度）
+        candidates: (候选数, 维度) 的候选向量
+        relevance: 候选的相关度，为 None 时使用与查询的内积
+        top_k: 选出的数量
+        diversity: 多样性权重（0 为只看相关度）
+
+    Returns:
+        选中的候选位置，按选择顺序
+    """
+    if not len(candidates):
+        return []
+    candidates = _normalize(np.asarray(candidates, dtype=np.float32))
+    if relevance is None:
+        relevance = candidates @ np.asarray(query, dtype=np.float32)
+    # 相关度缩放到最大为 1，与余弦相似度处于同一量级
+    relevance = np.asarray(relevance, dtype=np.float32)
+    relevance = relevance / max(float(relevance.max()), 1e-12)
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    while len(selected) < min(top_k, len(candidates)):
+        scores = (1 - diversity) * relevance - diversity * max_similarity
+        scores[selected] = -np.inf
+        choice = int(np.argmax(scores))
+        selected.append(choice)
+        np.maximum(max_similarity, similarity[choice], out=max_similarity)
+    return selected